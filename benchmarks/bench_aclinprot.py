@@ -0,0 +1,382 @@
+'''
+    Benchmark suite: hot paths of aclinprot over the repository corpus
+
+    Every case is timed with timeit (best of repeat runs) and its peak memory is measured with tracemalloc.
+    The results can be stored as a baseline and later runs are compared against it, flagging the cases
+    that are slower than the baseline by more than a threshold. Baselines store absolute timings and are
+    machine dependent: the machine is recorded with the baseline, a comparison on another machine is warned
+    about, and a baseline should be saved on the machine where the comparison is made. Corpus prescriptions
+    the converter rejects are excluded from the timings but reported; new rejections fail the comparison.
+
+    Usage (from the repository root):
+        python benchmarks/bench_aclinprot.py                    # run and compare with benchmarks/baseline.json
+        python benchmarks/bench_aclinprot.py --save             # run and store the results as the new baseline
+        python benchmarks/bench_aclinprot.py --threshold 0.3    # flag cases more than 30 % slower
+        python benchmarks/bench_aclinprot.py parse convert      # run only the cases whose name contains a pattern
+        python benchmarks/bench_aclinprot.py --scale 100 synthetic  # synthetic export 100 times the corpus size
+'''
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src/aclinprot')))
+import aclinprot as acp
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def _corpus(root=ROOT):
+    '''
+    Function: Files of the repository corpus used by the benchmarks
+    '''
+    corpus = {
+        'prescriptions': sorted(glob.glob(os.path.join(root, 'prescripciones', '*.csv'))),
+        'rsdicoms': sorted(glob.glob(os.path.join(root, 'DICOM', 'RS.*.dcm'))),
+        'clinprot': os.path.join(root, 'protocolos', 'clinicos', 'SBRTTórax1fx.xml'),
+        'largeProtocols': [os.path.join(root, 'protocolos', 'clinicos', name)
+                           for name in ['Próstata 20Fx mod.xml', 'SBRTTórax1fx.xml']],
+        'protocols': sorted(glob.glob(os.path.join(root, 'protocolos', '**', '*.xml'), recursive=True)),
+    }
+    return corpus
+
+def _convertible(prescriptions):
+    '''
+    Function: (file, prescription index) pairs that the converter accepts, and the ones it rejects
+
+    Returns:
+    pairs: List
+        (file, prescription index) pairs converted without errors
+    failures: List
+        (file name, prescription index, error) of the prescriptions the converter rejects. A conversion
+        that starts failing is a regression the timings cannot show, see compareFailures
+    '''
+    pairs, failures = [], []
+    for prescription in prescriptions:
+        pvdfs, _, _ = acp.parse_prescription(prescription)
+        for index in range(len(pvdfs)):
+            try:
+                acp.convertPrescriptionIntoClinicalProtocol(prescription, 'Bench', 'Bench', 'PlanID', ProtOut=None,
+                                                            PrescriptionIndex=index)
+            except Exception as e:
+                failures.append((os.path.basename(prescription), index, f'{type(e).__name__}: {e}'))
+                continue
+            pairs.append((prescription, index))
+    return pairs, failures
+
+def _syntheticCases(scale, nPrescriptions):
+    '''
+    Function: Cases parsing and converting a synthetic ARIA export scale times the size of the corpus
+    '''
+    content = io.BytesIO()
+    acp.generatePrescriptionExport(content, nPrescriptions=scale * nPrescriptions, nPTVs=2, nOARs=8, nDosimPars=2)
+    content = content.getvalue()
+    pvdfs, ccdfs, oardfs = acp.parse_prescription(io.BytesIO(content))
+
+    def convert():
+        for pvdf, ccdf, oardf in zip(pvdfs, ccdfs, oardfs):
+            acp.convertPrescriptionIntoClinicalProtocol(pvdf, 'Bench', 'Bench', 'PlanID', ProtOut=None, ccdf=ccdf,
+                                                        oardf=oardf, Return='bytes')
+
+    cases = [
+        ('parse_prescription[synthetic x{}]'.format(scale), lambda: acp.parse_prescription(io.BytesIO(content)),
+         len(pvdfs), 'prescriptions'),
+        ('parse_prescription_tables[synthetic x{}]'.format(scale),
+         lambda: acp.parse_prescription_tables(io.BytesIO(content)), len(pvdfs), 'prescriptions'),
+        ('convertPrescriptionIntoClinicalProtocol[synthetic x{}]'.format(scale), convert, len(pvdfs), 'protocols'),
+    ]
+    return cases
+
+def _xmlBackendCases(protocols):
+    '''
+    Function: Cases parsing, writing and summarizing the protocol library with every installed XML backend
+    '''
+    backends = [acp.xmlBackend('etree')]
+    try:
+        backends.append(acp.xmlBackend('lxml'))
+    except ImportError:
+        pass
+    cases = []
+    for backend in backends:
+        trees = [backend.parse(protocol) for protocol in protocols]
+
+        def parse(backend=backend):
+            for protocol in protocols:
+                backend.parse(protocol)
+
+        def write(backend=backend, trees=trees):
+            for tree in trees:
+                backend.tostring(tree)
+
+        def summarize(backend=backend):
+            for protocol in protocols:
+                acp.summarizeProt(protocol, backend=backend.name)
+
+        cases += [(f'parseProt[{backend.name}]', parse, len(protocols), 'files'),
+                  (f'writeProt[{backend.name}]', write, len(protocols), 'files'),
+                  (f'summarizeProt[{backend.name}]', summarize, len(protocols), 'files')]
+    return cases
+
+def benchmarkCases(root=ROOT, scale=0, failures=None):
+    '''
+    Function: Build the benchmark cases. Inputs are prepared here so that only the hot path is timed
+
+    Arguments:
+    root: String
+        Repository root
+    scale: Integer
+        If positive, add cases parsing and converting a synthetic export (see acp.generatePrescriptionExport)
+    failures: List or None
+        If given, the corpus prescriptions the converter rejects are appended to it, see _convertible
+        with scale times as many prescriptions as the corpus
+
+    Returns:
+    cases: List
+        (name, function, items, unit) tuples. function is called without arguments and processes
+        items units of work (files, parameters, structures...) per call
+    '''
+    corpus = _corpus(root)
+    prescriptions = corpus['prescriptions']
+    parsed = [acp.parse_prescription(prescription) for prescription in prescriptions]
+    oardfs = [oardf for _, _, fileoardfs in parsed for oardf in fileoardfs]
+    dosimPars = [dosimPar for oardf in oardfs for dosimPars in oardf['DosimPars'] for dosimPar in dosimPars]
+    pairs, conversionFailures = _convertible(prescriptions)
+    if failures is not None:
+        failures.extend(conversionFailures)
+    rsdicom = corpus['rsdicoms'][0]
+    clinprot = corpus['clinprot']
+
+    def parsePrescriptions():
+        for prescription in prescriptions:
+            acp.parse_prescription(prescription)
+
+    def parsePrescriptionTables():
+        for prescription in prescriptions:
+            acp.parse_prescription_tables(prescription)
+
+    def parsePrescriptionIR():
+        for prescription in prescriptions:
+            acp.parse_prescription_ir(prescription)
+
+    def parseDosimParLoop():
+        for dosimPar in dosimPars:
+            acp.parseDosimPar(dosimPar)
+
+    def checkDosimPars():
+        for oardf in oardfs:
+            acp.checkDosimPars(oardf)
+
+    def convert():
+        for prescription, index in pairs:
+            acp.convertPrescriptionIntoClinicalProtocol(prescription, 'Bench', 'Bench', 'PlanID', ProtOut=None,
+                                                        PrescriptionIndex=index, Return='bytes')
+
+    models = [acp.parseProt(protocol) for protocol in corpus['largeProtocols']]
+    modelIDs = [acp.readClinProtStructureNames(protocol) for protocol in corpus['largeProtocols']]
+    amendedStructures = sum(len(IDs) for IDs in modelIDs)
+
+    def amend():
+        for model, IDs in zip(models, modelIDs):
+            amended = acp.templateRegistry.get()
+            for ID in IDs:
+                acp.amendClinicalProtocol(amended, model, ID)
+
+    strNameRules = acp.StrNameRules(dictionary=os.path.join(root, 'tools', 'Diccionario.csv'))
+    strNames = {file: acp.readStructureNames(file)
+                for file in corpus['prescriptions'] + corpus['rsdicoms'] + [corpus['clinprot']]}
+    nStrNames = sum(len(names) for names in strNames.values())
+
+    cases = [
+        ('parse_prescription', parsePrescriptions, len(prescriptions), 'files'),
+        ('parse_prescription_tables', parsePrescriptionTables, len(prescriptions), 'files'),
+        ('parse_prescription_ir', parsePrescriptionIR, len(prescriptions), 'files'),
+        ('parseDosimPar', parseDosimParLoop, len(dosimPars), 'dosimpars'),
+        ('parseDosimPars', lambda: acp.parseDosimPars(dosimPars), len(dosimPars), 'dosimpars'),
+        ('checkDosimPars', checkDosimPars, len(oardfs), 'oardfs'),
+        ('convertPrescriptionIntoClinicalProtocol', convert, len(pairs), 'protocols'),
+        ('suggestStrNames', lambda: acp.suggestStrNames(clinprot, rsdicom), 1, 'protocols'),
+        ('StrNameRules.check', lambda: strNameRules.check(strNames), nStrNames, 'names'),
+        ('readStructureVolumes', lambda: acp.readStructureVolumes(rsdicom), 1, 'files'),
+        ('readStructureVolume', lambda: acp.readStructureVolume(rsdicom, 'Corazón'), 1, 'structures'),
+        ('readContouringStructureNames', lambda: acp.readContouringStructureNames(rsdicom), 1, 'files'),
+        ('amendClinicalProtocol', amend, amendedStructures, 'structures'),
+    ]
+    cases += _xmlBackendCases(corpus['protocols'])
+    if scale > 0:
+        cases += _syntheticCases(scale, len(pairs))
+    return cases
+
+def runBenchmark(function, items=1, repeat=5, number=None):
+    '''
+    Function: Time a function and measure its peak memory
+
+    Arguments:
+    function: Callable
+        Function called without arguments
+    items: Integer
+        Units of work processed per call, used to report the throughput
+    repeat, number: Integer
+        timeit repetitions. The best of repeat runs of number calls is reported.
+        If number is None it is calibrated so that each run takes at least 0.2 s
+
+    Returns:
+    result: dict
+        Keys 'Calls', 'Time_ms' (per call), 'Throughput' (items per second) and 'PeakKB'
+    '''
+    timer = timeit.Timer(function)
+    if number is None:
+        number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    result = {'Calls': number, 'Time_ms': seconds * 1000, 'Throughput': items / seconds, 'PeakKB': peak / 1024}
+    return result
+
+def runSuite(patterns=(), repeat=5, number=None, root=ROOT, scale=0, failures=None):
+    '''
+    Function: Run the benchmark cases
+
+    Arguments:
+    patterns: List of String
+        Run only the cases whose name contains any of the patterns. All cases if empty
+    repeat, number: Integer
+        See runBenchmark
+    root: String
+        Repository root
+    scale, failures:
+        See benchmarkCases
+
+    Returns:
+    benchdf: Pandas DataFrame
+        One row per case with columns ['Case', 'Items', 'Unit', 'Calls', 'Time_ms', 'Throughput', 'PeakKB']
+    '''
+    rows = []
+    for name, function, items, unit in benchmarkCases(root, scale, failures):
+        if patterns and not any(pattern in name for pattern in patterns):
+            continue
+        result = runBenchmark(function, items=items, repeat=repeat, number=number)
+        rows.append({'Case': name, 'Items': items, 'Unit': unit, **result})
+    benchdf = pd.DataFrame(rows, columns=['Case', 'Items', 'Unit', 'Calls', 'Time_ms', 'Throughput', 'PeakKB'])
+    return benchdf
+
+def _machine():
+    '''
+    Function: Description of the machine stored with a baseline. Absolute timings are only comparable on it
+    '''
+    machine = {'python': platform.python_version(), 'machine': platform.platform(),
+               'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()}
+    return machine
+
+def saveBaseline(benchdf, baseline=BASELINE, failures=None):
+    '''
+    Function: Store the benchmark results as a json baseline, together with a description of the machine
+        and the corpus prescriptions the converter rejects. Cases already stored in the baseline and
+        not present in benchdf are kept
+    '''
+    document = {}
+    if os.path.exists(baseline):
+        with open(baseline, encoding='utf-8') as f:
+            document = json.load(f)
+        basedf = pd.DataFrame(document['results'])
+        benchdf = pd.concat([basedf[~basedf['Case'].isin(benchdf['Case'])], benchdf], ignore_index=True)
+    document = {**_machine(), 'results': benchdf.to_dict(orient='records'),
+                'conversionFailures': [list(failure) for failure in failures] if failures is not None
+                else document.get('conversionFailures', [])}
+    with open(baseline, 'w', encoding='utf-8') as f:
+        json.dump(document, f, indent=2, ensure_ascii=False)
+
+def loadBaseline(baseline=BASELINE):
+    '''
+    Function: Read a json baseline written by saveBaseline
+
+    Returns:
+    basedf: Pandas DataFrame
+        The stored benchmark results
+    '''
+    with open(baseline, encoding='utf-8') as f:
+        document = json.load(f)
+    basedf = pd.DataFrame(document['results'])
+    return basedf
+
+def compareFailures(failures, baseline=BASELINE):
+    '''
+    Function: Corpus prescriptions the converter rejects now but accepted when the baseline was stored
+
+    Returns:
+    newFailures: List
+        (file name, prescription index, error) of the new failures
+    '''
+    with open(baseline, encoding='utf-8') as f:
+        document = json.load(f)
+    known = {(name, index) for name, index, _ in document.get('conversionFailures', [])}
+    newFailures = [failure for failure in failures if tuple(failure[:2]) not in known]
+    return newFailures
+
+def compareBaseline(benchdf, basedf, threshold=0.2):
+    '''
+    Function: Compare benchmark results with a baseline
+
+    Arguments:
+    benchdf, basedf: Pandas DataFrame
+        Current and baseline results, as returned by runSuite
+    threshold: Float
+        Relative slowdown above which a case is flagged as a regression. Default 0.2 (20 %)
+
+    Returns:
+    comparisondf: Pandas DataFrame
+        One row per case with the current and baseline times (ms), their ratio, the peak memory ratio
+        and a boolean 'Regression' column. Cases without baseline have NaN ratios and are not flagged
+    '''
+    comparisondf = benchdf[['Case', 'Time_ms', 'PeakKB']].merge(
+        basedf[['Case', 'Time_ms', 'PeakKB']], on='Case', how='left', suffixes=('', '_baseline'))
+    comparisondf['Ratio'] = comparisondf['Time_ms'] / comparisondf['Time_ms_baseline']
+    comparisondf['PeakRatio'] = comparisondf['PeakKB'] / comparisondf['PeakKB_baseline']
+    comparisondf['Regression'] = comparisondf['Ratio'] > 1 + threshold
+    return comparisondf
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the aclinprot hot paths over the repository corpus')
+    parser.add_argument('patterns', nargs='*', help='run only the cases whose name contains any of these')
+    parser.add_argument('--baseline', default=BASELINE, help='json baseline file')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown flagged as regression')
+    parser.add_argument('--repeat', type=int, default=5, help='timeit repetitions')
+    parser.add_argument('--scale', type=int, default=0, help='add synthetic cases this many times the corpus size')
+    args = parser.parse_args()
+
+    failures = []
+    benchdf = runSuite(args.patterns, repeat=args.repeat, scale=args.scale, failures=failures)
+    print(benchdf.to_string(index=False, float_format='{:.3f}'.format))
+    for name, index, error in failures:
+        print(f'Conversion excluded from the benchmark: {name} [{index}] {error}', file=sys.stderr)
+    if args.save:
+        saveBaseline(benchdf, args.baseline, failures)
+        print('Baseline stored in ' + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baselineMachine = {key: value for key, value in json.load(f).items() if key in _machine()}
+        if any(_machine()[key] != value for key, value in baselineMachine.items()):
+            print(f'Warning: the baseline was stored on another machine {baselineMachine}', file=sys.stderr)
+        comparisondf = compareBaseline(benchdf, loadBaseline(args.baseline), args.threshold)
+        print()
+        print(comparisondf.to_string(index=False, float_format='{:.3f}'.format))
+        regressions = comparisondf.loc[comparisondf['Regression'], 'Case'].tolist()
+        newFailures = compareFailures(failures, args.baseline)
+        if regressions:
+            print('Regressions beyond {:.0%}: '.format(args.threshold) + ', '.join(regressions))
+        if newFailures:
+            print('Conversions failing since the baseline: ' +
+                  ', '.join(f'{name} [{index}]' for name, index, _ in newFailures))
+        if regressions or newFailures:
+            sys.exit(1)
@@ -0,0 +1,44 @@
+'''
+    Benchmark: header-only vs full read of RT Dicom structure sets
+
+    Usage (from the repository root):
+        python benchmarks/bench_read_contouring.py [RS files ...]
+'''
+import glob
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src/aclinprot')))
+import aclinprot as acp
+
+def benchReadContouring(rsdicoms, repeat=5, number=20):
+    '''
+    Function: Time readContouringStructureNames with and without headerOnly
+
+    Arguments:
+    rsdicoms: List
+        File paths of the RT Dicom structure sets
+    repeat, number: Integer
+        timeit repetitions. The best of repeat runs of number calls is reported
+
+    Returns:
+    benchdf: Pandas DataFrame
+        One row per file with the full and header-only times (ms per read) and the speedup
+    '''
+    rows = []
+    for rsdicom in rsdicoms:
+        full = min(timeit.repeat(lambda: acp.readContouringStructureNames(rsdicom, headerOnly=False),
+                                 repeat=repeat, number=number)) / number
+        header = min(timeit.repeat(lambda: acp.readContouringStructureNames(rsdicom, headerOnly=True),
+                                   repeat=repeat, number=number)) / number
+        rows.append({'File': os.path.basename(rsdicom), 'MB': os.path.getsize(rsdicom) / 2**20,
+                     'FullRead_ms': full * 1000, 'HeaderOnly_ms': header * 1000, 'Speedup': full / header})
+    benchdf = pd.DataFrame(rows)
+    return benchdf
+
+if __name__ == '__main__':
+    rsdicoms = sys.argv[1:] or glob.glob(os.path.join(os.path.dirname(__file__), '../DICOM/RS.*.dcm'))
+    print(benchReadContouring(rsdicoms).to_string(index=False))
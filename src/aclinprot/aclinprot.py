@@ -1,12 +1,85 @@
+import collections
+import concurrent.futures
+import copy
+import dataclasses
+import cProfile
 import datetime
+import functools
+import glob
+import hashlib
 import io
+import logging
 import os
+import pstats
+import random
 import re
+import sqlite3
+import threading
+import time
+import unicodedata
 import pandas as pd
 import xml.etree.ElementTree as ET
+import xml.sax.saxutils
 import pydicom as dcm
 from textdistance import ratcliff_obershelp
 from numpy import isnan
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+'''
+    Precompiled regular expressions
+'''
+_DOSE_RX = re.compile(r'(?P<Dose>(\d+)?\.?(\d+)?) Gy')
+
+_DOSIMPAR_RX_DICT = {
+    'Vxx%': re.compile(r'V(\s+)?(?P<Dose>\d+\.?(\d+)?)\s*?(Gy)?\$(?P<VolumeRelative>\d+\.?(\d+)?)(\s+)?(\%)?$'),
+    'VxxGy': re.compile(r'V(\s+)?(?P<Dose>\d+\.?(\d+)?)\s*?(Gy)?\$(?P<VolumeAbsolute>\d+\.?(\d+)?)(\s+)?cc$'),
+    'Dxxcc': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?)cc\$(?P<DoseRelative>\d+\.?(\d+)?)(\s+)?\%?'),
+    'Dxx%': re.compile(r'D(\s+)?(?P<VolumeRelative>\d+\.?(\d+)?)\%\$(?P<DoseRelative>\d+\.?(\d+)?)(\s+)?\%?'),
+    'Dxx_Gy': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?)\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
+    'Dxxcc_Gy': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?).*?cc\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
+    'Dxx%_Gy': re.compile(r'D(\s+)?(?P<VolumeRelative>\d+\.?(\d+)?)\%\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
+}
+
+# Doses in cGy, read by parseDosimPar only when the _DOSIMPAR_RX_DICT patterns recognize nothing
+_DOSIMPAR_CGY_RX = re.compile(r'(?P<Dose>\d+\.?\d*)\s*cGy')
+
+# ARIA prescription export fields: prescription volumes, coverage constraints and organs at risk
+_PV_RX_DICT = {
+    'Volume': re.compile(r'Volume (?P<Volume>.+)  \d+\.\d+ Gy '),
+    'Dose': re.compile(r'  (?P<Dose>\d+\.\d+) Gy'),
+    'FxDose' : re.compile(r'  (?P<FxDose>\d+\.\d+) Gy/Frac'),
+}
+_CC_RX_DICT = {
+    'Volume': re.compile(r'Volume / Structure :(?P<Volume>.*) Min Dose'),
+    'Min': re.compile(r'Min Dose:(?P<Min>.*) Gy Max'),
+    'Max': re.compile(r'Max Dose:(?P<Max>.*) Gy At'),
+    'AtLeast': re.compile(r'At Least (?P<AtLeast>.*) % of (?P<Volume>.*) at (?P<Percentage>.*) % (?P<Dose>.*) Gy No More Than'),
+    'NoMore': re.compile(r'No More Than (?P<NoMore>.*) % of (?P<Volume>.*) at (?P<Percentage>.*) % (?P<Dose>.*) Gy'),
+}
+_OAR_RX_DICT = {
+    'Organ': re.compile(r'Organ :(?P<Organ>.*) Mean'),
+    'Dmean': re.compile(r'Mean :(?P<Dmean>.*) Max Dose'),
+    'Dmax' : re.compile(r'Max Dose :(?P<Dmax>.*)$'),
+}
+# A line matching any of the _OAR_RX_DICT patterns starts a new organ at risk
+_OAR_HEADER_RX = re.compile(r'Organ :.* Mean|Mean :.* Max Dose|Max Dose :.*$')
+
+# Directorios de datos del repositorio, para que los valores por defecto no dependan del directorio de trabajo
+REPOSITORY_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+CLINICAL_PROTOCOLS_DIR = os.path.join(REPOSITORY_DIR, 'protocolos', 'clinicos')
+CONTOURING_TEMPLATES_DIR = os.path.join(REPOSITORY_DIR, 'protocolos', 'contorneo')
+DICTIONARY_FILE = os.path.join(REPOSITORY_DIR, 'tools', 'Diccionario.csv')
+DICOM_DIR = os.path.join(REPOSITORY_DIR, 'DICOM')
+
+# RT Structure Set tags needed to describe the ROIs, i.e. everything but the ROIContourSequence
+_RS_HEADER_TAGS = ['SOPInstanceUID', 'StructureSetROISequence', 'RTROIObservationsSequence']
+
+DOSIMPAR_KINDS = ['Vxx%', 'VxxGy', 'Dxxcc', 'Dxx%', 'Dxx_Gy', 'Dxxcc_Gy', 'Dxx%_Gy']
+# Dose and volume units of each kind
+_DOSIMPAR_UNITS = {None: (None, None), 'Vxx%': ('Gy', '%'), 'VxxGy': ('Gy', 'cc'), 'Dxxcc': ('%', 'cc'),
+                   'Dxx%': ('%', '%'), 'Dxx_Gy': ('Gy', 'cc'), 'Dxxcc_Gy': ('Gy', 'cc'), 'Dxx%_Gy': ('Gy', '%')}
 
 def parseDose(strDose):
     '''
@@ -21,12 +94,7 @@ def parseDose(strDose):
         Dose: Float
             The dose numerical value
     '''
-    dose_rx_dict = {
-        'Dose' : re.compile(r'(?P<Dose>(\d+)?\.?(\d+)?) Gy')
-    }
-
-    for key, rx in dose_rx_dict.items():
-        match = rx.search(strDose)
+    match = _DOSE_RX.search(strDose)
 
     Dose = float(match.group('Dose'))
     return Dose
@@ -35,6 +103,7 @@ def parseDosimPar(strDosimPar):
     '''
     Function: parseDosimPar
         Parse the string specifying a a dosimetric parameter 
+        Doses in cGy (e.g. 'V2780cGy$11.46 %') are read in Gy when no pattern recognizes the string as it is
 
     Arguments:
         srtDosimPar: String
@@ -42,18 +111,11 @@ def parseDosimPar(strDosimPar):
 
     Returns:
     '''
-    dosimPar_rx_dict = {
-        'Vxx%': re.compile(r'V(\s+)?(?P<Dose>\d+\.?(\d+)?)\s*?(Gy)?\$(?P<VolumeRelative>\d+\.?(\d+)?)(\s+)?(\%)?$'),
-        'VxxGy': re.compile(r'V(\s+)?(?P<Dose>\d+\.?(\d+)?)\s*?(Gy)?\$(?P<VolumeAbsolute>\d+\.?(\d+)?)(\s+)?cc$'),
-        'Dxxcc': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?)cc\$(?P<DoseRelative>\d+\.?(\d+)?)(\s+)?\%?'),
-        'Dxx%': re.compile(r'D(\s+)?(?P<VolumeRelative>\d+\.?(\d+)?)\%\$(?P<DoseRelative>\d+\.?(\d+)?)(\s+)?\%?'),
-        'Dxx_Gy': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?)\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
-        'Dxxcc_Gy': re.compile(r'D(\s+)?(?P<Volume>\d+\.?(\d+)?).*?cc\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
-        'Dxx%_Gy': re.compile(r'D(\s+)?(?P<VolumeRelative>\d+\.?(\d+)?)\%\$(?P<DoseGy>\d+\.?(\d+)?)(\s+)?(Gy)?'),
-    }
-
     matches = {}
-    for key, rx in dosimPar_rx_dict.items():
+    for key, rx in _DOSIMPAR_RX_DICT.items():
+        # Cada patrón empieza por la letra de su clase (V o D): sin ella no puede coincidir
+        if key[0] not in strDosimPar:
+            continue
         match = rx.search(strDosimPar)
         if match:
             if key == 'Vxx%':
@@ -84,9 +146,57 @@ def parseDosimPar(strDosimPar):
                 Volume = float(match.group('VolumeRelative'))
                 Dose = float(match.group('DoseGy'))
                 matches[key] = {'VolumeRelative': Volume, 'DoseGy': Dose}
-        
-    return matches        
+    if not matches and 'cGy' in strDosimPar:
+        # Solo si ningún patrón lo reconoce: los parámetros ya reconocidos no cambian
+        strDosimParGy = _DOSIMPAR_CGY_RX.sub(lambda match: f"{float(match.group('Dose')) / 100!r} Gy", strDosimPar)
+        if strDosimParGy != strDosimPar:
+            matches = parseDosimPar(strDosimParGy)
+    return matches
 
+def parseDosimPars(dosimPars):
+    '''
+    Function: parseDosimPars
+        Parse a whole column of dosimetric parameters into a table. Each distinct parameter is parsed once
+        with parseDosimPar, the only classifier. Building the table costs about 1 ms, so for a few hundred
+        parameters a parseDosimPar loop is faster; the table pays off when the parameters repeat
+
+    Arguments:
+        dosimPars: Pandas Series or list of Strings
+            The strings specifying the dosimetric parameters
+
+    Returns:
+        dosimpardf: Pandas DataFrame
+            DataFrame with the same index as dosimPars and columns
+            ['DosimPar', 'Kind', 'Dose', 'DoseUnits', 'Volume', 'VolumeUnits', 'Recognized'].
+            Kind is the last of the parseDosimPar kinds matched, the one the clinical protocol conversion uses
+            (e.g. 'D2cc$70' matches 'Dxxcc' and 'Dxxcc_Gy' and is 'Dxxcc_Gy'). Dose is given in Gy or in %
+            of the prescription, Volume in % or cc. Unrecognized parameters have Kind NaN and Recognized False
+    '''
+    if isinstance(dosimPars, pd.Series):
+        index, dosimPars = dosimPars.index, dosimPars.tolist()
+    else:
+        index, dosimPars = None, list(dosimPars)
+    # Las exportaciones repiten mucho los parámetros: cada parámetro distinto se clasifica una sola vez
+    classified = {}
+    kinds, doses, volumes = [], [], []
+    for dosimPar in dosimPars:
+        strDosimPar = _dosimParString(dosimPar)
+        classification = classified.get(strDosimPar)
+        if classification is None:
+            classification = classified[strDosimPar] = _classifyDosimPar(strDosimPar)
+        kinds.append(classification[0])
+        doses.append(classification[1])
+        volumes.append(classification[2])
+    dosimpardf = pd.DataFrame({
+        'DosimPar': np.array(dosimPars, dtype=object),
+        'Kind': pd.Categorical(kinds, categories=DOSIMPAR_KINDS),
+        'Dose': np.array(doses, dtype=float),
+        'DoseUnits': [_DOSIMPAR_UNITS[Kind][0] for Kind in kinds],
+        'Volume': np.array(volumes, dtype=float),
+        'VolumeUnits': [_DOSIMPAR_UNITS[Kind][1] for Kind in kinds],
+        'Recognized': np.array([Kind is not None for Kind in kinds], dtype=bool),
+    }, index=index)
+    return dosimpardf
 
 '''
     Prescriptions
@@ -105,6 +215,96 @@ def read_prescription(file):
     prdf = pd.read_csv(file)
     return prdf
 
+def _parse_prescription_volume(line):
+    matches = {}
+    for key, rx in _PV_RX_DICT.items():
+        match = rx.search(line)
+        if match:
+            matches[key] = match.group(key)
+    return matches
+
+def _parse_volume(line):
+    matches = {}
+    for key, rx in _CC_RX_DICT.items():
+        match = rx.search(line)
+        if match:
+            if key == 'Volume':
+                volume = match.group(key)
+                matches[key] = match.group(key)
+            elif key == 'AtLeast' and match.group('Volume') == volume:
+                constraint = [match.group('AtLeast'), match.group('Percentage'), match.group('Dose')]
+                matches[key] = constraint
+            elif key == 'NoMore' and match.group('Volume') == volume:
+                constraint = [match.group('NoMore'), match.group('Percentage'), match.group('Dose')]
+                matches[key] = constraint
+            else:
+                matches[key] = match.group(key)
+    return matches
+
+def _parse_line(line):
+    for key, rx in _OAR_RX_DICT.items():
+        match = rx.search(line)
+        if match:
+            return key, match
+    return None, None
+
+def _parse_organ(line):
+    matches = {}
+    for key, rx in _OAR_RX_DICT.items():
+        match = rx.search(line)
+        if match:
+            matches[key] = match.group(key).strip()
+    return matches
+
+def _prescription_records(row):
+    '''
+    Function: Split one prescription (a row of the export) into its prescription volume, coverage constraint
+        and OAR records (lists of dicts of strings)
+    '''
+    # Split the fields for this prescription
+    pv_lines = row.PrescribedTo.split('|')
+    cc_lines = row.CoverageConstraints.split('|')
+    if isinstance(row.OrgansAtRisk, str):
+        oar_lines = row.OrgansAtRisk.split('\n')
+    else:
+        oar_lines = []
+
+    # Prescription volumes
+    pv_list = [_parse_prescription_volume(pv_line) for pv_line in pv_lines]
+    # Coverage constraints
+    cc_list = [_parse_volume(cc_line) for cc_line in cc_lines]
+
+    # OARs
+    oars, oar = [], None
+    for oar_line in oar_lines:
+        oar_key, oar_name = _parse_line(oar_line)
+        if oar_key:
+            oars.append(oar)
+            oar = [oar_line]
+        else:
+            if oar is not None:
+                oar.append(oar_line.strip())
+    oars.append(oar)
+    oars = [x for x in oars if x is not None]  # Elimina posibles None iniciales
+
+    oars_list = []
+    for oar in oars:
+        if oar is not None:
+            oar_dict = _parse_organ(oar[0])
+            oar_dict['DosimPars'] = oar[2:]
+            oars_list.append(oar_dict)
+    return pv_list, cc_list, oars_list
+
+def _parse_prescription_row(row):
+    '''
+    Function: Parse one prescription (a row of the export) into its pvdf, ccdf and oardf DataFrames
+    '''
+    pv_list, cc_list, oars_list = _prescription_records(row)
+    pvdf = pd.DataFrame(pv_list)
+    ccdf = pd.DataFrame(cc_list)
+    oardf = pd.DataFrame(oars_list)
+    return pvdf, ccdf, oardf
+
 def parse_prescription(file):
     '''
     Function: parse_prescription
@@ -121,112 +321,298 @@ def parse_prescription(file):
             List of dataframes with OAR restrictions
             
     '''
-    # Regular expression dictionaries (igual que antes)
-    pv_rx_dict = {
-        'Volume': re.compile(r'Volume (?P<Volume>.+)  \d+\.\d+ Gy '),
-        'Dose': re.compile(r'  (?P<Dose>\d+\.\d+) Gy'),
-        'FxDose' : re.compile(r'  (?P<FxDose>\d+\.\d+) Gy/Frac'),
-    }
-    cc_rx_dict = {
-        'Volume': re.compile(r'Volume / Structure :(?P<Volume>.*) Min Dose'),
-        'Min': re.compile(r'Min Dose:(?P<Min>.*) Gy Max'),
-        'Max': re.compile(r'Max Dose:(?P<Max>.*) Gy At'),
-        'AtLeast': re.compile(r'At Least (?P<AtLeast>.*) % of (?P<Volume>.*) at (?P<Percentage>.*) % (?P<Dose>.*) Gy No More Than'),
-        'NoMore': re.compile(r'No More Than (?P<NoMore>.*) % of (?P<Volume>.*) at (?P<Percentage>.*) % (?P<Dose>.*) Gy'),
-    }
-    oar_rx_dict = {
-        'Organ': re.compile(r'Organ :(?P<Organ>.*) Mean'),
-        'Dmean': re.compile(r'Mean :(?P<Dmean>.*) Max Dose'),
-        'Dmax' : re.compile(r'Max Dose :(?P<Dmax>.*)$'),
-    }
-
-    def _parse_prescription_volume(line):
-        matches = {}
-        for key, rx in pv_rx_dict.items():
-            match = rx.search(line)
-            if match:
-                matches[key] = match.group(key)
-        return matches
-
-    def _parse_volume(line):
-        matches = {}
-        for key, rx in cc_rx_dict.items():
-            match = rx.search(line)
-            if match:
-                if key == 'Volume':
-                    volume = match.group(key)
-                    matches[key] = match.group(key)
-                elif key == 'AtLeast' and match.group('Volume') == volume:
-                    constraint = [match.group('AtLeast'), match.group('Percentage'), match.group('Dose')]
-                    matches[key] = constraint
-                elif key == 'NoMore' and match.group('Volume') == volume:
-                    constraint = [match.group('NoMore'), match.group('Percentage'), match.group('Dose')]
-                    matches[key] = constraint
-                else:
-                    matches[key] = match.group(key)
-        return matches
-
-    def _parse_line(line):
-        for key, rx in oar_rx_dict.items():
-            match = rx.search(line)
-            if match:
-                return key, match
-        return None, None
-
-    def _parse_organ(line):
-        matches = {}
-        for key, rx in oar_rx_dict.items():
-            match = rx.search(line)
-            if match:
-                matches[key] = match.group(key).strip()
-        return matches
-
     # Read the prescription file
     prdf = read_prescription(file)
 
     pvdfs, ccds, oardfs = [], [], []
 
-    for idx, row in prdf.iterrows():
-        # Split the fields for this prescription
-        pv_lines = row.PrescribedTo.split('|')
-        cc_lines = row.CoverageConstraints.split('|')
-        if isinstance(row.OrgansAtRisk, str):
-            oar_lines = row.OrgansAtRisk.split('\n')
-        else:
-            oar_lines = []
-
-        # Prescription volumes
-        pvdf = pd.DataFrame([_parse_prescription_volume(pv_line) for pv_line in pv_lines])
-        # Coverage constraints
-        ccdf = pd.DataFrame([_parse_volume(cc_line) for cc_line in cc_lines])
-
-        # OARs
-        oars, oar = [], None
-        for oar_line in oar_lines:
-            oar_key, oar_name = _parse_line(oar_line)
-            if oar_key:
-                oars.append(oar)
-                oar = [oar_line]
-            else:
-                if oar is not None:
-                    oar.append(oar_line.strip())
-        oars.append(oar)
-        oars = [x for x in oars if x is not None]  # Elimina posibles None iniciales
-
-        oars_list = []
-        for oar in oars:
-            if oar is not None:
-                oar_dict = _parse_organ(oar[0])
-                oar_dict['DosimPars'] = oar[2:]
-                oars_list.append(oar_dict)
-        oardf = pd.DataFrame(oars_list)
-
+    for row in prdf.itertuples():
+        pvdf, ccdf, oardf = _parse_prescription_row(row)
         pvdfs.append(pvdf)
         ccds.append(ccdf)
         oardfs.append(oardf)
 
     return pvdfs, ccds, oardfs
 
+def iter_prescriptions(file, chunksize=64, dtype=str, engine=None, blocksize=2**20):
+    '''
+    Function: iter_prescriptions
+        Stream the prescriptions of an export. The csv file is read in chunks and each prescription is
+        parsed and yielded as soon as its chunk has been read, so memory stays bounded by the chunk size
+        and the first prescription is available without reading the whole file
+
+    Arguments:
+    file: Path file or buffer
+        File containing the prescription(s). Exported from ARIA in csv format
+    chunksize: Integer
+        Number of prescriptions read at a time by the pandas engines. Default 64
+    dtype: Type or dict
+        Column dtypes passed to pd.read_csv. Default str, which skips type inference.
+        The pyarrow engine always reads the columns as strings
+    engine: String (None [Default], 'c', 'python', 'pyarrow')
+        CSV parser. 'pyarrow' streams blocks of blocksize bytes through pyarrow.csv, which must be installed
+    blocksize: Integer
+        Bytes read at a time by the pyarrow engine. Default 1 MB
+
+    Yields:
+        pvdf, ccdf, oardf: Pandas DataFrame
+            The prescription volumes, coverage constraints and OAR restrictions of each prescription,
+            in file order. They are the elements of the parse_prescription lists
+    '''
+    if engine == 'pyarrow':
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        columns = ['PrescriptionName', 'CoverageConstraints', 'OrgansAtRisk', 'PrescribedTo']
+        reader = pacsv.open_csv(file, read_options=pacsv.ReadOptions(block_size=blocksize),
+                                parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                                convert_options=pacsv.ConvertOptions(
+                                    column_types={column: pa.string() for column in columns},
+                                    strings_can_be_null=True))
+        for batch in reader:
+            for row in batch.to_pandas().itertuples():
+                yield _parse_prescription_row(row)
+    else:
+        with pd.read_csv(file, chunksize=chunksize, dtype=dtype, engine=engine) as reader:
+            for chunk in reader:
+                for row in chunk.itertuples():
+                    yield _parse_prescription_row(row)
+
+def _explodeField(field, sep):
+    '''
+    Function: One row per line of a multi-line export field, indexed by the prescription index
+    '''
+    lines = field.dropna().astype(object).str.split(sep).explode()
+    lines.index.name = 'PrescriptionIndex'
+    return lines
+
+def _floatColumn(values):
+    '''
+    Function: Cast stripped strings to float, blank or missing values are NaN
+    '''
+    return pd.to_numeric(values.str.strip(), errors='coerce').astype(float)
+
+def _doseColumn(values):
+    '''
+    Function: Dose in Gy of strings like '45 Gy' or '4500 cGy', NaN if blank or missing
+    '''
+    parts = values.str.extract(r'(?P<Dose>\d+\.?\d*)\s*(?P<Units>c?Gy)')
+    dose = parts.Dose.astype(float)
+    return dose.where(parts.Units != 'cGy', dose / 100)
+
+def parse_prescription_tables(file):
+    '''
+    Function: parse_prescription_tables
+        Columnar alternative to parse_prescription. The '|' and newline separated fields of every
+        prescription in the export are exploded and parsed at once with vectorized string operations,
+        returning three long-form tables instead of one small DataFrame per prescription and field.
+        Its cost is almost constant up to a few dozen prescriptions, so it pays off with large
+        multi-prescription exports; parse_prescription is cheaper for a single prescription
+
+    Arguments:
+    file: Path file, buffer or Pandas DataFrame
+        File containing the prescription(s), exported from ARIA in csv format, or the DataFrame
+        read_prescription returns for it
+
+    Returns:
+        pvtable: Pandas DataFrame
+            Prescription volumes, columns ['PrescriptionIndex', 'Volume', 'Dose', 'FxDose']
+        cctable: Pandas DataFrame
+            Coverage constraints, columns ['PrescriptionIndex', 'Volume', 'Min', 'Max', 'AtLeast',
+            'AtLeastPercentage', 'AtLeastDose', 'NoMore', 'NoMorePercentage', 'NoMoreDose']
+        oartable: Pandas DataFrame
+            OAR constraints, one row per DosimPar, columns ['PrescriptionIndex', 'OARIndex', 'Organ', 'Dmean',
+            'Dmax', 'DosimPar'] plus the parsed DosimPar columns of parseDosimPars. OARs without DosimPars
+            have a single row with DosimPar NaN
+
+        PrescriptionIndex is the row of the prescription in the export, as used by the parse_prescription lists,
+        and OARIndex the position of the OAR in the prescription. Doses are floats in Gy, blanks are NaN
+    '''
+    prdf = file if isinstance(file, pd.DataFrame) else read_prescription(file)
+
+    # Prescription volumes
+    lines = _explodeField(prdf['PrescribedTo'], '|')
+    pvtable = pd.DataFrame({
+        'Volume': lines.str.extract(_PV_RX_DICT['Volume'], expand=False),
+        'Dose': lines.str.extract(_PV_RX_DICT['Dose'], expand=False).astype(float),
+        'FxDose': lines.str.extract(_PV_RX_DICT['FxDose'], expand=False).astype(float),
+    }).reset_index()
+
+    # Coverage constraints. At Least and No More Than only count when they refer to the same volume
+    lines = _explodeField(prdf['CoverageConstraints'], '|')
+    volume = lines.str.extract(_CC_RX_DICT['Volume'], expand=False)
+    cctable = pd.DataFrame({
+        'Volume': volume,
+        'Min': _floatColumn(lines.str.extract(_CC_RX_DICT['Min'], expand=False)),
+        'Max': _floatColumn(lines.str.extract(_CC_RX_DICT['Max'], expand=False)),
+    })
+    for key in ['AtLeast', 'NoMore']:
+        constraint = lines.str.extract(_CC_RX_DICT[key])
+        constraint = constraint[constraint.Volume.eq(volume).fillna(False).astype(bool)]
+        cctable[key] = _floatColumn(constraint[key])
+        cctable[key + 'Percentage'] = _floatColumn(constraint['Percentage'])
+        cctable[key + 'Dose'] = _floatColumn(constraint['Dose'])
+    cctable = cctable.reset_index()
+
+    # Organs at risk: a header line starts an OAR, the next line ('Constraints :') is skipped
+    # and the remaining lines up to the next header are its DosimPars
+    lines = _explodeField(prdf['OrgansAtRisk'], '\n')
+    header = lines.str.contains(_OAR_HEADER_RX).fillna(False).astype(bool)
+    oarNumber = header.astype(int).groupby(level=0).cumsum()
+    position = lines.groupby([lines.index, oarNumber.to_numpy()]).cumcount()
+    inOAR = (oarNumber > 0).to_numpy()
+
+    headers = lines[header.to_numpy() & inOAR]
+    organs = pd.DataFrame({
+        'OARIndex': oarNumber[header.to_numpy() & inOAR].to_numpy() - 1,
+        'Organ': headers.str.extract(_OAR_RX_DICT['Organ'], expand=False).str.strip(),
+        'Dmean': _doseColumn(headers.str.extract(_OAR_RX_DICT['Dmean'], expand=False)),
+        'Dmax': _doseColumn(headers.str.extract(_OAR_RX_DICT['Dmax'], expand=False)),
+    }).reset_index()
+    isDosimPar = inOAR & (position >= 2).to_numpy()
+    dosimPars = pd.DataFrame({
+        'OARIndex': oarNumber[isDosimPar].to_numpy() - 1,
+        'DosimPar': lines[isDosimPar].str.strip(),
+    }).reset_index()
+    oartable = organs.merge(dosimPars, on=['PrescriptionIndex', 'OARIndex'], how='left', sort=False)
+    parsed = parseDosimPars(oartable['DosimPar'])
+    oartable = pd.concat([oartable, parsed.drop(columns='DosimPar')], axis=1)
+    return pvtable, cctable, oartable
+
+def _readContent(file):
+    '''
+    Function: Read the raw bytes of a path file or buffer. Buffers are rewound so they can be read again
+    '''
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if hasattr(file, 'getvalue'):
+        content = file.getvalue()
+    elif hasattr(file, 'read'):
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        content = file.read()
+        if hasattr(file, 'seek'):
+            file.seek(0)
+    else:
+        with open(file, 'rb') as f:
+            content = f.read()
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return content
+
+def _copyDataFrame(df):
+    '''
+    Function: Deep copy a DataFrame including the lists held in its cells (DosimPars, AtLeast, NoMore)
+    '''
+    dfcopy = df.copy(deep=True)
+    for column in dfcopy.columns[dfcopy.dtypes == object]:
+        values = dfcopy[column].tolist()
+        if any(isinstance(value, list) for value in values):
+            values = [list(value) if isinstance(value, list) else value for value in values]
+            dfcopy[column] = pd.Series(values, index=dfcopy.index, dtype=object)
+    return dfcopy
+
+class PrescriptionCache:
+    '''
+    Class: PrescriptionCache
+        LRU cache of parse_prescription results keyed by a digest of the file content.
+        Callers always receive copies, so mutating the returned DataFrames (or the lists they hold)
+        does not corrupt the cache
+
+    Arguments:
+    maxsize: Integer
+        Maximum number of parsed files kept. Default 32
+    maxbytes: Integer
+        Maximum memory, in bytes, of the cached DataFrames. Default 64 MB
+    '''
+    def __init__(self, maxsize=32, maxbytes=64 * 2**20):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(file):
+        '''
+        Method: Digest of the content of a path file, buffer or bytes
+        '''
+        return hashlib.blake2b(_readContent(file), digest_size=16).hexdigest()
+
+    def parse(self, file):
+        '''
+        Method: parse_prescription through the cache. See parse_prescription
+        '''
+        content = _readContent(file)
+        key = hashlib.blake2b(content, digest_size=16).hexdigest()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            pvdfs, ccds, oardfs = parse_prescription(io.BytesIO(content))
+            nbytes = sum(int(df.memory_usage(deep=True).sum()) for df in pvdfs + ccds + oardfs)
+            entry = (pvdfs, ccds, oardfs, nbytes)
+            with self._lock:
+                self.misses += 1
+                if key not in self._entries and nbytes <= self.maxbytes:
+                    self._entries[key] = entry
+                    self._nbytes += nbytes
+                    self._evict()
+        pvdfs, ccds, oardfs, _ = entry
+        return ([_copyDataFrame(df) for df in pvdfs],
+                [_copyDataFrame(df) for df in ccds],
+                [_copyDataFrame(df) for df in oardfs])
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.maxsize or self._nbytes > self.maxbytes):
+            _, (_, _, _, nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+
+    def clear(self):
+        '''
+        Method: Empty the cache
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self.hits = self.misses = 0
+
+    def info(self):
+        '''
+        Method: Cache statistics
+
+        Returns:
+        info: dict
+            Keys 'hits', 'misses', 'entries', 'nbytes', 'maxsize' and 'maxbytes'
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'nbytes': self._nbytes, 'maxsize': self.maxsize, 'maxbytes': self.maxbytes}
+
+prescriptionCache = PrescriptionCache()
+
+def parse_prescription_cached(file, cache=None):
+    '''
+    Function: parse_prescription_cached
+        Memoized parse_prescription. Files with the same content are parsed only once
+
+    Arguments:
+    file: Path file, buffer or bytes
+        File containing the prescription(s). Exported from ARIA in csv format
+    cache: PrescriptionCache
+        Cache to be used. Defaults to the module cache prescriptionCache
+
+    Returns:
+        pvdfs, ccds, oardfs: lists of Pandas DataFrame
+            Copies of the parse_prescription result
+    '''
+    if cache is None:
+        cache = prescriptionCache
+    return cache.parse(file)
+
 def getTreatmentDosePrescription(pvdf):
     '''
     Function: Retrieve the treatment dose prescription. 
@@ -242,6 +628,43 @@ def getTreatmentDosePrescription(pvdf):
     TreatmentDosePrescription = pvdf.Dose.astype('float').max()
     return TreatmentDosePrescription
     
+def _dosimParString(dosimPar):
+    '''
+    Function: String of a dosimetric parameter, '' if missing
+    '''
+    if isinstance(dosimPar, str):
+        return dosimPar
+    return '' if dosimPar is None or dosimPar != dosimPar else str(dosimPar)
+
+def oarDosimPars(oardf):
+    '''
+    Function: Parse every DosimPar of every OAR in oardf (see parseDosimPars)
+
+    Arguments:
+    oardf: DataFrame
+        DataFrame with OARs, must have columns 'Organ' and 'DosimPars'
+
+    Returns:
+    dosimpardf: DataFrame
+        Long-form DataFrame, one row per DosimPar, indexed by the oardf index and with
+        column 'Organ' plus the columns returned by parseDosimPars
+    '''
+    if 'DosimPars' not in oardf:
+        return parseDosimPars([]).assign(Organ=pd.Series(dtype=object))
+    # Una fila por DosimPar; los órganos sin lista de DosimPars se descartan
+    index, organs, dosimPars = [], [], []
+    for oarIndex, Organ, oarDosimParList in zip(oardf.index, oardf['Organ'], oardf['DosimPars']):
+        if not isinstance(oarDosimParList, list):
+            continue
+        for dosimPar in oarDosimParList:
+            if _dosimParString(dosimPar):
+                index.append(oarIndex)
+                organs.append(Organ)
+                dosimPars.append(dosimPar)
+    dosimpardf = parseDosimPars(pd.Series(dosimPars, index=pd.Index(index, dtype=oardf.index.dtype), dtype=object))
+    dosimpardf.insert(0, 'Organ', pd.Series(organs, index=dosimpardf.index, dtype=object))
+    return dosimpardf
+
 def checkDosimPars(oardf):
     '''
     Function: Check which DosimPars in oardf are recognized by parseDosimPar
@@ -255,19 +678,13 @@ def checkDosimPars(oardf):
         DataFrame with columns ['Organ', 'DosimPar', 'Recognized']
     '''
     rows = []
-    for _, oar in oardf.iterrows():
-        organ = oar['Organ']
-        dosimpars = oar['DosimPars']
-        if not isinstance(dosimpars, list):
+    for Organ, dosimPars in zip(oardf['Organ'], oardf['DosimPars']) if 'DosimPars' in oardf else []:
+        if not isinstance(dosimPars, list):
             continue
-        for dosimpar in dosimpars:
-            try:
-                parsed = parseDosimPar(dosimpar)
-                recognized = bool(parsed)  # True si hay algún resultado
-            except Exception:
-                recognized = False
-            rows.append({'Organ': organ, 'DosimPar': dosimpar, 'Recognized': recognized})
-    result_df = pd.DataFrame(rows)
+        for dosimPar in dosimPars:
+            # Los parámetros vacíos o que no son texto se listan como no reconocidos
+            rows.append((Organ, dosimPar, bool(parseDosimPar(dosimPar)) if isinstance(dosimPar, str) else False))
+    result_df = pd.DataFrame(rows, columns=['Organ', 'DosimPar', 'Recognized'])
     return result_df
 
 def addDosimPar(oardf, Organ, DosimPar):
@@ -299,24 +716,820 @@ def addDosimPar(oardf, Organ, DosimPar):
         oardf = pd.concat([oardf, pd.DataFrame([new_row])], ignore_index=True)
     return oardf
 
+'''
+    Prescription intermediate representation
+'''
+@dataclasses.dataclass(slots=True)
+class CoverageConstraint:
+    '''
+    Class: CoverageConstraint
+        At Least / No More Than coverage constraint of a target volume:
+        VolumePercentage % of the volume at DosePercentage % of the prescribed dose, Dose Gy
+    '''
+    VolumePercentage: float
+    DosePercentage: float
+    Dose: float = float('nan')
+
+@dataclasses.dataclass(slots=True)
+class TargetVolume:
+    '''
+    Class: TargetVolume
+        Prescription volume with its total and fraction doses in Gy and its coverage constraints
+    '''
+    Volume: str
+    Dose: float
+    FxDose: float
+    MinDose: float = float('nan')
+    MaxDose: float = float('nan')
+    AtLeast: CoverageConstraint | None = None
+    NoMore: CoverageConstraint | None = None
+
+@dataclasses.dataclass(slots=True)
+class OARConstraint:
+    '''
+    Class: OARConstraint
+        Dose constraint of an organ at risk. Kind is 'Dmean', 'Dmax', one of DOSIMPAR_KINDS or None
+        for unrecognized dosimetric parameters. Dose and Volume as in parseDosimPars
+    '''
+    Organ: str
+    Kind: str | None
+    Dose: float
+    Volume: float = float('nan')
+    DosimPar: str = ''
+
+@dataclasses.dataclass(slots=True)
+class Prescription:
+    '''
+    Class: Prescription
+        Parsed prescription with typed values, the compact alternative to the (pvdf, ccdf, oardf) DataFrames.
+        The number of fractions and the treatment dose prescription are computed once
+
+    Arguments:
+    TargetVolumes: list of TargetVolume
+        Prescription volumes, the first one sets the fractionation
+    OrgansAtRisk: list of String
+        Organs at risk, in export order
+    OARConstraints: list of OARConstraint
+        Constraints of the organs at risk: Dmean, Dmax and the dosimetric parameters of each organ in turn
+    Index: Integer
+        Row of the prescription in the export
+    '''
+    TargetVolumes: list
+    OrgansAtRisk: list
+    OARConstraints: list
+    Index: int = 0
+    Fractions: float = dataclasses.field(init=False)
+    FractionCount: int = dataclasses.field(init=False)
+    TreatmentDose: float = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        if not self.TargetVolumes:
+            raise ValueError('La prescripción no tiene volúmenes de tratamiento')
+        self.Fractions = self.TargetVolumes[0].Dose / self.TargetVolumes[0].FxDose
+        self.FractionCount = int(self.Fractions)
+        self.TreatmentDose = max(targetVolume.Dose for targetVolume in self.TargetVolumes)
+
+    def dataframes(self):
+        '''
+        Method: DataFrame view of the prescription
+
+        Returns:
+        pvdf: Pandas DataFrame
+            Columns ['Volume', 'Dose', 'FxDose', 'MinDose', 'MaxDose']
+        ccdf: Pandas DataFrame
+            One row per coverage constraint with columns
+            ['Volume', 'Constraint', 'VolumePercentage', 'DosePercentage', 'Dose']
+        oardf: Pandas DataFrame
+            One row per OAR constraint with columns ['Organ', 'Kind', 'Dose', 'Volume', 'DosimPar']
+        '''
+        pvdf = pd.DataFrame([(tv.Volume, tv.Dose, tv.FxDose, tv.MinDose, tv.MaxDose) for tv in self.TargetVolumes],
+                            columns=['Volume', 'Dose', 'FxDose', 'MinDose', 'MaxDose'])
+        ccdf = pd.DataFrame([(tv.Volume, name, cc.VolumePercentage, cc.DosePercentage, cc.Dose)
+                             for tv in self.TargetVolumes
+                             for name, cc in (('AtLeast', tv.AtLeast), ('NoMore', tv.NoMore)) if cc is not None],
+                            columns=['Volume', 'Constraint', 'VolumePercentage', 'DosePercentage', 'Dose'])
+        oardf = pd.DataFrame([(c.Organ, c.Kind, c.Dose, c.Volume, c.DosimPar) for c in self.OARConstraints],
+                             columns=['Organ', 'Kind', 'Dose', 'Volume', 'DosimPar'])
+        return pvdf, ccdf, oardf
+
+def _number(value):
+    '''
+    Function: Float value of a parsed field, NaN if missing or not numeric
+    '''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def _classifyDosimPar(strDosimPar):
+    '''
+    Function: Kind, dose and volume of a single dosimetric parameter, see parseDosimPars
+
+    Returns:
+    Kind, Dose, Volume: String or None, Float, Float
+    '''
+    matches = parseDosimPar(strDosimPar)
+    if not matches:
+        return None, float('nan'), float('nan')
+    # La última clase reconocida es la que usa la conversión (Dxxcc_Gy antes que Dxxcc...)
+    Kind, values = list(matches.items())[-1]
+    Dose = values.get('DoseGy', values.get('DoseRelative'))
+    Volume = values.get('VolumeRelative', values.get('VolumeAbsolute'))
+    return Kind, Dose, Volume
+
+def _coverageConstraint(constraint):
+    '''
+    Function: CoverageConstraint of a parsed [VolumePercentage, DosePercentage, Dose] list, None if absent
+    '''
+    if not isinstance(constraint, list) or not constraint:
+        return None
+    return CoverageConstraint(float(constraint[0]), float(constraint[1]), _number(constraint[2]))
+
+def _prescriptionFromRecords(pv_list, cc_list, oars_list, Index=0):
+    '''
+    Function: Build a Prescription from the prescription volume, coverage constraint and OAR records
+    '''
+    # Como en la conversión, cada volumen toma la primera restricción de cobertura con su nombre
+    coverage = {}
+    for cc in cc_list:
+        coverage.setdefault(cc.get('Volume'), cc)
+    TargetVolumes = []
+    for pv in pv_list:
+        cc = coverage.get(pv.get('Volume'), {})
+        TargetVolumes.append(TargetVolume(pv['Volume'], float(pv['Dose']), float(pv['FxDose']),
+                                          _number(cc.get('Min')), _number(cc.get('Max')),
+                                          _coverageConstraint(cc.get('AtLeast')),
+                                          _coverageConstraint(cc.get('NoMore'))))
+    OrgansAtRisk, OARConstraints = [], []
+    for oar in oars_list:
+        Organ = oar.get('Organ')
+        OrgansAtRisk.append(Organ)
+        for Kind in ('Dmean', 'Dmax'):
+            if isinstance(oar.get(Kind), str) and oar[Kind]:
+                OARConstraints.append(OARConstraint(Organ, Kind, parseDose(oar[Kind])))
+        dosimPars = oar.get('DosimPars')
+        if isinstance(dosimPars, list):
+            for dosimPar in dosimPars:
+                if isinstance(dosimPar, str):
+                    Kind, Dose, Volume = _classifyDosimPar(dosimPar)
+                    OARConstraints.append(OARConstraint(Organ, Kind, Dose, Volume, dosimPar))
+    return Prescription(TargetVolumes, OrgansAtRisk, OARConstraints, Index)
+
+def prescriptionFromDataFrames(pvdf, ccdf, oardf, Index=0):
+    '''
+    Function: Build the Prescription of the DataFrames returned by parse_prescription, e.g. after editing them
+
+    Arguments:
+    pvdf, ccdf, oardf: Pandas DataFrame
+        Prescription volumes, coverage constraints and OARs of one prescription
+    Index: Integer
+        Row of the prescription in the export
+
+    Returns:
+    prescription: Prescription
+    '''
+    prescription = _prescriptionFromRecords(pvdf.to_dict('records'), ccdf.to_dict('records'),
+                                            oardf.to_dict('records'), Index)
+    return prescription
+
+def parse_prescription_ir(file, PrescriptionIndex=None):
+    '''
+    Function: parse_prescription_ir
+        Parse the prescriptions of an export straight into Prescription objects, without building DataFrames
+
+    Arguments:
+    file: Path file or buffer
+        File containing the prescription(s). Exported from ARIA in csv format
+    PrescriptionIndex: Integer
+        If given, only this prescription is parsed
+
+    Returns:
+        prescriptions: list of Prescription, or a Prescription if PrescriptionIndex is given
+    '''
+    prdf = read_prescription(file)
+    if PrescriptionIndex is not None:
+        row = next(prdf.iloc[[PrescriptionIndex]].itertuples())
+        return _prescriptionFromRecords(*_prescription_records(row), Index=PrescriptionIndex % len(prdf))
+    prescriptions = [_prescriptionFromRecords(*_prescription_records(row), Index=Index)
+                     for Index, row in enumerate(prdf.itertuples())]
+    return prescriptions
+
+'''
+    Synthetic prescriptions
+'''
+_SYNTHETIC_SCHEMES = [(25, 2.0), (28, 1.8), (33, 2.0), (35, 2.0), (20, 3.0), (15, 2.67), (5, 7.0), (8, 7.5), (3, 18.0)]
+
+_SYNTHETIC_ORGANS = ['Recto', 'Vejiga', 'Cabeza femoral dcha', 'Cabeza femoral izda', 'Intestino delgado',
+                     'médula', 'tronco', 'parótida dcha', 'parótida izda', 'mandíbula', 'cavidad oral', 'laringe',
+                     'esofago', 'corazon', 'suma pulmones', 'traquea', 'plexo braquial', 'aorta', 'higado',
+                     'riñon dcho', 'riñon izdo', 'estomago', 'duodeno', 'quiasma óptico', 'nervio óptico dcho']
+
+# Variantes de formato presentes en las exportaciones de ARIA y unidades del volumen de cada una.
+# d: dosis en Gy, c: dosis en cGy, v: volumen, p: porcentaje de la dosis de prescripción
+_SYNTHETIC_DOSIMPAR_FORMATS = [('V{d}${v}%', '%'), ('V{d}${v} %', '%'), ('V {d}${v} %', '%'), ('V{d} Gy${v}%', '%'),
+                               ('V{c}cGy${v} %', '%'), ('V{d}${v}cc', 'cc'), ('V{d}${v} cc', 'cc'),
+                               ('V {d} Gy${v} cc', 'cc'), ('V{d} Gy${v}cc', 'cc'), ('D{v}cc${d} Gy', 'cc'),
+                               ('D {v}cc${d} Gy', 'cc'), ('D{v} cc${d} Gy', 'cc'), ('D{v}${d} Gy', 'cc'),
+                               ('D{v}%${d} Gy', '%'), ('D{v}%${p}%', '%'), ('D{v}cc${p}%', 'cc')]
+
+def _syntheticNumber(value):
+    '''
+    Function: Format a number the way ARIA does, without trailing zeros
+    '''
+    return '{:g}'.format(round(value, 2))
+
+def _syntheticDosimPar(rng, dose):
+    '''
+    Function: Random dosimetric parameter string for an OAR of a prescription of dose Gy
+    '''
+    form, volumeUnits = rng.choice(_SYNTHETIC_DOSIMPAR_FORMATS)
+    d = dose * rng.uniform(0.2, 1.05)
+    v = rng.uniform(1, 70) if volumeUnits == '%' else rng.choice([0.03, 0.1, 0.35, 1, 2, 5, 10, 15, 150, 700, 950])
+    dosimPar = form.format(d=_syntheticNumber(d), c=int(round(d * 100)), v=_syntheticNumber(v),
+                           p=_syntheticNumber(rng.uniform(50, 105)))
+    return dosimPar
+
+def generatePrescriptionExport(file=None, nPrescriptions=1, nPTVs=2, nOARs=8, nDosimPars=3, seed=0):
+    '''
+    Function: generatePrescriptionExport
+        Generate a synthetic ARIA prescription export, with the same layout parse_prescription expects,
+        for scale and load testing. The same arguments and seed always produce the same export
+
+    Arguments:
+    file: Path file, binary buffer or None
+        Where the csv file is written (utf-8 with BOM and CRLF line endings, as ARIA does). Not written if None
+    nPrescriptions: Integer
+        Number of prescriptions (rows) in the export
+    nPTVs: Integer
+        Number of prescription volumes per prescription
+    nOARs: Integer
+        Number of organs at risk per prescription
+    nDosimPars: Integer
+        Number of dosimetric parameter lines per organ at risk
+    seed: Integer
+        Seed of the random generator
+
+    Returns:
+    prdf: Pandas DataFrame
+        Dataframe with the prescription data, as read_prescription returns it
+    '''
+    rng = random.Random(seed)
+    rows = []
+    for k in range(nPrescriptions):
+        FxCount, FxDose = rng.choice(_SYNTHETIC_SCHEMES)
+        # Prescription volumes: the first one receives the highest dose
+        ptvs = []
+        for i in range(nPTVs):
+            ptvFxDose = FxDose if i == 0 else round(FxDose * rng.uniform(0.75, 0.95), 2)
+            ptvs.append(('PTV{} {}'.format(i + 1, _syntheticNumber(FxCount * ptvFxDose)), FxCount * ptvFxDose,
+                         ptvFxDose))
+        prescribedTo = '|'.join('Volume {}  {:.3f} Gy  {:.3f} Gy/Frac'.format(name, dose, fxDose)
+                                for name, dose, fxDose in ptvs)
+        coverageConstraints = '|'.join(
+            ' Volume / Structure :{0} Min Dose:   Gy Max Dose:   Gy At Least 95 % of {0} at 95 % {1} Gy '
+            'No More Than {2} % of {0} at {3} % {4} Gy'.format(name, _syntheticNumber(0.95 * dose),
+                                                              rng.choice([2, 5]), rng.choice([105, 107]),
+                                                              _syntheticNumber(rng.choice([1.05, 1.07]) * dose))
+            for name, dose, _ in ptvs)
+        # Organs at risk, with blank Mean and Max Dose fields most of the times
+        dose = ptvs[0][1]
+        organs = []
+        for j in range(nOARs):
+            organ = _SYNTHETIC_ORGANS[j % len(_SYNTHETIC_ORGANS)]
+            if j >= len(_SYNTHETIC_ORGANS):
+                organ += ' {}'.format(j // len(_SYNTHETIC_ORGANS) + 1)
+            mean = '{} Gy'.format(_syntheticNumber(dose * rng.uniform(0.2, 0.5))) if rng.random() < 0.15 else ''
+            maximum = '{} Gy'.format(_syntheticNumber(dose * rng.uniform(0.6, 1.05))) if rng.random() < 0.5 else ''
+            lines = ['Organ :{} Mean : {} Max Dose : {}'.format(organ, mean, maximum), 'Constraints : ']
+            lines += [_syntheticDosimPar(rng, dose) for _ in range(nDosimPars)]
+            organs.append('\n'.join(lines))
+        rows.append({'PrescriptionName': 'Sintetica {} {}x{}'.format(k + 1, FxCount, _syntheticNumber(FxDose)),
+                     'CoverageConstraints': coverageConstraints,
+                     'OrgansAtRisk': '\n'.join(organs),
+                     'PrescribedTo': prescribedTo})
+    prdf = pd.DataFrame(rows, columns=['PrescriptionName', 'CoverageConstraints', 'OrgansAtRisk', 'PrescribedTo'])
+
+    if file is not None:
+        content = ('\ufeff' + prdf.to_csv(index=False, lineterminator='\r\n') + '\r\n').encode('utf-8')
+        if hasattr(file, 'write'):
+            file.write(content)
+        else:
+            with open(file, 'wb') as f:
+                f.write(content)
+    return prdf
+
+'''
+    XML backends
+'''
+class XMLBackend:
+    '''
+    Class: XMLBackend
+        Parsing and serialization of xml documents through lxml or xml.etree.ElementTree.
+        lxml parses and serializes in C and evaluates full XPath; ElementTree is always available.
+        Trees of both backends are read alike (find, findall, iter, get, text), but the functions of this
+        module that add elements (addStructure, addPlanObjetive...) require ElementTree trees
+
+    Arguments:
+    name: String (None [Default], 'lxml', 'etree')
+        Backend. None selects lxml when it is installed and ElementTree otherwise
+    '''
+    def __init__(self, name=None):
+        if name not in (None, 'lxml', 'etree'):
+            raise ValueError(f"Backend xml desconocido: {name}. Use 'lxml' o 'etree'")
+        self.etree = ET
+        if name != 'etree':
+            try:
+                from lxml import etree
+                self.etree = etree
+            except ImportError:
+                if name == 'lxml':
+                    raise
+        self.name = 'etree' if self.etree is ET else 'lxml'
+
+    def __repr__(self):
+        return f"XMLBackend('{self.name}')"
+
+    def parse(self, source):
+        '''
+        Method: Parse an xml document
+
+        Arguments:
+        source: String or file-like object
+            File name or binary file-like object
+
+        Returns:
+        An ElementTree instance of the backend
+        '''
+        if isinstance(source, os.PathLike):
+            source = os.fspath(source)
+        return self.etree.parse(source)
+
+    def write(self, tree, out):
+        '''
+        Method: Indent and write an xml document as UTF-8 with xml declaration
+
+        Arguments:
+        tree: ElementTree of the backend
+            The xml document
+        out: String or file-like object
+            File name or binary file-like object
+        '''
+        if isinstance(out, os.PathLike):
+            out = os.fspath(out)
+        self.etree.indent(tree)
+        tree.write(out, encoding='utf-8', xml_declaration=True)
+
+    def tostring(self, tree):
+        '''
+        Method: Bytes that write would write
+        '''
+        buffer = io.BytesIO()
+        self.write(tree, buffer)
+        return buffer.getvalue()
+
+    def xpath(self, element, path):
+        '''
+        Method: Elements matching a path. lxml evaluates full XPath 1.0; ElementTree evaluates
+            the ElementPath subset (relative paths, tags, [@attr='value'] predicates...)
+
+        Returns:
+        elements: list of Element
+        '''
+        if self.name == 'lxml':
+            return element.xpath(path)
+        return element.findall(path)
+
+    def iterparse(self, source, tags):
+        '''
+        Method: Stream the elements of an xml document without building the whole tree.
+            Each matching element is yielded complete when its end tag is read, and cleared when
+            the iteration resumes. Processed elements are detached from the tree with both backends,
+            so memory stays bounded. Stopping the iteration stops reading the file
+
+        Arguments:
+        source: String or file-like object
+            File name or binary file-like object
+        tags: String or tuple of String
+            Tags of the elements yielded
+
+        Yields:
+        element: Element
+        '''
+        tags = (tags,) if isinstance(tags, str) else tuple(tags)
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                yield from self.iterparse(f, tags)
+            return
+        if self.name == 'lxml':
+            for _, element in self.etree.iterparse(source, events=('end',), tag=tags):
+                yield element
+                element.clear(keep_tail=True)
+                # Liberar también los hermanos ya procesados
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        else:
+            # ElementTree no tiene getparent: pila de elementos abiertos
+            parents = []
+            openMatches = 0
+            for event, element in self.etree.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    parents.append(element)
+                    openMatches += element.tag in tags
+                    continue
+                parents.pop()
+                if element.tag in tags:
+                    openMatches -= 1
+                    yield element
+                    element.clear()
+                # Liberar el elemento procesado salvo que forme parte de un elemento que se va a devolver.
+                # Los hermanos anteriores ya se liberaron, así que es el último hijo de su padre
+                if parents and not openMatches:
+                    del parents[-1][-1]
+
+_xmlBackends = {}
+
+def xmlBackend(name=None):
+    '''
+    Function: Shared XMLBackend instance
+
+    Arguments:
+    name: String (None [Default], 'lxml', 'etree')
+        Backend. None selects lxml when it is installed and ElementTree otherwise
+
+    Returns:
+    An XMLBackend instance
+    '''
+    backend = _xmlBackends.get(name)
+    if backend is None:
+        backend = _xmlBackends.setdefault(name, XMLBackend(name))
+    return backend
+
+def _treeBackend(tree):
+    '''
+    Function: Backend that built an element tree
+    '''
+    if isinstance(tree, (ET.ElementTree, ET.Element)):
+        return xmlBackend('etree')
+    return xmlBackend('lxml')
+
+def summarizeProt(clinprot, backend=None):
+    '''
+    Function: Summary of a clinical protocol streamed with iterparse, without building the whole tree
+
+    Arguments:
+    clinprot: String or file-like object
+        File name of the clinical protocol (XML format)
+    backend: String (None [Default], 'lxml', 'etree')
+        XML backend. None uses lxml when it is installed
+
+    Returns:
+    summary: dict
+        Keys 'ID', 'TreatmentSite', 'ApprovalStatus', 'Structures' (list of IDs), 'Items' and 'MeasureItems'
+    '''
+    summary = {'ID': None, 'TreatmentSite': None, 'ApprovalStatus': None, 'Structures': [],
+               'Items': 0, 'MeasureItems': 0}
+    for element in xmlBackend(backend).iterparse(clinprot, ('Preview', 'Structures', 'Prescription')):
+        if element.tag == 'Preview':
+            if summary['ID'] is None:
+                summary.update({key: element.get(key) for key in ('ID', 'TreatmentSite', 'ApprovalStatus')})
+        elif element.tag == 'Structures':
+            summary['Structures'] += [structure.get('ID') for structure in element.iterfind('Structure')]
+        else:
+            for prescriptionElement in element:
+                if prescriptionElement.tag == 'Item':
+                    summary['Items'] += 1
+                elif prescriptionElement.tag == 'MeasureItem':
+                    summary['MeasureItems'] += 1
+    return summary
+
 '''
     Clinical protocols
 '''
-def parseProt(protin = 'ClinicalProtocol.xml'):
+def parseProt(protin = 'ClinicalProtocol.xml', backend='etree'):
     '''
     Function: Parse a clinical protocol
 
     Arguments:
     protin: String
         File name of the clinical protocal (XML formt)
+    backend: String ('etree' [Default], 'lxml', None)
+        XML backend. lxml trees are faster to parse and write but read-only for the functions of this module.
+        None uses lxml when it is installed
 
     Returns:
     An ElementTree instance
     '''
     # Leer el protocolo clínico de entrada
-    cpet = ET.parse(protin)
+    cpet = xmlBackend(backend).parse(protin)
     return cpet
 
+class TemplateRegistry:
+    '''
+    Class: TemplateRegistry
+        Clinical protocol templates parsed once and kept in memory. Every request returns a deep clone,
+        so the cached template is never modified. A template is parsed again when its file changes
+        (modification time or size, and content digest if checkHash is set)
+
+    Arguments:
+    directory: String
+        Directory where template file names are looked up. Defaults to the aclinprot module directory
+    default: String
+        Template used when neither a name nor a known treatment site is requested. Default 'BareBone.xml'
+    checkHash: Boolean
+        Also compare a digest of the file content on every request. Default False
+    '''
+    def __init__(self, directory=None, default='BareBone.xml', checkHash=False):
+        self.directory = os.path.dirname(os.path.abspath(__file__)) if directory is None else directory
+        self.default = default
+        self.checkHash = checkHash
+        self._names = {}
+        self._sites = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, name, path=None, sites=()):
+        '''
+        Method: Register a template under a name and, optionally, the treatment sites it is used for
+
+        Arguments:
+        name: String
+            Name of the template
+        path: String
+            Template file. Defaults to name, looked up in the registry directory
+        sites: list of String
+            Treatment sites (case insensitive) for which the template is selected
+        '''
+        with self._lock:
+            self._names[name] = name if path is None else path
+            for site in sites:
+                self._sites[site.strip().lower()] = name
+
+    def path(self, name=None, site=None):
+        '''
+        Method: Absolute path of the template selected by name, by treatment site or the default one
+        '''
+        if name is None:
+            name = self._sites.get(str(site).strip().lower(), self.default) if site else self.default
+        path = self._names.get(name, name)
+        return os.path.abspath(os.path.join(self.directory, path))
+
+    def get(self, name=None, site=None):
+        '''
+        Method: Clone of a parsed template
+
+        Arguments:
+        name: String
+            Registered template name or template file name
+        site: String
+            Treatment site, used when no name is given
+
+        Returns:
+        An ElementTree instance owned by the caller
+        '''
+        path = self.path(name, site)
+        stat = os.stat(path)
+        digest = None
+        if self.checkHash:
+            with open(path, 'rb') as f:
+                digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        signature = (stat.st_mtime_ns, stat.st_size, digest)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.hits += 1
+                root = entry[1]
+            else:
+                root = None
+        if root is None:
+            root = parseProt(path).getroot()
+            # El parser de C deja text y tail como fragmentos pendientes de unir, y deepcopy los copia sin unir.
+            # Reasignarlos una vez guarda cadenas normales y abarata cada copia unas 10 veces
+            for element in root.iter():
+                element.text = element.text
+                element.tail = element.tail
+            with self._lock:
+                self.misses += 1
+                self._entries[path] = (signature, root)
+        return ET.ElementTree(copy.deepcopy(root))
+
+    def clear(self):
+        '''
+        Method: Forget the parsed templates, registrations are kept
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        '''
+        Method: Registry statistics
+
+        Returns:
+        info: dict
+            Keys 'hits', 'misses', 'templates', 'names' and 'sites'
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'templates': list(self._entries),
+                    'names': dict(self._names), 'sites': dict(self._sites)}
+
+templateRegistry = TemplateRegistry()
+
+# Campos de Structure que la plantilla de contorneo fija; ID, Name y VolumeID son propios del protocolo
+_CONTOURING_FIELDS = ('Identification/VolumeCode', 'Identification/VolumeType', 'Identification/VolumeCodeTable',
+                      'Identification/StructureCode', 'ColorAndStyle', 'SearchCTLow', 'SearchCTHigh',
+                      'DVHLineStyle', 'DVHLineColor', 'DVHLineWidth')
+
+def _fieldValue(element):
+    '''
+    Function: Printable value of a Structure field: its text and its attributes without namespaces
+    '''
+    text = (element.text or '').strip()
+    attributes = ' '.join(f'{name.rpartition("}")[2]}={value}' for name, value in sorted(element.attrib.items()))
+    return ' '.join(value for value in (text, attributes) if value)
+
+class ContouringTemplate:
+    '''
+    Class: ContouringTemplate
+        Contouring structure template (ARIA StructureTemplate xml document) indexed by structure ID.
+        The template is read once; every lookup takes constant time. Structures are matched by ID and,
+        failing that, by normalized name (see normalizeStrName)
+
+    Arguments:
+    template: String or Element Tree
+        File name of the contouring template or the parsed template
+    '''
+    def __init__(self, template):
+        if not isinstance(template, ET.ElementTree):
+            template = parseProt(template)
+        self.cpet = template
+        root = template.getroot()
+        # La plantilla de contorneo tiene StructureTemplate como raíz; también se acepta un protocolo clínico
+        structureTemplate = root if root.tag == 'StructureTemplate' else root.find('StructureTemplate')
+        if structureTemplate is None or structureTemplate.find('Structures') is None:
+            raise ValueError('No es una plantilla de estructuras: falta StructureTemplate/Structures')
+        Preview = structureTemplate.find('Preview')
+        self.ID = Preview.get('ID') if Preview is not None else ''
+        self._structures = {}
+        self._normStructures = {}
+        for structureElement in structureTemplate.find('Structures').findall('Structure'):
+            ID = structureElement.get('ID')
+            self._structures.setdefault(ID, structureElement)
+            self._normStructures.setdefault(normalizeStrName(ID), structureElement)
+
+    def __contains__(self, ID):
+        return self.structureElement(ID) is not None
+
+    def __len__(self):
+        return len(self._structures)
+
+    @property
+    def structureIDs(self):
+        '''
+        List of the structure IDs in document order
+        '''
+        return list(self._structures)
+
+    def structureElement(self, ID):
+        '''
+        Method: Retrieve the template Structure element matching ID, None if there is not any
+        '''
+        structureElement = self._structures.get(ID)
+        if structureElement is None and ID:
+            structureElement = self._normStructures.get(normalizeStrName(ID))
+        return structureElement
+
+    def structures(self):
+        '''
+        Method: Structure attributes of the template
+
+        Returns:
+        structuresdf: Pandas DataFrame
+            One row per structure with the ID and the template fields as columns
+        '''
+        rows = []
+        for ID, structureElement in self._structures.items():
+            row = {'ID': ID}
+            for field in _CONTOURING_FIELDS:
+                element = structureElement.find(field)
+                row[field.rpartition('/')[2]] = _fieldValue(element) if element is not None else None
+            rows.append(row)
+        structuresdf = pd.DataFrame(rows, columns=['ID'] + [field.rpartition('/')[2] for field in _CONTOURING_FIELDS])
+        return structuresdf
+
+    def apply(self, structureElement):
+        '''
+        Method: Copy the template fields into a clinical protocol Structure element, keeping its ID and Name
+
+        Arguments:
+        structureElement: Element
+            Structure element to update in place
+
+        Returns:
+        changes: list of dict
+            Change log with keys 'ID', 'Field', 'Old' and 'New'. Empty if the structure is not in the template
+        '''
+        ID = structureElement.get('ID')
+        templateElement = self.structureElement(ID)
+        changes = []
+        if templateElement is None:
+            return changes
+        for field in _CONTOURING_FIELDS:
+            newElement = templateElement.find(field)
+            if newElement is None:
+                continue
+            parentPath, _, tag = field.rpartition('/')
+            parent = structureElement.find(parentPath) if parentPath else structureElement
+            if parent is None:
+                continue
+            oldElement = parent.find(tag)
+            Old = _fieldValue(oldElement) if oldElement is not None else None
+            New = _fieldValue(newElement)
+            if Old == New:
+                continue
+            replacement = copy.deepcopy(newElement)
+            if oldElement is None:
+                parent.append(replacement)
+            else:
+                replacement.tail = oldElement.tail
+                parent[list(parent).index(oldElement)] = replacement
+            changes.append({'ID': ID, 'Field': tag, 'Old': Old, 'New': New})
+        return changes
+
+    def reconcile(self, cpet):
+        '''
+        Method: Update in place every structure of a clinical protocol found in the template
+
+        Arguments:
+        cpet: Element Tree or ClinicalProtocol
+            Clinical protocol to update
+
+        Returns:
+        changes: list of dict
+            Change log. See apply
+        '''
+        changes = []
+        for structureElement in cpet.find('StructureTemplate').find('Structures').findall('Structure'):
+            changes.extend(self.apply(structureElement))
+        return changes
+
+    def reconcileLibrary(self, library=CLINICAL_PROTOCOLS_DIR, outdir=None, pattern='**/*.xml'):
+        '''
+        Method: Reconcile every clinical protocol of a library with the template.
+            Files that are not clinical protocols (e.g. contouring templates) are skipped
+
+        Arguments:
+        library: String or list of String
+            Directory of the clinical protocols or list of clinical protocol files.
+            Default CLINICAL_PROTOCOLS_DIR, protocolos/clinicos of the repository
+        outdir: String
+            Directory where the updated protocols are written with the same file names.
+            If None (default) nothing is written and only the change log is returned
+        pattern: String
+            Glob pattern of the protocol files inside library. Default '**/*.xml'
+
+        Returns:
+        changelogdf: Pandas DataFrame
+            One row per change with columns ['File', 'ID', 'Field', 'Old', 'New']
+        '''
+        if isinstance(library, (str, os.PathLike)):
+            protocolFiles = sorted(glob.glob(os.path.join(library, pattern), recursive=True))
+        else:
+            protocolFiles = list(library)
+        if outdir is not None:
+            os.makedirs(outdir, exist_ok=True)
+        rows = []
+        for protocolFile in protocolFiles:
+            cpet = parseProt(protocolFile)
+            if cpet.find('StructureTemplate') is None:
+                continue
+            changes = self.reconcile(cpet)
+            rows.extend({'File': protocolFile, **change} for change in changes)
+            if outdir is not None and changes:
+                writeProt(cpet, os.path.join(outdir, os.path.basename(protocolFile)))
+        changelogdf = pd.DataFrame(rows, columns=['File', 'ID', 'Field', 'Old', 'New'])
+        return changelogdf
+
+@functools.lru_cache(maxsize=16)
+def _contouringTemplateFile(path, mtime_ns, size):
+    return ContouringTemplate(path)
+
+def parseContouringTemplate(template):
+    '''
+    Function: Parse a contouring structure template. The parsed template is cached until the file changes
+
+    Arguments:
+    template: String
+        File name of the contouring template
+
+    Returns:
+    A ContouringTemplate instance, shared by the callers: do not modify its element tree
+    '''
+    path = os.path.abspath(template)
+    stat = os.stat(path)
+    return _contouringTemplateFile(path, stat.st_mtime_ns, stat.st_size)
+
 def modPreview(cpet, ID, ApprovalStatus='Unapproved', TreatmentSite='', AssignedUsers=r''):
     '''
     Function: Modify the Preview section of a clinical protocol
@@ -343,7 +1556,8 @@ def modPreview(cpet, ID, ApprovalStatus='Unapproved', TreatmentSite='', Assigned
     ApprovalHistory = AssignedUsers + ' Created [' + creationdatetime + ' ]'
     Preview.set('ApprovalHistory', ApprovalHistory)
 
-def addStructure(cpet, structureName, stColourAndStyle='Countour - Brown', searchCT=1000, vDVHLineColor=-16777216):
+def addStructure(cpet, structureName, stColourAndStyle='Countour - Brown', searchCT=1000, vDVHLineColor=-16777216,
+                 contouringTemplate=None):
     '''
     Function: Add a new structure to the Structures section of a clinical protocol
 
@@ -358,6 +1572,13 @@ def addStructure(cpet, structureName, stColourAndStyle='Countour - Brown', searc
         An integer to set the SearchCTLow and SearchCTHigh fields
     vDVHLineColor:  Int
         A signed integer coding the DVH line color of the structure
+    contouringTemplate: ContouringTemplate
+        If given and the structure is in it, the identification codes, color and DVH line style are
+        taken from the contouring template instead of the default values
+
+    Returns:
+    Structure: Element
+        The Structure element added
     '''
     StructureTemplate = cpet.find('StructureTemplate')
     Structures = StructureTemplate.find('Structures')
@@ -393,6 +1614,9 @@ def addStructure(cpet, structureName, stColourAndStyle='Countour - Brown', searc
     TCPBeta.set('xsi:nil', 'true')
     TCPGamma = ET.SubElement(Structure, 'TCPGamma')
     TCPGamma.set('xsi:nil', 'true')
+    if contouringTemplate is not None:
+        contouringTemplate.apply(Structure)
+    return Structure
 
 def modPhase(cpet, ID, vFractionCount):
     '''
@@ -439,11 +1663,23 @@ def addPlanObjetive(cpet, ID, vParameter, vDose, vTotalDose, vPrimary='false', v
         Fraction dose in Gy
     vTotalDose: Float
         Total dose in Gy
+
+    Returns:
+    Item: Element
+        The prescription Item element added
     '''
     Phases = cpet.find('Phases')
     Phase = Phases.find('Phase')
     Prescription = Phase.find('Prescription')
-    Item = ET.SubElement(Prescription, 'Item')
+    Item = _planObjetiveElement(ID, vParameter, vDose, vTotalDose, vPrimary=vPrimary, vModifier=vModifier)
+    Prescription.append(Item)
+    return Item
+
+def _planObjetiveElement(ID, vParameter, vDose, vTotalDose, vPrimary='false', vModifier=1):
+    '''
+    Function: Build a stand-alone prescription Item element. See addPlanObjetive
+    '''
+    Item = ET.Element('Item')
     Item.set('ID', ID)
     Item.set('Primary', vPrimary)
     Type = ET.SubElement(Item, 'Type')
@@ -456,6 +1692,7 @@ def addPlanObjetive(cpet, ID, vParameter, vDose, vTotalDose, vPrimary='false', v
     Dose.text = f'{float(vDose):g}'
     TotalDose = ET.SubElement(Item, 'TotalDose')
     TotalDose.text = f'{float(vTotalDose):g}'
+    return Item
 
 def addQualityIndex(cpet, ID, vType, vModifier, vValue, vTypeSpecifier, vReportDQPValueInAbsoluteUnits):
     '''
@@ -485,6 +1722,10 @@ def addQualityIndex(cpet, ID, vType, vModifier, vValue, vTypeSpecifier, vReportD
         The dose or volume in Vdose or Dvolume in %, Gy or cc
     vReportDQPValueInAbsoluteUnits: string {'true', 'false'}
         If the constrain is specified in absolute units
+
+    Returns:
+    MeasureItem: Element
+        The MeasureItem element added
     '''
     Phases = cpet.find('Phases')
     Phase = Phases.find('Phase')
@@ -501,6 +1742,7 @@ def addQualityIndex(cpet, ID, vType, vModifier, vValue, vTypeSpecifier, vReportD
     TypeSpecifier.text = f'{float(vTypeSpecifier):g}' 
     ReportDQPValueInAbsoluteUnits = ET.SubElement(MeasureItem, 'ReportDQPValueInAbsoluteUnits')
     ReportDQPValueInAbsoluteUnits.text = vReportDQPValueInAbsoluteUnits
+    return MeasureItem
 
 def writeProt(cpet, protout):
     '''
@@ -512,10 +1754,27 @@ def writeProt(cpet, protout):
     protout: String
         File name of the clinical protocal (XML formt) to be written
     '''
-    ET.indent(cpet)
-    cpet.write(protout, encoding='utf-8', xml_declaration=True)
+    # ElementTree o lxml según quién construyó el árbol
+    _treeBackend(cpet).write(cpet, protout)
+
+def serializeProt(cpet):
+    '''
+    Function: serialize a clinical protocol in memory, exactly as writeProt would write it
+
+    Arguments:
+    cpet: An element tree instance
+        The xml document to be serialized
+
+    Returns:
+    protbytes: Bytes
+        The UTF-8 encoded xml document
+    '''
+    buffer = io.BytesIO()
+    writeProt(cpet, buffer)
+    protbytes = buffer.getvalue()
+    return protbytes
 
-def indentProt(prot):
+def indentProt(prot, backend='etree'):
     '''
     Function: indent a clinical protocol xml file
     Overwrite the xml file indenting its elements
@@ -523,10 +1782,106 @@ def indentProt(prot):
     Arguments:
     prot: String
         File name of the clinical protocal (XML formt)
+    backend: String ('etree' [Default], 'lxml', None)
+        XML backend. None uses lxml when it is installed
     '''
     # Leer el protocolo clínico de entrada
-    cpet = ET.parse(prot)
-    writeProt(cpet, prot)
+    xmlbackend = xmlBackend(backend)
+    cpet = xmlbackend.parse(prot)
+    xmlbackend.write(cpet, prot)
+
+class ConversionTimings:
+    '''
+    Class: ConversionTimings
+        Wall time and call counts of the stages of clinical protocol conversions.
+        Pass the same instance to several conversions (see convertPrescriptionIntoClinicalProtocol and
+        convertPrescriptionFiles) to aggregate their timings
+
+    Stages: 'read_prescription' (batch runs), 'parse_prescription' or 'prescriptionFromDataFrames', 'template',
+        'modPreview', 'modPhase', 'addStructure', 'addPlanObjetive', 'addQualityIndex' and 'writeProt'.
+        Calls count the structures, plan objectives and quality indexes added, and one per run for the other stages
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.runs = 0
+
+    def add(self, stage, seconds, calls=1):
+        '''
+        Method: Accumulate the time and calls of a stage
+        '''
+        entry = self.stages.setdefault(stage, [0, 0.])
+        entry[0] += calls
+        entry[1] += seconds
+
+    def merge(self, other):
+        '''
+        Method: Accumulate the timings of another ConversionTimings or of its asdict() representation
+        '''
+        if isinstance(other, ConversionTimings):
+            other = other.asdict()
+        self.runs += other['runs']
+        for stage, (calls, seconds) in other['stages'].items():
+            self.add(stage, seconds, calls)
+        return self
+
+    def asdict(self):
+        '''
+        Method: Plain dict representation {'runs': runs, 'stages': {stage: (calls, seconds)}}, e.g. to pickle or log
+        '''
+        return {'runs': self.runs, 'stages': {stage: tuple(entry) for stage, entry in self.stages.items()}}
+
+    @property
+    def seconds(self):
+        '''
+        Total time of all the stages
+        '''
+        return sum(seconds for _, seconds in self.stages.values())
+
+    def report(self):
+        '''
+        Method: Timing report
+
+        Returns:
+        reportdf: Pandas DataFrame
+            One row per stage with columns ['Stage', 'Calls', 'Seconds', 'MeanSeconds', 'Share']
+        '''
+        reportdf = pd.DataFrame([(stage, calls, seconds) for stage, (calls, seconds) in self.stages.items()],
+                                columns=['Stage', 'Calls', 'Seconds'])
+        reportdf['MeanSeconds'] = reportdf.Seconds / reportdf.Calls.where(reportdf.Calls > 0)
+        reportdf['Share'] = reportdf.Seconds / self.seconds if self.seconds > 0 else 0.
+        return reportdf
+
+class _StageClock:
+    '''
+    Class: Measure the consecutive stages of one conversion and hand them to a ConversionTimings and a hook
+    '''
+    def __init__(self, timings=None, hook=None):
+        self.timings = timings
+        self.hook = hook
+        self.last = time.perf_counter()
+
+    def lap(self, stage, calls=1):
+        now = time.perf_counter()
+        seconds = now - self.last
+        if self.timings is not None:
+            self.timings.add(stage, seconds, calls)
+        if self.hook is not None:
+            self.hook(stage, seconds, calls)
+        # El tiempo del hook no se carga a la etapa siguiente
+        self.last = time.perf_counter()
+
+    def finish(self):
+        if self.timings is not None:
+            self.timings.runs += 1
+
+def _dumpProfile(profiler, Profile):
+    '''
+    Function: Write the cProfile statistics to the file Profile, or print the 30 costliest calls if Profile is True
+    '''
+    if Profile is True:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    else:
+        profiler.dump_stats(Profile)
 
 def convertPrescriptionIntoClinicalProtocol(
     prescription_or_pvdf,
@@ -537,176 +1892,306 @@ def convertPrescriptionIntoClinicalProtocol(
     ProtOut='ClinicalProtocol.xml',
     PrescriptionIndex=0,
     ccdf=None,
-    oardf=None
+    oardf=None,
+    ProtOutDir=None,
+    Return=None,
+    ContTemplate=None,
+    Timings=None,
+    Hook=None,
+    Profile=None
 ):
     '''
     Function: Convert a prescription into a clinical protocol
 
     Arguments:
-    prescription_or_pvdf: String or DataFrame
-        Prescription file name or Prescription Volume DataFrame
+    prescription_or_pvdf: String, Prescription or DataFrame
+        Prescription file name, parsed Prescription (see parse_prescription_ir) or Prescription Volume DataFrame
     ProtocolID: String
         The identification of the clinical protocol in ARIA
     TreatmetSite: String
         The treatment anatomial region
     PlanID: String
         The plan identification
-    ProtTemplate: String
-        The xml document used as a clinical protocol template
-    ProtOut: String
-        Name of the xml file describing the clinical protocol
-        
+    ProtTemplate: String, Element Tree or None
+        The xml document used as a clinical protocol template: a name registered in templateRegistry or a file
+        name in the module directory, an already parsed template which is copied and left unmodified,
+        or None to select the template registered for TreatmentSite
+    ProtOut: String, file-like object or None
+        Name of the xml file describing the clinical protocol, a binary file-like object where it is written,
+        or None to skip writing
+    PrescriptionIndex: Integer
+        Index of the prescription in the file. Ignored if a Prescription or a DataFrame is given
+    ccdf, oardf: DataFrame
+        Coverage constraints and OAR DataFrames. Required if a DataFrame is given
+    ProtOutDir: String
+        Explicit directory where ProtOut is written. If None (default) the protocol is written
+        to CLINICAL_PROTOCOLS_DIR (protocolos/clinicos of the repository) when it exists, or to ProtOut otherwise
+    Return: String (None [Default], 'tree', 'bytes')
+        What the function returns: nothing, the clinical protocol element tree or its UTF-8 serialization
+    ContTemplate: String or ContouringTemplate
+        Contouring template (e.g. '../protocolos/contorneo/OARs Torax SBRT Task G.xml') from which the
+        structure codes, colors and DVH line styles are taken. None (default) keeps the default values
+    Timings: ConversionTimings
+        Accumulates the wall time and call counts of every stage of the conversion
+    Hook: Callable
+        Called as Hook(stage, seconds, calls) as soon as each stage finishes
+    Profile: String or Boolean
+        If given, the conversion runs under cProfile and the statistics are written to the file Profile
+        (open them with pstats or snakeviz), or printed if Profile is True
+
+    Returns:
+    None, Element Tree or Bytes depending on Return
     '''
+    if Profile:
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(convertPrescriptionIntoClinicalProtocol, prescription_or_pvdf, ProtocolID,
+                                    TreatmentSite, PlanID, ProtTemplate=ProtTemplate, ProtOut=ProtOut,
+                                    PrescriptionIndex=PrescriptionIndex, ccdf=ccdf, oardf=oardf,
+                                    ProtOutDir=ProtOutDir, Return=Return, ContTemplate=ContTemplate,
+                                    Timings=Timings, Hook=Hook)
+        finally:
+            _dumpProfile(profiler, Profile)
+
+    clock = _StageClock(Timings, Hook)
     # Si el primer argumento es un DataFrame, asume la llamada con pvdf, ccdf, oardf
-    if isinstance(prescription_or_pvdf, pd.DataFrame):
+    if isinstance(prescription_or_pvdf, Prescription):
+        prescription = prescription_or_pvdf
+    elif isinstance(prescription_or_pvdf, pd.DataFrame):
         pvdf = prescription_or_pvdf
         # ccdf y oardf deben estar presentes
         if ccdf is None or oardf is None:
             raise ValueError("ccdf y oardf deben proporcionarse si el primer argumento es un DataFrame")
+        prescription = prescriptionFromDataFrames(pvdf, ccdf, oardf)
+        clock.lap('prescriptionFromDataFrames')
     else:
         # Asume que es la llamada tradicional con prescription (ruta o buffer)
         # Read the prescriptiop
-        prescription = prescription_or_pvdf
-        pvdfs, ccdfs, oardfs = parse_prescription(prescription)
-        pvdf = pvdfs[PrescriptionIndex]
-        ccdf = ccdfs[PrescriptionIndex]
-        oardf = oardfs[PrescriptionIndex]
+        prescription = parse_prescription_ir(prescription_or_pvdf, PrescriptionIndex)
+        clock.lap('parse_prescription')
 
     # Read protocol template
-    cpet = parseProt(os.path.dirname(__file__) + '/' + ProtTemplate)
+    if isinstance(ProtTemplate, ET.ElementTree):
+        cpet = copy.deepcopy(ProtTemplate)
+    elif ProtTemplate is None:
+        cpet = templateRegistry.get(site=TreatmentSite)
+    else:
+        cpet = templateRegistry.get(ProtTemplate)
+    clock.lap('template')
     # Preview
     modPreview(cpet, ID=ProtocolID, TreatmentSite=TreatmentSite)
+    clock.lap('modPreview')
     # Phases
-    FractionCount = int(float(pvdf.Dose[0])/float(pvdf.FxDose[0]))
-    modPhase(cpet, ID=PlanID, vFractionCount=FractionCount)
+    modPhase(cpet, ID=PlanID, vFractionCount=prescription.FractionCount)
+    clock.lap('modPhase')
     # Structutures
-    for pv in pvdf.itertuples():
-        addStructure(cpet, structureName=pv.Volume)
-    for oar in oardf.itertuples():
-        addStructure(cpet, structureName=oar.Organ)
-    
+    if isinstance(ContTemplate, (str, os.PathLike)):
+        ContTemplate = parseContouringTemplate(ContTemplate)
+    for targetVolume in prescription.TargetVolumes:
+        addStructure(cpet, structureName=targetVolume.Volume, contouringTemplate=ContTemplate)
+    for Organ in prescription.OrgansAtRisk:
+        addStructure(cpet, structureName=Organ, contouringTemplate=ContTemplate)
+    clock.lap('addStructure', len(prescription.TargetVolumes) + len(prescription.OrgansAtRisk))
+    # Los objetivos y los índices de calidad se cuentan por los elementos añadidos a Prescription
+    prescriptionElement = cpet.find('Phases').find('Phase').find('Prescription')
+    prescriptionCount = len(prescriptionElement)
+
     # Plan objetives
-    for pv in pvdf.itertuples():
-        ccVolumedf = ccdf[ccdf.Volume == pv.Volume]
-        if ccVolumedf.AtLeast.values[0] and isinstance(ccVolumedf.AtLeast.values[0], list):
-            atLeastlst = ccVolumedf.AtLeast.values[0]
-            VolumePercentage =  atLeastlst[0]
-            DosePercentage = float(atLeastlst[1])/100
-            FxDoseGy = float(pv.FxDose) * DosePercentage
-            DoseGy = float(pv.Dose) * DosePercentage
-            addPlanObjetive(cpet, ID=pv.Volume, vParameter=VolumePercentage,
-                                vDose=FxDoseGy, vTotalDose=DoseGy, vModifier=0)
-        if ccVolumedf.NoMore.values[0] and isinstance(ccVolumedf.NoMore.values[0], list):
-            noMorelst = ccVolumedf.NoMore.values[0]
-            VolumePercentage =  noMorelst[0]
-            DosePercentage = float(noMorelst[1])/100
-            FxDoseGy = float(pv.FxDose) * DosePercentage
-            DoseGy = float(pv.Dose) * DosePercentage
-            addPlanObjetive(cpet, ID=pv.Volume, vParameter=VolumePercentage,
-                                vDose=FxDoseGy, vTotalDose=DoseGy)
-    for oar in oardf.itertuples():
-        if oar.Dmean:
-            ID = oar.Organ
-            Parameter = 0
-            Fxs = float(pvdf.Dose.values[0]) / float(pvdf.FxDose.values[0])
-            TotalDose = parseDose(oar.Dmean)
+    Fxs = prescription.Fractions
+    for targetVolume in prescription.TargetVolumes:
+        # At Least: vModifier 0, No More Than: vModifier 1
+        for vModifier, constraint in enumerate((targetVolume.AtLeast, targetVolume.NoMore)):
+            if constraint is not None:
+                DosePercentage = constraint.DosePercentage/100
+                FxDoseGy = targetVolume.FxDose * DosePercentage
+                DoseGy = targetVolume.Dose * DosePercentage
+                addPlanObjetive(cpet, ID=targetVolume.Volume, vParameter=constraint.VolumePercentage,
+                                vDose=FxDoseGy, vTotalDose=DoseGy, vModifier=vModifier)
+    for constraint in prescription.OARConstraints:
+        if constraint.Kind in ('Dmean', 'Dmax'):
+            # Dmean: mean dose is less than, Dmax: maximum dose is less than
+            vModifier = 8 if constraint.Kind == 'Dmean' else 10
+            TotalDose = constraint.Dose
             Dose = f'{TotalDose / Fxs:g}'
-            addPlanObjetive(cpet, ID=ID, vParameter=Parameter, vDose=Dose, vTotalDose=TotalDose,
-                                vModifier=8)
-        if oar.Dmax:
-            ID = oar.Organ
-            Parameter = 0
-            Fxs = float(pvdf.Dose.values[0]) / float(pvdf.FxDose.values[0])
-            TotalDose = parseDose(oar.Dmax)
+            addPlanObjetive(cpet, ID=constraint.Organ, vParameter=0, vDose=Dose, vTotalDose=TotalDose,
+                                vModifier=vModifier)
+        elif constraint.Kind == 'Vxx%':
+            TotalDose = constraint.Dose
             Dose = f'{TotalDose / Fxs:g}'
-            addPlanObjetive(cpet, ID=ID, vParameter=Parameter, vDose=Dose, vTotalDose=TotalDose,
-                                vModifier=10)
-        if oar.DosimPars:
-            ID = oar.Organ
-            for DosimPar in oar.DosimPars:
-                constraint_dict = parseDosimPar(DosimPar)
-                for key, constraint in constraint_dict.items():
-                    if key == 'Vxx%':
-                        VolumePercentage = constraint['VolumeRelative']
-                        Fxs = float(pvdf.Dose.values[0]) / float(pvdf.FxDose.values[0])
-                        TotalDose = constraint['DoseGy']
-                        Dose = f'{TotalDose / Fxs:g}'
-                        addPlanObjetive(cpet, ID=ID, vParameter=VolumePercentage, vDose=Dose, vTotalDose=TotalDose,
-                                            vModifier=1)
-                        
+            addPlanObjetive(cpet, ID=constraint.Organ, vParameter=constraint.Volume, vDose=Dose,
+                                vTotalDose=TotalDose, vModifier=1)
+    clock.lap('addPlanObjetive', len(prescriptionElement) - prescriptionCount)
+    prescriptionCount = len(prescriptionElement)
+
     # Quality Indexes
-    for pv in pvdf.itertuples():
-        ccVolumedf = ccdf[ccdf.Volume == pv.Volume]
-        if ccVolumedf.AtLeast.values[0] and isinstance(ccVolumedf.AtLeast.values[0], list):
-            TreatmentDosePrescription = getTreatmentDosePrescription(pvdf)
-            atLeastlst = ccVolumedf.AtLeast.values[0]
-            VolumePercentage =  atLeastlst[0]
-            DosePercentage = float(atLeastlst[1])/100
-            structureAbsoluteDose = float(pv.Dose) * DosePercentage
-            StructureRelativeDose = structureAbsoluteDose / TreatmentDosePrescription * 100
-            addQualityIndex(cpet, ID=pv.Volume, vType=3, vModifier=0, 
-                                vValue=VolumePercentage, vTypeSpecifier=structureAbsoluteDose, 
-                                vReportDQPValueInAbsoluteUnits='false')
-        if ccVolumedf.NoMore.values[0] and isinstance(ccVolumedf.NoMore.values[0], list):
-            TreatmentDosePrescription = getTreatmentDosePrescription(pvdf)
-            noMorelst = ccVolumedf.NoMore.values[0]
-            VolumePercentage = noMorelst[0]
-            DosePercentage = float(noMorelst[1])/100
-            structureAbsoluteDose = float(pv.Dose) * DosePercentage
-            StructureRelativeDose = structureAbsoluteDose / TreatmentDosePrescription * 100
-            addQualityIndex(cpet, ID=pv.Volume, vType=3, vModifier=1, 
-                                vValue=VolumePercentage, vTypeSpecifier=structureAbsoluteDose, 
+    for targetVolume in prescription.TargetVolumes:
+        # At Least: is more than, No More Than: is less than
+        for vModifier, constraint in enumerate((targetVolume.AtLeast, targetVolume.NoMore)):
+            if constraint is not None:
+                structureAbsoluteDose = targetVolume.Dose * (constraint.DosePercentage/100)
+                addQualityIndex(cpet, ID=targetVolume.Volume, vType=3, vModifier=vModifier,
+                                    vValue=constraint.VolumePercentage, vTypeSpecifier=structureAbsoluteDose,
+                                    vReportDQPValueInAbsoluteUnits='false')
+
+    skipped = []
+    for constraint in prescription.OARConstraints:
+        ID = constraint.Organ
+        if constraint.Kind == 'Vxx%':
+            addQualityIndex(cpet, ID=ID, vType=3, vModifier=1, 
+                                vValue=constraint.Volume, vTypeSpecifier=constraint.Dose, 
                                 vReportDQPValueInAbsoluteUnits='false')
-    
-    for oar in oardf.itertuples():
-        if oar.DosimPars:
-            ID = oar.Organ
-            for DosimPar in oar.DosimPars:
-                constraint_dict = parseDosimPar(DosimPar)
-                for key, constraint in constraint_dict.items():
-                    if key == 'Vxx%':
-                        VolumePercentage = constraint['VolumeRelative']
-                        PrescriptionDoseGy = pvdf.Dose.astype('float').max()
-                        ConstraintDoseGy = constraint['DoseGy']
-                        StructureRelativeDose = f'{ConstraintDoseGy / PrescriptionDoseGy * 100:g}'
-                        addQualityIndex(cpet, ID=ID, vType=3, vModifier=1, 
-                                            vValue=VolumePercentage, vTypeSpecifier=ConstraintDoseGy, 
-                                            vReportDQPValueInAbsoluteUnits='false')
-                    if key == 'VxxGy':
-                        VolumeAbsolute = constraint['VolumeAbsolute']*1000
-                        PrescriptionDoseGy = pvdf.Dose.astype('float').max()
-                        ConstraintDoseGy = constraint['DoseGy']
-                        StructureRelativeDose = f'{ConstraintDoseGy / PrescriptionDoseGy * 100:g}'
-                        addQualityIndex(cpet, ID=ID, vType=3, vModifier=1, 
-                                            vValue=VolumeAbsolute, vTypeSpecifier=ConstraintDoseGy, 
-                                            vReportDQPValueInAbsoluteUnits='true')
-                    if key == 'Dxx_Gy':
-                        VolumeAbsolute = constraint['VolumeAbsolute']
-                        StructureAbsoluteDose = constraint['DoseGy']
-                        addQualityIndex(cpet, ID=ID, vType=5, vModifier=1, 
-                                            vValue=StructureAbsoluteDose, vTypeSpecifier=VolumeAbsolute, 
-                                            vReportDQPValueInAbsoluteUnits='true')
-                    if key == 'Dxxcc_Gy':
-                        VolumeAbsolute = constraint['VolumeAbsolute']
-                        StructureAbsoluteDose = constraint['DoseGy']
-                        addQualityIndex(cpet, ID=ID, vType=5, vModifier=1, 
-                                            vValue=StructureAbsoluteDose, vTypeSpecifier=VolumeAbsolute, 
-                                            vReportDQPValueInAbsoluteUnits='true')
-    
-                    if key == 'Dxx%_Gy':
-                        VolumePercentage = constraint['VolumeRelative']
-                        StructureAbsoluteDose = constraint['DoseGy']
-                        addQualityIndex(cpet, ID=ID, vType=4, vModifier=1, 
-                                            vValue=StructureAbsoluteDose, vTypeSpecifier=VolumePercentage, 
-                                            vReportDQPValueInAbsoluteUnits='true')
+        elif constraint.Kind == 'VxxGy':
+            VolumeAbsolute = constraint.Volume*1000
+            addQualityIndex(cpet, ID=ID, vType=3, vModifier=1, 
+                                vValue=VolumeAbsolute, vTypeSpecifier=constraint.Dose, 
+                                vReportDQPValueInAbsoluteUnits='true')
+        elif constraint.Kind in ('Dxx_Gy', 'Dxxcc_Gy'):
+            addQualityIndex(cpet, ID=ID, vType=5, vModifier=1, 
+                                vValue=constraint.Dose, vTypeSpecifier=constraint.Volume, 
+                                vReportDQPValueInAbsoluteUnits='true')
+        elif constraint.Kind == 'Dxx%_Gy':
+            addQualityIndex(cpet, ID=ID, vType=4, vModifier=1, 
+                                vValue=constraint.Dose, vTypeSpecifier=constraint.Volume, 
+                                vReportDQPValueInAbsoluteUnits='true')
+        elif constraint.Kind not in ('Dmean', 'Dmax') and constraint.DosimPar.strip():
+            skipped.append(f'{ID}: {constraint.DosimPar}')
+    if skipped:
+        # Las restricciones que no se convierten no se descartan en silencio
+        _logger.warning('%s: %d restricciones no convertidas (%s)', ProtocolID, len(skipped), '; '.join(skipped))
+    clock.lap('addQualityIndex', len(prescriptionElement) - prescriptionCount)
 
     # Write clincial protocol
-    clinprotpath = '../protocolos/clinicos/'
-    if os.path.exists(clinprotpath):
-        writeProt(cpet, clinprotpath + ProtOut)
-        print('Creado protocolo ' + clinprotpath + ProtOut)
+    # Con Return='bytes' se serializa una sola vez y los mismos bytes se escriben en el destino
+    protbytes = serializeProt(cpet) if Return == 'bytes' else None
+    if ProtOut is None:
+        protout = None
+    elif not isinstance(ProtOut, (str, os.PathLike)):
+        protout = ProtOut
+    elif ProtOutDir is not None:
+        protout = os.path.join(ProtOutDir, ProtOut)
+    elif os.path.isdir(CLINICAL_PROTOCOLS_DIR):
+        protout = os.path.join(CLINICAL_PROTOCOLS_DIR, ProtOut)
+    else:
+        protout = ProtOut
+    if protout is not None:
+        if protbytes is None:
+            writeProt(cpet, protout)
+        elif isinstance(protout, (str, os.PathLike)):
+            with open(protout, 'wb') as f:
+                f.write(protbytes)
+        else:
+            protout.write(protbytes)
+        if isinstance(protout, (str, os.PathLike)):
+            _logger.info('Creado protocolo %s', protout)
+    if protbytes is not None or protout is not None:
+        clock.lap('writeProt')
+    clock.finish()
+
+    if Return == 'tree':
+        return cpet
+    if Return == 'bytes':
+        return protbytes
+
+
+def _convertPrescriptionFile(prescriptionFile, ProtOutDir, TreatmentSite, PlanID, ProtTemplate, ContTemplate=None):
+    '''
+    Function: Convert every prescription in a prescription file. Worker of convertPrescriptionFiles
+
+    Returns:
+    summary: dict
+        Per-file summary with the conversion successes, failures and timing. 'Timings' holds the
+        per-stage timings (ConversionTimings.asdict)
+    '''
+    start = time.perf_counter()
+    stem = os.path.splitext(os.path.basename(prescriptionFile))[0]
+    timings = ConversionTimings()
+    summary = {'File': prescriptionFile, 'Prescriptions': 0, 'Converted': 0, 'Failed': 0,
+               'Outputs': [], 'Errors': [], 'Seconds': 0., 'Timings': timings.asdict()}
+    try:
+        prdf = read_prescription(prescriptionFile)
+        timings.add('read_prescription', time.perf_counter() - start)
+    except Exception as e:
+        summary['Failed'] = 1
+        summary['Errors'].append(f'{type(e).__name__}: {e}')
+        summary['Seconds'] = time.perf_counter() - start
+        return summary
+
+    summary['Prescriptions'] = len(prdf)
+    for PrescriptionIndex, row in enumerate(prdf.itertuples()):
+        ProtocolID = stem if len(prdf) == 1 else f'{stem}_{PrescriptionIndex + 1}'
+        ProtOut = ProtocolID + '.xml'
+        try:
+            # Cada prescripción se analiza por separado: un error solo afecta a la suya
+            parseStart = time.perf_counter()
+            prescription = _prescriptionFromRecords(*_prescription_records(row), Index=PrescriptionIndex)
+            timings.add('parse_prescription', time.perf_counter() - parseStart)
+            convertPrescriptionIntoClinicalProtocol(prescription, ProtocolID=ProtocolID, TreatmentSite=TreatmentSite,
+                                                    PlanID=PlanID, ProtTemplate=ProtTemplate, ProtOut=ProtOut,
+                                                    ProtOutDir=ProtOutDir, ContTemplate=ContTemplate, Timings=timings)
+            summary['Converted'] += 1
+            summary['Outputs'].append(os.path.join(ProtOutDir, ProtOut))
+        except Exception as e:
+            summary['Failed'] += 1
+            summary['Errors'].append(f'{PrescriptionIndex}: {type(e).__name__}: {e}')
+    summary['Seconds'] = time.perf_counter() - start
+    summary['Timings'] = timings.asdict()
+    return summary
+
+def convertPrescriptionFiles(prescriptions, ProtOutDir, TreatmentSite='', PlanID='PlanID',
+                             ProtTemplate='BareBone.xml', max_workers=None, ContTemplate=None, Timings=None):
+    '''
+    Function: Convert every prescription of every ARIA prescription export into clinical protocols
+        The files are distributed across a process pool. Each prescription is written to ProtOutDir
+        as <file name>.xml, or <file name>_<n>.xml when the file holds more than one prescription
+
+    Arguments:
+    prescriptions: String or list of Strings
+        A directory (all its *.csv files are converted), a glob pattern such as 'prescripciones/*.csv'
+        or a list of prescription file paths
+    ProtOutDir: String
+        Directory where the clinical protocols are written. It is created if it does not exist
+    TreatmentSite: String
+        The treatment anatomial region given to every protocol
+    PlanID: String
+        The plan identification given to every protocol
+    ProtTemplate: String
+        Name of the clinical protocol template in templateRegistry, parsed once per worker process
+    max_workers: Integer
+        Number of worker processes. None uses the number of processors, 1 converts serially in this process
+    ContTemplate: String
+        Contouring template file from which the structure attributes are taken, parsed once per worker process
+    Timings: ConversionTimings
+        Accumulates the per-stage timings of every conversion of the batch, see ConversionTimings.report
+
+    Returns:
+    summarydf: Pandas DataFrame
+        One row per prescription file with columns
+        ['File', 'Prescriptions', 'Converted', 'Failed', 'Outputs', 'Errors', 'Seconds']
+    '''
+    if isinstance(prescriptions, str):
+        if os.path.isdir(prescriptions):
+            prescriptionFiles = sorted(glob.glob(os.path.join(prescriptions, '*.csv')))
+        else:
+            prescriptionFiles = sorted(glob.glob(prescriptions))
+    else:
+        prescriptionFiles = list(prescriptions)
+    os.makedirs(ProtOutDir, exist_ok=True)
+    ProtOutDir = os.path.abspath(ProtOutDir)
+
+    worker = functools.partial(_convertPrescriptionFile, ProtOutDir=ProtOutDir, TreatmentSite=TreatmentSite,
+                               PlanID=PlanID, ProtTemplate=ProtTemplate, ContTemplate=ContTemplate)
+    if max_workers == 1 or len(prescriptionFiles) <= 1:
+        summaries = [worker(prescriptionFile) for prescriptionFile in prescriptionFiles]
     else:
-        writeProt(cpet, ProtOut)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            summaries = list(executor.map(worker, prescriptionFiles))
+
+    if Timings is not None:
+        for summary in summaries:
+            Timings.merge(summary['Timings'])
+    summarydf = pd.DataFrame(summaries, columns=['File', 'Prescriptions', 'Converted', 'Failed',
+                                                 'Outputs', 'Errors', 'Seconds'])
+    return summarydf
 
 
 def structureElementByID(cpet, ID):
@@ -724,6 +2209,8 @@ def structureElementByID(cpet, ID):
     structureElement: Elment
         Structure Element in the clinical protocol element tree
     '''
+    if isinstance(cpet, ClinicalProtocol):
+        return cpet.structureElement(ID)
     for structureElement in cpet.find('StructureTemplate').find('Structures').findall('Structure'):
         if structureElement.get('ID') == ID:
             return structureElement
@@ -744,6 +2231,8 @@ def prescriptionItemsByID(cpet, ID):
     prescriptionItems: List
         Prescription Item Element List in the clinical protocol element tree
     '''
+    if isinstance(cpet, ClinicalProtocol):
+        return cpet.prescriptionItems(ID)
     prescriptionItems = []
     for prescriptionItem in cpet.find('Phases').find('Phase').find('Prescription').findall('Item'):
         if prescriptionItem.get('ID') == ID:
@@ -765,6 +2254,8 @@ def measureItemsByID(cpet, ID):
     measureItems: List
         Measure Item Element List in the clinical protocol element tree
     '''
+    if isinstance(cpet, ClinicalProtocol):
+        return cpet.measureItems(ID)
     measureItems = []
     for measureItem in cpet.find('Phases').find('Phase').find('Prescription').findall('MeasureItem'):
         if measureItem.get('ID') == ID:
@@ -789,6 +2280,8 @@ def amendClinicalProtocol(amendedcpet, modelcpet, ID):
     amendedcpet: Element Tree
         Amended clinical protocol element tree
     '''
+    if isinstance(amendedcpet, ClinicalProtocol):
+        return amendedcpet.amend(modelcpet, ID)
     # Structures
     structureElement = structureElementByID(cpet=modelcpet, ID=ID)
     amendedcpet.find('StructureTemplate').find('Structures').append(structureElement)
@@ -804,9 +2297,674 @@ def amendClinicalProtocol(amendedcpet, modelcpet, ID):
      
     return amendedcpet
 
-'''
-    Validation
-'''
+'''
+    Indexed clinical protocol
+'''
+class ClinicalProtocol:
+    '''
+    Class: ClinicalProtocol
+        Clinical protocol element tree indexed by structure ID. Lookups of the Structure element,
+        the prescription Items and the MeasureItems of a structure take constant time.
+        The indexes are kept consistent when elements are added or removed through the class methods.
+        After modifying the element tree directly call reindex()
+
+    Arguments:
+    cpet: Element Tree or String
+        Clinical protocol element tree of either backend (see parseProt) or file name of the clinical
+        protocol (XML format). lxml trees are read-only for the methods that add elements
+    '''
+    def __init__(self, cpet):
+        # Cualquier ElementTree, de ElementTree o de lxml (ver _treeBackend); si no, un archivo
+        if not hasattr(cpet, 'getroot'):
+            cpet = parseProt(cpet)
+        self.cpet = cpet
+        self.structures = cpet.find('StructureTemplate').find('Structures')
+        self.prescription = cpet.find('Phases').find('Phase').find('Prescription')
+        self.reindex()
+
+    def reindex(self):
+        '''
+        Method: Rebuild the ID indexes from the element tree
+        '''
+        self._structures = {}
+        self._items = {}
+        self._measureItems = {}
+        self._itemCount = 0
+        for structureElement in self.structures.findall('Structure'):
+            self._structures.setdefault(structureElement.get('ID'), structureElement)
+        for element in self.prescription:
+            if element.tag == 'Item':
+                self._items.setdefault(element.get('ID'), []).append(element)
+                self._itemCount += 1
+            elif element.tag == 'MeasureItem':
+                self._measureItems.setdefault(element.get('ID'), []).append(element)
+
+    def __contains__(self, ID):
+        return ID in self._structures
+
+    def find(self, path):
+        return self.cpet.find(path)
+
+    def getroot(self):
+        return self.cpet.getroot()
+
+    @property
+    def structureIDs(self):
+        '''
+        List of the structure IDs in document order
+        '''
+        return list(self._structures)
+
+    def structureElement(self, ID):
+        '''
+        Method: Retrieve the Structure element with the specified ID, None if there is not any
+        '''
+        return self._structures.get(ID)
+
+    def prescriptionItems(self, ID):
+        '''
+        Method: Retrieve the list of prescription Item elements with the specified ID
+        '''
+        return list(self._items.get(ID, []))
+
+    def measureItems(self, ID):
+        '''
+        Method: Retrieve the list of MeasureItem elements with the specified ID
+        '''
+        return list(self._measureItems.get(ID, []))
+
+    def appendStructureElement(self, structureElement):
+        '''
+        Method: Append a Structure element to the Structures section
+        '''
+        self.structures.append(structureElement)
+        self._structures.setdefault(structureElement.get('ID'), structureElement)
+        return structureElement
+
+    def appendPrescriptionItem(self, prescriptionItem):
+        '''
+        Method: Insert a prescription Item after the last Item of the Prescription section
+        '''
+        self.prescription.insert(self._itemCount, prescriptionItem)
+        self._itemCount += 1
+        self._items.setdefault(prescriptionItem.get('ID'), []).append(prescriptionItem)
+        return prescriptionItem
+
+    def appendMeasureItem(self, measureItem):
+        '''
+        Method: Append a MeasureItem at the end of the Prescription section
+        '''
+        self.prescription.append(measureItem)
+        self._measureItems.setdefault(measureItem.get('ID'), []).append(measureItem)
+        return measureItem
+
+    def addStructure(self, structureName, **kwargs):
+        '''
+        Method: Add a new structure. See addStructure
+        '''
+        structureElement = addStructure(self.cpet, structureName, **kwargs)
+        self._structures.setdefault(structureElement.get('ID'), structureElement)
+        return structureElement
+
+    def addPlanObjetive(self, ID, vParameter, vDose, vTotalDose, **kwargs):
+        '''
+        Method: Add a plan objetive. See addPlanObjetive
+        '''
+        prescriptionItem = _planObjetiveElement(ID, vParameter, vDose, vTotalDose, **kwargs)
+        return self.appendPrescriptionItem(prescriptionItem)
+
+    def addQualityIndex(self, ID, vType, vModifier, vValue, vTypeSpecifier, vReportDQPValueInAbsoluteUnits):
+        '''
+        Method: Add a quality index. See addQualityIndex
+        '''
+        measureItem = addQualityIndex(self.cpet, ID, vType, vModifier, vValue, vTypeSpecifier,
+                                      vReportDQPValueInAbsoluteUnits)
+        self._measureItems.setdefault(measureItem.get('ID'), []).append(measureItem)
+        return measureItem
+
+    def removeStructure(self, ID):
+        '''
+        Method: Remove the Structure element with the specified ID together with its prescription Items and MeasureItems
+        '''
+        structureElement = self._structures.pop(ID, None)
+        if structureElement is not None:
+            self.structures.remove(structureElement)
+        for prescriptionItem in self._items.pop(ID, []):
+            self.prescription.remove(prescriptionItem)
+            self._itemCount -= 1
+        for measureItem in self._measureItems.pop(ID, []):
+            self.prescription.remove(measureItem)
+        return structureElement
+
+    def amend(self, model, ID):
+        '''
+        Method: Amend the clinical protocol copying the structure, prescription Items and MeasureItems
+            with the specified ID from a model clinical protocol. See amendClinicalProtocol
+
+        Arguments:
+        model: ClinicalProtocol or Element Tree
+            Clinical protocol to be used as a model
+        ID: String
+            Structure element ID
+        '''
+        structureElement = structureElementByID(cpet=model, ID=ID)
+        if structureElement is not None:
+            self.appendStructureElement(structureElement)
+        for prescriptionItem in prescriptionItemsByID(cpet=model, ID=ID):
+            self.appendPrescriptionItem(prescriptionItem)
+        for measureItem in measureItemsByID(cpet=model, ID=ID):
+            self.appendMeasureItem(measureItem)
+        return self
+
+    def write(self, protout):
+        '''
+        Method: Write the clinical protocol. See writeProt
+        '''
+        writeProt(self.cpet, protout)
+
+'''
+    Clinical protocol diff
+'''
+# Atributos que cambian en cada guardado sin que cambie el contenido del protocolo
+_VOLATILE_ATTRIBUTES = ('LastModified', 'ApprovalHistory')
+
+def _canonicalElement(element, ignore=_VOLATILE_ATTRIBUTES, skip=()):
+    '''
+    Function: Canonical text of an element subtree: sorted attributes without the ignored ones,
+        stripped text and no tails, so indentation and attribute order do not matter
+    '''
+    parts = []
+
+    def visit(e):
+        parts.append('<' + e.tag)
+        for name in sorted(e.attrib):
+            if name not in ignore:
+                parts.append(' {}="{}"'.format(name, xml.sax.saxutils.escape(e.attrib[name], {'"': '&quot;'})))
+        parts.append('>' + xml.sax.saxutils.escape((e.text or '').strip()))
+        for child in e:
+            if child.tag not in skip:
+                visit(child)
+        parts.append('</>')
+
+    visit(element)
+    return ''.join(parts)
+
+def _subtreeHash(element, ignore=_VOLATILE_ATTRIBUTES, skip=()):
+    return hashlib.blake2b(_canonicalElement(element, ignore, skip).encode('utf-8'), digest_size=16).hexdigest()
+
+def _flattenElement(element, ignore=_VOLATILE_ATTRIBUTES, skip=(), path=''):
+    '''
+    Function: Leaf values of an element subtree keyed by path. Repeated sibling tags are numbered
+    '''
+    leaves = {}
+    for name, value in element.attrib.items():
+        if name not in ignore:
+            leaves[path + '@' + name] = value
+    text = (element.text or '').strip()
+    if text or len(element) == 0:
+        leaves[path or '.'] = text
+    children = [child for child in element if child.tag not in skip]
+    counts = collections.Counter(child.tag for child in children)
+    seen = collections.Counter()
+    for child in children:
+        seen[child.tag] += 1
+        tag = child.tag if counts[child.tag] == 1 else '{}[{}]'.format(child.tag, seen[child.tag])
+        leaves.update(_flattenElement(child, ignore, skip, path + '/' + tag if path else tag))
+    return leaves
+
+def fingerprintProt(cpet, ignore=_VOLATILE_ATTRIBUTES):
+    '''
+    Function: Hash the Preview, Phase, Structure, Item and MeasureItem subtrees of a clinical protocol
+
+    Arguments:
+    cpet: Element Tree, ClinicalProtocol or String
+        Clinical protocol, or file name of a clinical or contouring protocol (XML format)
+    ignore: tuple of String
+        Attributes left out of the hashes. Default LastModified and ApprovalHistory
+
+    Returns:
+    fingerprint: dict
+        'Digest': hash of the whole protocol, independent of the order of the subtrees
+        'Subtrees': dict mapping (Kind, ID) to the list of (hash, element) pairs of the subtrees, in document order.
+            The Phase subtree leaves its Prescription out, as its Items and MeasureItems are hashed on their own
+    '''
+    if isinstance(cpet, ClinicalProtocol):
+        cpet = cpet.cpet
+    elif not isinstance(cpet, ET.ElementTree):
+        cpet = parseProt(cpet)
+    root = cpet.getroot()
+    subtrees = {}
+
+    def add(kind, element, skip=()):
+        key = (kind, element.get('ID', ''))
+        subtrees.setdefault(key, []).append((_subtreeHash(element, ignore, skip), element))
+
+    preview = root.find('Preview')
+    if preview is not None:
+        add('Preview', preview)
+    for phase in root.iterfind('.//Phases/Phase'):
+        add('Phase', phase, skip=('Prescription',))
+        prescription = phase.find('Prescription')
+        for element in (prescription if prescription is not None else []):
+            if element.tag in ('Item', 'MeasureItem'):
+                add(element.tag, element)
+    for structure in root.iterfind('.//Structures/Structure'):
+        add('Structure', structure)
+
+    digest = hashlib.blake2b(digest_size=16)
+    for kind, ID, subtreeHash in sorted((kind, ID, h) for (kind, ID), pairs in subtrees.items() for h, _ in pairs):
+        digest.update('{}\0{}\0{}\n'.format(kind, ID, subtreeHash).encode('utf-8'))
+    fingerprint = {'Digest': digest.hexdigest(), 'Subtrees': subtrees}
+    return fingerprint
+
+def _changeDetails(oldElement, newElement, ignore=_VOLATILE_ATTRIBUTES, skip=()):
+    '''
+    Function: Readable description of the leaf values that differ between two subtrees
+    '''
+    old = _flattenElement(oldElement, ignore, skip)
+    new = _flattenElement(newElement, ignore, skip)
+    details = ['{}: {} -> {}'.format(path, old.get(path, '(none)'), new.get(path, '(none)'))
+               for path in list(old) + [path for path in new if path not in old] if old.get(path) != new.get(path)]
+    return '; '.join(details)
+
+def diffProt(oldcpet, newcpet, ignore=_VOLATILE_ATTRIBUTES, details=True):
+    '''
+    Function: Structured diff of two clinical protocols. Subtrees are matched by kind and ID and compared
+        by hash. Subtrees of the same kind and ID present only in one of the protocols are paired, in document
+        order, as changed; the rest are added or removed
+
+    Arguments:
+    oldcpet, newcpet: Element Tree, ClinicalProtocol, String or fingerprint
+        Clinical protocols to compare, or their fingerprintProt
+    ignore: tuple of String
+        Attributes ignored in the comparison. Default LastModified and ApprovalHistory
+    details: Boolean
+        Describe the differing values of the changed subtrees. Default True
+
+    Returns:
+    diffdf: Pandas DataFrame
+        One row per difference with columns ['Kind', 'ID', 'Change', 'Details'].
+        Change is 'added', 'removed' or 'changed'. Empty if the protocols are equivalent
+    '''
+    old = oldcpet if isinstance(oldcpet, dict) else fingerprintProt(oldcpet, ignore)
+    new = newcpet if isinstance(newcpet, dict) else fingerprintProt(newcpet, ignore)
+    rows = []
+    if old['Digest'] != new['Digest']:
+        keys = list(old['Subtrees']) + [key for key in new['Subtrees'] if key not in old['Subtrees']]
+        for kind, ID in keys:
+            oldPairs = old['Subtrees'].get((kind, ID), [])
+            newPairs = new['Subtrees'].get((kind, ID), [])
+            # Subtrees with the same hash on both sides are unchanged
+            common = collections.Counter(h for h, _ in oldPairs) & collections.Counter(h for h, _ in newPairs)
+            removed, added = [], []
+            for pairs, unmatched in ((oldPairs, removed), (newPairs, added)):
+                remaining = collections.Counter(common)
+                for h, element in pairs:
+                    if remaining[h] > 0:
+                        remaining[h] -= 1
+                    else:
+                        unmatched.append(element)
+            skip = ('Prescription',) if kind == 'Phase' else ()
+            for oldElement, newElement in zip(removed, added):
+                rows.append({'Kind': kind, 'ID': ID, 'Change': 'changed',
+                             'Details': _changeDetails(oldElement, newElement, ignore, skip) if details else ''})
+            for element in removed[len(added):]:
+                rows.append({'Kind': kind, 'ID': ID, 'Change': 'removed', 'Details': ''})
+            for element in added[len(removed):]:
+                rows.append({'Kind': kind, 'ID': ID, 'Change': 'added', 'Details': ''})
+    diffdf = pd.DataFrame(rows, columns=['Kind', 'ID', 'Change', 'Details'])
+    return diffdf
+
+@functools.lru_cache(maxsize=256)
+def _fingerprintFile(path, mtime_ns, size, ignore):
+    # La clave incluye mtime y tamaño: un fichero modificado se vuelve a procesar.
+    # Solo se guardan los hashes, no los elementos: la caché no mantiene vivos los árboles
+    fingerprint = fingerprintProt(path, ignore)
+    digests = {key: [(h, None) for h, _ in pairs] for key, pairs in fingerprint['Subtrees'].items()}
+    return {'Digest': fingerprint['Digest'], 'Subtrees': digests}
+
+def diffProtLibrary(cpet, library=None, pattern='**/*.xml', ignore=_VOLATILE_ATTRIBUTES):
+    '''
+    Function: Compare a clinical protocol with every protocol of a library. The library fingerprints are
+        kept in memory and only recomputed for the files whose modification time or size have changed
+
+    Arguments:
+    cpet: Element Tree, ClinicalProtocol or String
+        Clinical protocol to compare
+    library: String or list of String
+        Directory of the library, or list of protocol file names. Default None, protocolos/clinicos of the repository
+    pattern: String
+        Glob pattern of the protocol files inside the library directory. Default '**/*.xml'
+    ignore: tuple of String
+        Attributes ignored in the comparison. Default LastModified and ApprovalHistory
+
+    Returns:
+    librarydf: Pandas DataFrame
+        One row per library protocol with columns ['Protocol', 'Identical', 'Added', 'Removed', 'Changed'],
+        sorted from the most to the least similar protocol
+    '''
+    if library is None:
+        library = CLINICAL_PROTOCOLS_DIR
+    if isinstance(library, (str, os.PathLike)):
+        library = sorted(glob.glob(os.path.join(library, pattern), recursive=True))
+    fingerprint = fingerprintProt(cpet, ignore)
+    rows = []
+    for protocol in library:
+        stat = os.stat(protocol)
+        libraryFingerprint = _fingerprintFile(os.path.abspath(protocol), stat.st_mtime_ns, stat.st_size, tuple(ignore))
+        changes = diffProt(fingerprint, libraryFingerprint, ignore, details=False)['Change'].value_counts()
+        rows.append({'Protocol': protocol, 'Identical': changes.sum() == 0, 'Added': changes.get('added', 0),
+                     'Removed': changes.get('removed', 0), 'Changed': changes.get('changed', 0)})
+    librarydf = pd.DataFrame(rows, columns=['Protocol', 'Identical', 'Added', 'Removed', 'Changed'])
+    librarydf = librarydf.assign(_total=librarydf[['Added', 'Removed', 'Changed']].sum(axis=1)) \
+        .sort_values('_total', kind='stable').drop(columns='_total').reset_index(drop=True)
+    return librarydf
+
+'''
+    Protocol catalog
+'''
+_CATALOG_SCHEMA = """
+PRAGMA foreign_keys = ON;
+CREATE TABLE IF NOT EXISTS Protocols (
+    ProtocolKey INTEGER PRIMARY KEY, Path TEXT UNIQUE NOT NULL, MTimeNs INTEGER, Size INTEGER, Digest TEXT,
+    Root TEXT, ID TEXT, Type TEXT, ApprovalStatus TEXT, TreatmentSite TEXT, Diagnosis TEXT, AssignedUsers TEXT,
+    Description TEXT, PhaseID TEXT, FractionCount INTEGER);
+CREATE TABLE IF NOT EXISTS Structures (
+    ProtocolKey INTEGER REFERENCES Protocols ON DELETE CASCADE, StructureID TEXT, Name TEXT, VolumeType TEXT,
+    ColorAndStyle TEXT);
+CREATE TABLE IF NOT EXISTS Items (
+    ProtocolKey INTEGER REFERENCES Protocols ON DELETE CASCADE, StructureID TEXT, "Primary" TEXT, Type INTEGER,
+    Modifier INTEGER, Parameter REAL, Dose REAL, TotalDose REAL, Measure TEXT);
+CREATE TABLE IF NOT EXISTS MeasureItems (
+    ProtocolKey INTEGER REFERENCES Protocols ON DELETE CASCADE, StructureID TEXT, Type INTEGER, Modifier INTEGER,
+    Value REAL, TypeSpecifier REAL, AbsoluteUnits INTEGER, Measure TEXT);
+CREATE INDEX IF NOT EXISTS StructuresByID ON Structures (StructureID COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS ItemsByID ON Items (StructureID COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS MeasureItemsByID ON MeasureItems (StructureID COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS MeasureItemsByMeasure ON MeasureItems (Measure COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS StructuresByProtocol ON Structures (ProtocolKey);
+CREATE INDEX IF NOT EXISTS ItemsByProtocol ON Items (ProtocolKey);
+CREATE INDEX IF NOT EXISTS MeasureItemsByProtocol ON MeasureItems (ProtocolKey);
+"""
+
+def _catalogNumber(text):
+    '''
+    Function: Float value of an element text, None if missing or not numeric
+    '''
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+def _catalogMeasure(letter, number, units=''):
+    return None if number is None else '{}{:g}{}'.format(letter, number, units)
+
+# MeasureItem Type (see addQualityIndex): measure letter and units of the TypeSpecifier
+_MEASURE_ITEM_KINDS = {0: ('CI', None), 1: ('GM', None), 2: ('V', '%'), 3: ('V', ''), 4: ('D', '%'), 5: ('D', 'cc')}
+
+class ProtocolCatalog:
+    '''
+    Class: ProtocolCatalog
+        SQLite index of a library of clinical and contouring protocols: Preview metadata, fraction count,
+        structures, prescription Items and MeasureItems. refresh() only parses the files that are new or whose
+        content has changed (checked by modification time and size first, then by content digest).
+
+        Items and MeasureItems carry a Measure column naming the dosimetric parameter they constrain:
+        'V20' (volume receiving 20 Gy), 'V95%' (volume receiving 95 % of the dose), 'D2cc', 'D2%' (dose to
+        2 cc or 2 % of the volume), 'Dmean', 'Dmax', 'CI' (conformity index) or 'GM' (gradient measure)
+
+    Arguments:
+    database: String
+        SQLite database file. Default ':memory:', a catalog that lives only in this process
+    library: list of String
+        Directories of the protocol library. Default [CLINICAL_PROTOCOLS_DIR, CONTOURING_TEMPLATES_DIR],
+        protocolos/clinicos and protocolos/contorneo of the repository
+    pattern: String
+        Glob pattern of the protocol files inside the library directories. Default '**/*.xml'
+    '''
+    def __init__(self, database=':memory:', library=(CLINICAL_PROTOCOLS_DIR, CONTOURING_TEMPLATES_DIR),
+                 pattern='**/*.xml'):
+        self.library = [library] if isinstance(library, (str, os.PathLike)) else list(library)
+        self.pattern = pattern
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript(_CATALOG_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Method: Close the database connection
+        '''
+        self.connection.close()
+
+    def files(self):
+        '''
+        Method: Absolute paths of the protocol files currently in the library directories
+        '''
+        return sorted({os.path.abspath(path) for directory in self.library
+                       for path in glob.glob(os.path.join(directory, self.pattern), recursive=True)})
+
+    def refresh(self):
+        '''
+        Method: Bring the catalog up to date with the library directories
+
+        Returns:
+        counts: dict
+            Number of protocol files 'added', 'updated', 'unchanged' and 'removed'
+        '''
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        known = {path: (key, mtime, size, digest) for key, path, mtime, size, digest in
+                 self.connection.execute('SELECT ProtocolKey, Path, MTimeNs, Size, Digest FROM Protocols')}
+        files = self.files()
+        with self.connection:
+            for path in files:
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is not None and entry[1:3] == (stat.st_mtime_ns, stat.st_size):
+                    counts['unchanged'] += 1
+                    continue
+                with open(path, 'rb') as f:
+                    content = f.read()
+                digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+                if entry is not None and entry[3] == digest:
+                    # Fichero tocado pero con el mismo contenido: basta con actualizar mtime
+                    self.connection.execute('UPDATE Protocols SET MTimeNs = ?, Size = ? WHERE ProtocolKey = ?',
+                                            (stat.st_mtime_ns, stat.st_size, entry[0]))
+                    counts['unchanged'] += 1
+                    continue
+                if entry is not None:
+                    self.connection.execute('DELETE FROM Protocols WHERE ProtocolKey = ?', (entry[0],))
+                self._insert(path, stat, digest, ET.fromstring(content))
+                counts['updated' if entry is not None else 'added'] += 1
+            for path in set(known) - set(files):
+                self.connection.execute('DELETE FROM Protocols WHERE ProtocolKey = ?', (known[path][0],))
+                counts['removed'] += 1
+        return counts
+
+    def _insert(self, path, stat, digest, root):
+        preview = root.find('Preview')
+        preview = {} if preview is None else preview.attrib
+        phase = root.find('.//Phases/Phase')
+        fractionCount = _catalogNumber(phase.findtext('FractionCount')) if phase is not None else None
+        cursor = self.connection.execute(
+            'INSERT INTO Protocols (Path, MTimeNs, Size, Digest, Root, ID, Type, ApprovalStatus, TreatmentSite, '
+            'Diagnosis, AssignedUsers, Description, PhaseID, FractionCount) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, stat.st_mtime_ns, stat.st_size, digest, root.tag, preview.get('ID'), preview.get('Type'),
+             preview.get('ApprovalStatus'), preview.get('TreatmentSite'), preview.get('Diagnosis'),
+             preview.get('AssignedUsers'), preview.get('Description'),
+             phase.get('ID') if phase is not None else None,
+             int(fractionCount) if fractionCount is not None else None))
+        key = cursor.lastrowid
+
+        self.connection.executemany(
+            'INSERT INTO Structures VALUES (?, ?, ?, ?, ?)',
+            [(key, structure.get('ID'), structure.get('Name'), structure.findtext('Identification/VolumeType'),
+              structure.findtext('ColorAndStyle')) for structure in root.iterfind('.//Structures/Structure')])
+
+        items, measureItems = [], []
+        for element in root.iterfind('.//Phases/Phase/Prescription/*'):
+            Type = _catalogNumber(element.findtext('Type'))
+            Modifier = _catalogNumber(element.findtext('Modifier'))
+            if element.tag == 'Item':
+                TotalDose = _catalogNumber(element.findtext('TotalDose'))
+                measure = {8: 'Dmean', 10: 'Dmax'}.get(Modifier) or _catalogMeasure('V', TotalDose)
+                items.append((key, element.get('ID'), element.get('Primary'), Type, Modifier,
+                              _catalogNumber(element.findtext('Parameter')), _catalogNumber(element.findtext('Dose')),
+                              TotalDose, measure))
+            elif element.tag == 'MeasureItem':
+                TypeSpecifier = _catalogNumber(element.findtext('TypeSpecifier'))
+                letter, units = _MEASURE_ITEM_KINDS.get(Type, (None, None))
+                measure = letter if units is None else _catalogMeasure(letter, TypeSpecifier, units)
+                measureItems.append((key, element.get('ID'), Type, Modifier, _catalogNumber(element.findtext('Value')),
+                                     TypeSpecifier, element.findtext('ReportDQPValueInAbsoluteUnits') == 'true',
+                                     measure))
+        self.connection.executemany('INSERT INTO Items VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', items)
+        self.connection.executemany('INSERT INTO MeasureItems VALUES (?, ?, ?, ?, ?, ?, ?, ?)', measureItems)
+
+    def query(self, sql, params=()):
+        '''
+        Method: Run an SQL query on the catalog tables (Protocols, Structures, Items, MeasureItems)
+
+        Returns:
+        A Pandas DataFrame with the query result
+        '''
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def protocolsConstraining(self, structure):
+        '''
+        Method: Protocols with prescription Items or MeasureItems for a structure
+
+        Arguments:
+        structure: String
+            Structure ID, case insensitive. SQL LIKE wildcards (%, _) are accepted, e.g. '%pulm%'
+
+        Returns:
+        A Pandas DataFrame with columns ['ID', 'Path', 'StructureID', 'Items', 'MeasureItems']
+        '''
+        return self.query(
+            'SELECT p.ID, p.Path, c.StructureID, SUM(c.Kind = 0) AS Items, SUM(c.Kind = 1) AS MeasureItems '
+            'FROM (SELECT ProtocolKey, StructureID, 0 AS Kind FROM Items WHERE StructureID LIKE ? '
+            '      UNION ALL SELECT ProtocolKey, StructureID, 1 FROM MeasureItems WHERE StructureID LIKE ?) c '
+            'JOIN Protocols p USING (ProtocolKey) GROUP BY p.ProtocolKey, c.StructureID ORDER BY p.Path, c.StructureID',
+            (structure, structure))
+
+    def protocolsWithMeasure(self, measure, structure='%'):
+        '''
+        Method: Protocols constraining a dosimetric parameter, optionally on a structure
+
+        Arguments:
+        measure: String
+            Measure name, case insensitive, e.g. 'V20', 'V95%', 'D2cc', 'Dmax'. SQL LIKE wildcards are accepted
+        structure: String
+            Structure ID, case insensitive, with SQL LIKE wildcards. Default any structure
+
+        Returns:
+        A Pandas DataFrame with columns ['ID', 'Path', 'StructureID', 'Kind', 'Measure', 'Modifier', 'Value']
+            Value is the Parameter of the Items and the Value of the MeasureItems
+        '''
+        return self.query(
+            "SELECT p.ID, p.Path, c.StructureID, c.Kind, c.Measure, c.Modifier, c.Value "
+            "FROM (SELECT ProtocolKey, StructureID, 'Item' AS Kind, Measure, Modifier, Parameter AS Value FROM Items "
+            "      WHERE Measure LIKE ? AND StructureID LIKE ? "
+            "      UNION ALL SELECT ProtocolKey, StructureID, 'MeasureItem', Measure, Modifier, Value FROM MeasureItems "
+            "      WHERE Measure LIKE ? AND StructureID LIKE ?) c "
+            "JOIN Protocols p USING (ProtocolKey) ORDER BY p.Path, c.StructureID",
+            (measure, structure, measure, structure))
+
+'''
+    Validation
+'''
+_TARGETVOLUME_RX_DICT = {
+#    'targetVolume': re.compile(r'Volume / Structure :(?P<targetVolume>.*?) M'),
+    'Dmean': re.compile(r'Mean :(?P<Dmean>.*?) c?Gy'),
+    'Dmax': re.compile(r'Max Dose:(?P<Dmax>.*?) c?Gy'),
+    'Dmin': re.compile(r'Min Dose:(?P<Dmin>.*?) c?Gy'),
+    'atLeast': re.compile(r'At Least(?P<atLeast>.*?) No More Than'),
+    'noMoreThan': re.compile(r'No More Than(?P<noMoreThan>.*?)$'),
+}
+_MEANMAX_RX_DICT = {
+    'Mean': re.compile(r'Mean :(?P<Mean>.*?) Max Dose :'),
+    'Max': re.compile(r'Max Dose :(?P<Max>.*?c?Gy)$'),
+}
+_CONSTRAINTS_SPLIT_RX = re.compile(r'Constraints : \r?\n')
+_VXX_RX = re.compile(r'V.*?\$')
+_VXXGY_RX = re.compile(r'V.*?Gy.*?\$')
+_DXX_RX = re.compile(r'D.*?\$')
+
+def _coverageConstraintCount(coverageConstraints):
+    '''
+    Function: Count the coverage constraints in the CoverageConstraints field of a prescription
+    '''
+    coverageConstraintList = []
+    for coverageConstraint in coverageConstraints.split('|'):
+        for key, rx in _TARGETVOLUME_RX_DICT.items():
+            match = rx.search(coverageConstraint)
+            if match:
+                if match.group(key).strip():
+                    coverageConstraintList.append(match.group(key))
+    return len(coverageConstraintList)
+
+def _splitOARs(organsAtRisk):
+    '''
+    Function: Split the OrgansAtRisk field of a prescription into (MeanMax, Constraints) strings per OAR
+    '''
+    if not isinstance(organsAtRisk, str):
+        return []
+    OARs = []
+    for OAR in organsAtRisk.split('Organ :')[1:]:
+        MeanMax, Constraints = _CONSTRAINTS_SPLIT_RX.split(OAR)
+        OARs.append((MeanMax, Constraints))
+    return OARs
+
+def _meanMaxConstraints(MeanMax):
+    '''
+    Function: List the non empty Mean and Max Dose constraints of an OAR
+    '''
+    meanMaxConstraints = []
+    for key, rx in _MEANMAX_RX_DICT.items():
+        match = rx.search(MeanMax)
+        if match:
+            if match.group(key).strip():
+                meanMaxConstraints.append(match.group(key))
+    return meanMaxConstraints
+
+def _prescriptionCounts(prescription):
+    '''
+    Function: Compute all the validation counts of a prescription in a single pass over its fields
+
+    Arguments:
+    prescription: Pandas Series
+        A row of the prescription DataFrame returned by read_prescription
+
+    Returns:
+    counts: dict
+        Keys 'CoverageConstraints', 'OARConstraints', 'PlanObjetives', 'ConstraintsToQualityIndexes'
+        and 'QualityIndexes'
+    '''
+    coverageConstraintCount = _coverageConstraintCount(prescription.CoverageConstraints)
+    OARConstraintCount = 0
+    MeanMaxCount, VxxCount, VxxGyCount, DxxCount = 0, 0, 0, 0
+    for MeanMax, Constraints in _splitOARs(prescription.OrgansAtRisk):
+        meanMaxConstraints = _meanMaxConstraints(MeanMax)
+        constraintList = Constraints.splitlines()
+        MeanMaxCount += len(meanMaxConstraints)
+        OARConstraintCount += len(list(filter(None, meanMaxConstraints + constraintList)))
+        for constraint in constraintList:
+            VxxCount += bool(_VXX_RX.search(constraint))
+            VxxGyCount += bool(_VXXGY_RX.search(constraint))
+            DxxCount += bool(_DXX_RX.search(constraint))
+    counts = {
+        'CoverageConstraints': coverageConstraintCount,
+        'OARConstraints': OARConstraintCount,
+        'PlanObjetives': MeanMaxCount + VxxCount - VxxGyCount + coverageConstraintCount,
+        'ConstraintsToQualityIndexes': VxxCount + DxxCount,
+        'QualityIndexes': VxxCount + DxxCount + coverageConstraintCount,
+    }
+    return counts
 
 def coverageConstraintCounting(prescriptionFile, prescriptionIndex=0):
     '''
@@ -824,26 +2982,7 @@ def coverageConstraintCounting(prescriptionFile, prescriptionIndex=0):
     '''
     prdf = read_prescription(prescriptionFile)
     pres = prdf.iloc[prescriptionIndex]
-    coverageConstraints = pres.CoverageConstraints.split('|')
-    
-    targetVolume_rx_dict = {
-    #    'targetVolume': re.compile(r'Volume / Structure :(?P<targetVolume>.*?) M'),
-        'Dmean': re.compile(r'Mean :(?P<Dmean>.*?) c?Gy'),
-        'Dmax': re.compile(r'Max Dose:(?P<Dmax>.*?) c?Gy'),
-        'Dmin': re.compile(r'Min Dose:(?P<Dmin>.*?) c?Gy'),
-        'atLeast': re.compile(r'At Least(?P<atLeast>.*?) No More Than'),
-        'noMoreThan': re.compile(r'No More Than(?P<noMoreThan>.*?)$'),
-    }
-    
-    coverageConstraintList = []
-    for coverageConstraint in coverageConstraints:
-        for key, rx in targetVolume_rx_dict.items():
-            match = rx.search(coverageConstraint)
-            if match:
-                if match.group(key).strip():
-                    coverageConstraintList.append(match.group(key))
-    
-    coverageConstraintCount = len(coverageConstraintList)
+    coverageConstraintCount = _coverageConstraintCount(pres.CoverageConstraints)
     return coverageConstraintCount
 
 def OARConstraintCounting(prescriptionFile, prescriptionIndex=0):
@@ -862,28 +3001,7 @@ def OARConstraintCounting(prescriptionFile, prescriptionIndex=0):
     '''
     prdf = read_prescription(prescriptionFile)
     prescription = prdf.iloc[prescriptionIndex]
-    
-    OARs = prescription.OrgansAtRisk.split('Organ :')[1:]
-    
-    MeanMax_rx_dict = {
-    #    'targetVolume': re.compile(r'Volume / Structure :(?P<targetVolume>.*?) M'),
-        'Mean': re.compile(r'Mean :(?P<Mean>.*?) Max Dose :'),
-        'Max': re.compile(r'Max Dose :(?P<Max>.*?c?Gy)$'),
-    }
-    
-    OARConstraints = []
-    for OAR in OARs:
-        MeanMax, Constraints = re.split(r'Constraints : \r?\n', OAR)
-        for key, rx in MeanMax_rx_dict.items():
-            match = rx.search(MeanMax)
-            if match:
-                if match.group(key).strip():
-                    OARConstraints.append(match.group(key))
-        
-        OARConstraints = OARConstraints + Constraints.splitlines()
-    
-    OARConstraints = list(filter(None, OARConstraints))
-    OARConstraintCount = len(OARConstraints)
+    OARConstraintCount = _prescriptionCounts(prescription)['OARConstraints']
     return OARConstraintCount
 
 def prescriptionPlanObjetiveCounting(prescriptionFile, prescriptionIndex=0):
@@ -901,39 +3019,8 @@ def prescriptionPlanObjetiveCounting(prescriptionFile, prescriptionIndex=0):
     Number of constraints in the prescription writable as plan objetive in the clinical protocol
     '''
     prdf = read_prescription(prescriptionFile)
-    prescription = prdf.iloc[0]
-    
-    OARs = prescription.OrgansAtRisk.split('Organ :')[1:]
-
-    MeanMax_rx_dict = {
-    #    'targetVolume': re.compile(r'Volume / Structure :(?P<targetVolume>.*?) M'),
-        'Mean': re.compile(r'Mean :(?P<Mean>.*?) Max Dose :'),
-        'Max': re.compile(r'Max Dose :(?P<Max>.*?c?Gy)$'),
-    }
-
-    rxVxx = re.compile(r'V.*?\$')
-    rxVxxGy = re.compile(r'V.*?Gy.*?\$')
-    
-    MeanMaxConstraints, VxxConstraints, VxxGyConstraints = [], [], []
-    for OAR in OARs:
-        MeanMax, Constraints = re.split(r'Constraints : \r?\n', OAR)
-        for key, rx in MeanMax_rx_dict.items():
-            match = rx.search(MeanMax)
-            if match:
-                if match.group(key).strip():
-                    MeanMaxConstraints.append(match.group(key))
-        constraintList = Constraints.splitlines()
-        for constraint in constraintList:
-            matchVxx = rxVxx.search(constraint)
-            if matchVxx:
-                VxxConstraints.append(matchVxx.string)
-    
-            matchVxxGy = rxVxxGy.search(constraint)
-            if matchVxxGy:
-                VxxGyConstraints.append(matchVxxGy.string)
-    
-    coverageConstraintCount = coverageConstraintCounting(prescriptionFile)
-    prescriptionPlanObjetiveCount = len(MeanMaxConstraints) + len(VxxConstraints) - len(VxxGyConstraints) + coverageConstraintCount
+    prescription = prdf.iloc[prescriptionIndex]
+    prescriptionPlanObjetiveCount = _prescriptionCounts(prescription)['PlanObjetives']
     return prescriptionPlanObjetiveCount
     
 def prescriptionConstraintsToQualityIndexesCounting(prescriptionFile, prescriptionIndex=0):
@@ -953,28 +3040,8 @@ def prescriptionConstraintsToQualityIndexesCounting(prescriptionFile, prescripti
     Number of constraints in the prescription writable as quality indexes in the clinical protocol
     '''
     prdf = read_prescription(prescriptionFile)
-    prescription = prdf.iloc[0]
-    
-    OARs = prescription.OrgansAtRisk.split('Organ :')[1:]
-
-    rxVxx = re.compile(r'V.*?\$')
-    rxDxx = re.compile(r'D.*?\$')
-    
-    VxxConstraints, DxxConstraints = [], []
-    for OAR in OARs:
-        MeanMax, Constraints = re.split(r'Constraints : \r?\n', OAR)
-        constraintList = Constraints.splitlines()
-        for constraint in constraintList:
-            matchVxx = rxVxx.search(constraint)
-            if matchVxx:
-                VxxConstraints.append(matchVxx.string)
-    
-            matchDxx = rxDxx.search(constraint)
-            if matchDxx:
-                DxxConstraints.append(matchDxx.string)
-    
-
-    prescriptionConstraintsToQualityIndexesCount = len(VxxConstraints + DxxConstraints)
+    prescription = prdf.iloc[prescriptionIndex]
+    prescriptionConstraintsToQualityIndexesCount = _prescriptionCounts(prescription)['ConstraintsToQualityIndexes']
     return prescriptionConstraintsToQualityIndexesCount
 
 def prescriptionQualityIndexCounting(prescriptionFile, prescriptionIndex=0):
@@ -993,12 +3060,28 @@ def prescriptionQualityIndexCounting(prescriptionFile, prescriptionIndex=0):
     prescriptionQualityIndexCount: Integer
     Number of quality indexes to be written in the clinical protocol
     '''
-
-    prescriptionConstraintsToQualityIndexesCount = prescriptionConstraintsToQualityIndexesCounting(prescriptionFile)
-    coverageConstraintCount = coverageConstraintCounting(prescriptionFile)
-    prescriptionQualityIndexCount = prescriptionConstraintsToQualityIndexesCount + coverageConstraintCount
+    prdf = read_prescription(prescriptionFile)
+    prescription = prdf.iloc[prescriptionIndex]
+    prescriptionQualityIndexCount = _prescriptionCounts(prescription)['QualityIndexes']
     return prescriptionQualityIndexCount
 
+def _clinicalProtocolPrescriptionCounts(clinicalProtocol):
+    '''
+    Function: Count the Items and MeasureItems of the prescription section of a clinical protocol with a single parse
+
+    Returns:
+    itemCount, measureItemCount: Integer
+    '''
+    if isinstance(clinicalProtocol, ClinicalProtocol):
+        Prescription = clinicalProtocol.prescription
+    else:
+        if not isinstance(clinicalProtocol, ET.ElementTree):
+            clinicalProtocol = parseProt(clinicalProtocol)
+        Prescription = clinicalProtocol.find('Phases').find('Phase').find('Prescription')
+    itemCount = len(Prescription.findall('Item'))
+    measureItemCount = len(Prescription.findall('MeasureItem'))
+    return itemCount, measureItemCount
+
 def clinicalProtocolPrescriptionItemCounting(clinicalProtocol='ClinicalProtocol.xml'):
     '''
     Function: clinicalProtocolPrescriptionItemCounting
@@ -1030,40 +3113,302 @@ def clinicalProtocolPrescriptionQualityIndexCounting(clinicalProtocol='ClinicalP
     clinicalProtocolPrescriptionQualityIndexCount = len(cpet.find('Phases').find('Phase').find('Prescription').findall('MeasureItem'))
     return clinicalProtocolPrescriptionQualityIndexCount
 
+class ValidationReport:
+    '''
+    Class: ValidationReport
+        Validation counts of every prescription in an ARIA prescription export.
+        The export is read once and all the counts of every prescription are computed in a single pass
+
+    Arguments:
+    prescriptionFile: Path file or buffer
+        File containing the prescription(s). Exported from ARIA in csv format
+
+    Attributes:
+    counts: Pandas DataFrame
+        One row per prescription index with columns ['PrescriptionName', 'CoverageConstraints',
+        'OARConstraints', 'PlanObjetives', 'ConstraintsToQualityIndexes', 'QualityIndexes']
+    '''
+    def __init__(self, prescriptionFile):
+        self.prescriptionFile = prescriptionFile
+        prdf = read_prescription(prescriptionFile)
+        rows = []
+        for prescription in prdf.itertuples(index=False):
+            counts = _prescriptionCounts(prescription)
+            counts['PrescriptionName'] = getattr(prescription, 'PrescriptionName', '')
+            rows.append(counts)
+        self.counts = pd.DataFrame(rows, columns=['PrescriptionName', 'CoverageConstraints', 'OARConstraints',
+                                                  'PlanObjetives', 'ConstraintsToQualityIndexes', 'QualityIndexes'])
+        self.counts.index.name = 'PrescriptionIndex'
+
+    def compare(self, clinicalProtocols):
+        '''
+        Method: Compare the expected counts with the Items and MeasureItems of generated clinical protocols
+
+        Arguments:
+        clinicalProtocols: Path file, list or dict
+            A clinical protocol (path, element tree or ClinicalProtocol) for the first prescription,
+            a list of them in prescription order or a dict {prescriptionIndex: clinical protocol}
+
+        Returns:
+        comparisondf: Pandas DataFrame
+            One row per compared prescription with the expected and written plan objetives (Items)
+            and quality indexes (MeasureItems) and whether they match
+        '''
+        if isinstance(clinicalProtocols, dict):
+            clinicalProtocols = clinicalProtocols.items()
+        elif isinstance(clinicalProtocols, (list, tuple)):
+            clinicalProtocols = enumerate(clinicalProtocols)
+        else:
+            clinicalProtocols = [(0, clinicalProtocols)]
+
+        rows = []
+        for prescriptionIndex, clinicalProtocol in clinicalProtocols:
+            itemCount, measureItemCount = _clinicalProtocolPrescriptionCounts(clinicalProtocol)
+            expected = self.counts.loc[prescriptionIndex]
+            rows.append({
+                'PrescriptionIndex': prescriptionIndex,
+                'ClinicalProtocol': clinicalProtocol if isinstance(clinicalProtocol, (str, os.PathLike)) else '',
+                'PlanObjetives': expected.PlanObjetives,
+                'Items': itemCount,
+                'ItemsMatch': expected.PlanObjetives == itemCount,
+                'QualityIndexes': expected.QualityIndexes,
+                'MeasureItems': measureItemCount,
+                'MeasureItemsMatch': expected.QualityIndexes == measureItemCount,
+            })
+        comparisondf = pd.DataFrame(rows)
+        return comparisondf
+
 '''
     Contouring
 '''
 
-def readContouringStructureNames(rsdicom):
+def _readStructureSetHeader(rsdicom, headerOnly=True, tags=_RS_HEADER_TAGS):
+    '''
+    Function: Read a RT Dicom structure set. If headerOnly, only the given tags are parsed
+        and the ROIContourSequence with the contour points is skipped
+    '''
+    if hasattr(rsdicom, 'seek'):
+        rsdicom.seek(0)
+    if headerOnly:
+        dcmds = dcm.dcmread(rsdicom, specific_tags=tags)
+    else:
+        dcmds = dcm.dcmread(rsdicom)
+    return dcmds
+
+def readContouringStructures(rsdicom, headerOnly=True):
+    '''
+    Function: Read the ROI description of a RT Dicom structure set file without reading its contour data
+
+    Arguments:
+    rsdicom: String or file-like object
+        File Path to the RT Dicom structure set
+    headerOnly: Boolean
+        If True (default) the ROIContourSequence is skipped. If False the full file is read
+
+    Return:
+        strdf: Pandas DataFrame
+        A DataFrame with columns ['ROINumber', 'ROIName', 'RTROIInterpretedType'], one row per structure
+    '''
+    dcmds = _readStructureSetHeader(rsdicom, headerOnly=headerOnly)
+    observationTypes = {int(observation.ReferencedROINumber): observation.get('RTROIInterpretedType', '')
+                        for observation in dcmds.get('RTROIObservationsSequence', [])}
+    strdf = pd.DataFrame([{'ROINumber': int(structure.ROINumber),
+                           'ROIName': structure.ROIName,
+                           'RTROIInterpretedType': observationTypes.get(int(structure.ROINumber), '')}
+                          for structure in dcmds.StructureSetROISequence],
+                         columns=['ROINumber', 'ROIName', 'RTROIInterpretedType'])
+    return strdf
+
+def readContouringStructureNames(rsdicom, headerOnly=True):
     '''
     Function: Read RT Dicom structure set file and generate a list of structure names
 
     Arguments:
     rsdicom: String
         File Path to the RT Dicom structure set
+    headerOnly: Boolean
+        If True (default) the contour data is not read. If False the full file is read
 
     Return:
         constrnames: list
         A list of the structure names given in ARIA
     '''
-    dcmds = dcm.dcmread(rsdicom)
+    dcmds = _readStructureSetHeader(rsdicom, headerOnly=headerOnly, tags=['StructureSetROISequence'])
     strsetsq = dcmds.StructureSetROISequence
     contstrnames = [structure.ROIName for structure in strsetsq]
     return contstrnames
 
-def readClinProtStructureNames(clinprot):
+_STRUCTURE_VOLUME_COLUMNS = ['ROINumber', 'ROIName', 'Volume', 'CentroidX', 'CentroidY', 'CentroidZ',
+                             'MinX', 'MaxX', 'MinY', 'MaxY', 'MinZ', 'MaxZ', 'Slices', 'Contours', 'SliceThickness']
+
+def _contourDataBytes(contour):
+    '''
+    Function: ContourData of a contour as DS bytes. Values not yet converted by pydicom are taken raw
+    '''
+    element = contour.get_item('ContourData')
+    if element is None:
+        return b''
+    if isinstance(element, dcm.dataelem.RawDataElement):
+        return element.value.strip(b' \x00')
+    return '\\'.join(str(value) for value in element.value).encode()
+
+def readStructureVolumes(rsdicom, ROINames=None, SliceThickness=None):
+    '''
+    Function: Volume, centroid and bounding box of the structures of a RT Dicom structure set
+
+    Arguments:
+    rsdicom: String or file-like object
+        File Path to the RT Dicom structure set
+    ROINames: List of String or None
+        Structures to compute. Default None, every structure. The contour data of the other structures is not converted
+    SliceThickness: Float or None
+        Slice spacing in mm. Default None, the median spacing between the contoured planes of each structure
+
+    Return:
+        strvoldf: Pandas DataFrame
+        One row per structure with columns ['ROINumber', 'ROIName', 'Volume' (cc), 'CentroidX', 'CentroidY',
+        'CentroidZ', 'MinX', 'MaxX', 'MinY', 'MaxY', 'MinZ', 'MaxZ' (mm), 'Slices', 'Contours', 'SliceThickness' (mm)].
+        Only CLOSED_PLANAR contours are taken into account. The area of each plane is the sum of the signed
+        shoelace areas of its contours, so holes contoured in the opposite direction, as Eclipse exports them,
+        are subtracted. Structures without contours or with a single plane and no SliceThickness have Volume NaN
+    '''
+    dcmds = _readStructureSetHeader(rsdicom, headerOnly=False)
+    strdf = pd.DataFrame([(int(structure.ROINumber), structure.ROIName)
+                          for structure in dcmds.StructureSetROISequence], columns=['ROINumber', 'ROIName'])
+    if ROINames is not None:
+        missing = set(ROINames) - set(strdf.ROIName)
+        if missing:
+            raise KeyError(f"Estructuras no encontradas: {', '.join(sorted(missing))}")
+        strdf = strdf[strdf.ROIName.isin(ROINames)].reset_index(drop=True)
+    roiIndex = {ROINumber: index for index, ROINumber in enumerate(strdf.ROINumber)}
+
+    # Todos los contornos de las estructuras pedidas se convierten de una vez
+    contourData, contourROIs = [], []
+    for roiContour in dcmds.get('ROIContourSequence', []):
+        index = roiIndex.get(int(roiContour.ReferencedROINumber))
+        if index is None:
+            continue
+        for contour in roiContour.get('ContourSequence', []):
+            if contour.get('ContourGeometricType', 'CLOSED_PLANAR') != 'CLOSED_PLANAR':
+                continue
+            data = _contourDataBytes(contour)
+            if data:
+                contourData.append(data)
+                contourROIs.append(index)
+    nROIs = len(strdf)
+    strvoldf = strdf.reindex(columns=_STRUCTURE_VOLUME_COLUMNS)
+    strvoldf[['Slices', 'Contours']] = 0
+    if not contourData:
+        return strvoldf
+
+    pointCounts = np.array([data.count(b'\\') + 1 for data in contourData]) // 3
+    # Conversión de texto DS a float de todos los contornos a la vez
+    values = np.fromstring(b'\\'.join(contourData).decode('ascii'), sep='\\')
+    if len(values) != 3 * pointCounts.sum():
+        raise ValueError('ContourData con valores no numéricos o incompletos')
+    points = values.reshape(-1, 3)
+    contourROIs = np.array(contourROIs)
+    starts = np.concatenate(([0], np.cumsum(pointCounts)[:-1]))
+    # Índice del punto siguiente de cada contorno, cerrando el polígono
+    following = np.arange(len(points)) + 1
+    following[starts + pointCounts - 1] = starts
+    x, y, z = points.T
+    cross = x * y[following] - x[following] * y
+    signedAreas = np.add.reduceat(cross, starts) / 2
+    momentsX = np.add.reduceat((x + x[following]) * cross, starts) / 6
+    momentsY = np.add.reduceat((y + y[following]) * cross, starts) / 6
+
+    # Planos de cada estructura: el área con signo de los contornos del mismo plano se suma
+    planeKeys, planes = np.unique(np.column_stack((contourROIs, np.round(z[starts], 3))), axis=0, return_inverse=True)
+    planes = planes.ravel()
+    planeROIs, planeZ = planeKeys[:, 0].astype(int), planeKeys[:, 1]
+    planeSigns = np.sign(np.bincount(planes, signedAreas))
+    planeAreas = np.abs(np.bincount(planes, signedAreas))
+    planeMomentsX = np.bincount(planes, momentsX) * planeSigns
+    planeMomentsY = np.bincount(planes, momentsY) * planeSigns
+
+    if SliceThickness is None:
+        sameROI = planeROIs[1:] == planeROIs[:-1]
+        thickness = pd.Series(np.diff(planeZ)[sameROI]).groupby(planeROIs[1:][sameROI]).median()
+        thickness = thickness.reindex(range(nROIs)).to_numpy()
+    else:
+        thickness = np.full(nROIs, float(SliceThickness))
+    areas = np.bincount(planeROIs, planeAreas, minlength=nROIs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        strvoldf['Volume'] = np.where(areas > 0, areas * thickness / 1000, np.nan)
+        strvoldf['CentroidX'] = np.bincount(planeROIs, planeMomentsX, minlength=nROIs) / areas
+        strvoldf['CentroidY'] = np.bincount(planeROIs, planeMomentsY, minlength=nROIs) / areas
+        strvoldf['CentroidZ'] = np.bincount(planeROIs, planeAreas * planeZ, minlength=nROIs) / areas
+
+    # Caja envolvente con los puntos ordenados por estructura
+    order = np.argsort(np.repeat(contourROIs, pointCounts), kind='stable')
+    sortedPoints = points[order]
+    pointROIs = np.repeat(contourROIs, pointCounts)[order]
+    contoured, roiStarts = np.unique(pointROIs, return_index=True)
+    for axis, name in enumerate(['X', 'Y', 'Z']):
+        strvoldf.loc[contoured, 'Min' + name] = np.minimum.reduceat(sortedPoints[:, axis], roiStarts)
+        strvoldf.loc[contoured, 'Max' + name] = np.maximum.reduceat(sortedPoints[:, axis], roiStarts)
+    strvoldf['Slices'] = np.bincount(planeROIs, minlength=nROIs)
+    strvoldf['Contours'] = np.bincount(contourROIs, minlength=nROIs)
+    strvoldf['SliceThickness'] = thickness
+    return strvoldf
+
+def readStructureVolume(rsdicom, ROIName, SliceThickness=None):
+    '''
+    Function: Volume of a single structure of a RT Dicom structure set, see readStructureVolumes
+
+    Return:
+        Volume: Float
+        The structure volume in cc
+    '''
+    return float(readStructureVolumes(rsdicom, ROINames=[ROIName], SliceThickness=SliceThickness).Volume.iloc[0])
+
+def dosimParVolumes(oardf, strvoldf):
+    '''
+    Function: Absolute and relative volumes of the dosimetric parameters of the organs at risk of a patient
+
+    Arguments:
+    oardf: Pandas DataFrame
+        Organs at risk with columns 'Organ' and 'DosimPars', see parse_prescription
+    strvoldf: Pandas DataFrame
+        Structure volumes of the patient, see readStructureVolumes. Organs are matched to structures by name
+        and, failing that, by normalized name (see normalizeStrName)
+
+    Return:
+        dosimvoldf: Pandas DataFrame
+        One row per dosimetric parameter with the parseDosimPars columns and 'Organ', 'ROIName', 'ROIVolume',
+        'VolumeCC' and 'VolumePercentage'. Parameters of organs without structure have NaN volumes
+    '''
+    dosimvoldf = oarDosimPars(oardf).reset_index(drop=True)
+
+    ROINames = dict(zip(strvoldf.ROIName, strvoldf.ROIName))
+    for ROIName in strvoldf.ROIName:
+        ROINames.setdefault(normalizeStrName(ROIName), ROIName)
+    organs = pd.Series(dosimvoldf.Organ.unique())
+    organROIs = dict(zip(organs, [ROINames.get(organ, ROINames.get(normalizeStrName(organ))) for organ in organs]))
+    dosimvoldf['ROIName'] = dosimvoldf.Organ.map(organROIs)
+    dosimvoldf['ROIVolume'] = dosimvoldf.ROIName.map(strvoldf.drop_duplicates('ROIName').set_index('ROIName').Volume)
+    relative = (dosimvoldf.VolumeUnits == '%').to_numpy()
+    dosimvoldf['VolumeCC'] = np.where(relative, dosimvoldf.Volume * dosimvoldf.ROIVolume / 100, dosimvoldf.Volume)
+    dosimvoldf['VolumePercentage'] = np.where(relative, dosimvoldf.Volume,
+                                              dosimvoldf.Volume / dosimvoldf.ROIVolume * 100)
+    return dosimvoldf
+
+def readClinProtStructureNames(clinprot, backend=None):
     '''
     Function: Read the structure names in the clinical protocol xml file
 
     Arguments:
     clinprot: String
         File Path to the clinical protocol xml file
+    backend: String (None [Default], 'lxml', 'etree')
+        XML backend. None uses lxml when it is installed
 
     Return:
         protstrnames: list
         A list of the structure names given in the clinical protocol xml file
     '''
-    tree = ET.parse(clinprot)
+    tree = xmlBackend(backend).parse(clinprot)
     root = tree.getroot()
     structures = root.find('StructureTemplate').find('Structures')
     protstrnames = [structure.get('ID') for structure in structures.findall('Structure')]
@@ -1087,7 +3432,107 @@ def checkStructureNameLength(strnames):
             invalidStrNames.append(strname)
     return invalidStrNames
 
-def _suggestStrNames(strlistA, strlistB):
+_LATERALITY_SUFFIXES = {
+    **dict.fromkeys(['l', 'i', 'izq', 'izqdo', 'izqda', 'izquierdo', 'izquierda', 'left', 'lt'], 'l'),
+    **dict.fromkeys(['r', 'd', 'dch', 'dcho', 'dcha', 'der', 'derecho', 'derecha', 'right', 'rt'], 'r'),
+}
+_STRNAME_SPLIT_RX = re.compile(r'[\s_\-\./]+')
+
+def normalizeStrName(strName):
+    '''
+    Function: Normalize a structure name for matching: casefold, strip accents, unify separators
+        and laterality suffixes (_L, I, Izqdo, Izqda... -> l; _R, D, Dcho, Dcha... -> r)
+
+    Arguments:
+    strName: String
+        Structure name
+
+    Return:
+        normStrName: String
+        The normalized structure name, e.g. 'Pulmón Izqdo' and 'Pulmon_I' -> 'pulmon l'
+    '''
+    normStrName = unicodedata.normalize('NFKD', str(strName).casefold())
+    normStrName = ''.join(c for c in normStrName if not unicodedata.combining(c))
+    tokens = [token for token in _STRNAME_SPLIT_RX.split(normStrName) if token]
+    if len(tokens) > 1 and tokens[-1] in _LATERALITY_SUFFIXES:
+        tokens[-1] = _LATERALITY_SUFFIXES[tokens[-1]]
+    normStrName = ' '.join(tokens)
+    return normStrName
+
+class StrNameMatcher:
+    '''
+    Class: StrNameMatcher
+        Structure name matcher. Reference names are normalized with normalizeStrName and indexed by
+        character n-grams. A query is compared with ratcliff_obershelp only against the shortlist of
+        reference names sharing the most n-grams with it
+
+    Arguments:
+    strNames: List
+        Reference structure names
+    n: Integer
+        n-gram length. Default 3
+    shortlist: Integer
+        Minimum number of candidates scored per query. Default 20
+    '''
+    def __init__(self, strNames, n=3, shortlist=20):
+        self.strNames = list(dict.fromkeys(strName for strName in strNames if isinstance(strName, str)))
+        self.normStrNames = [normalizeStrName(strName) for strName in self.strNames]
+        self.n = n
+        self.shortlist = shortlist
+        self._index = collections.defaultdict(list)
+        self._ngramCounts = []
+        for position, normStrName in enumerate(self.normStrNames):
+            ngrams = self._ngrams(normStrName)
+            self._ngramCounts.append(len(ngrams))
+            for ngram in ngrams:
+                self._index[ngram].append(position)
+
+    def _ngrams(self, normStrName):
+        padded = ' ' * (self.n - 1) + normStrName + ' '
+        return set(padded[i:i + self.n] for i in range(len(padded) - self.n + 1))
+
+    def match(self, strName, k=1):
+        '''
+        Method: Retrieve the k reference names closest to strName
+
+        Return:
+            matches: List
+            List of (reference name, score) tuples sorted by decreasing score, score in [0, 1]
+        '''
+        normStrName = normalizeStrName(strName)
+        ngrams = self._ngrams(normStrName)
+        shared = collections.Counter()
+        for ngram in ngrams:
+            shared.update(self._index.get(ngram, ()))
+        if shared:
+            # Candidatos ordenados por coeficiente de Dice de sus n-gramas
+            dice = {position: count / (len(ngrams) + self._ngramCounts[position]) for position, count in shared.items()}
+            candidates = sorted(dice, key=dice.get, reverse=True)[:max(self.shortlist, k)]
+        else:
+            candidates = []
+        if len(candidates) < k or not candidates:
+            # Sin suficientes n-gramas comunes: se completa con el resto de nombres de referencia
+            candidates = candidates + [position for position in range(len(self.strNames)) if position not in shared]
+        scores = [(self.strNames[position], ratcliff_obershelp(normStrName, self.normStrNames[position]))
+                  for position in candidates]
+        scores.sort(key=lambda score: score[1], reverse=True)
+        return scores[:k]
+
+    def matchAll(self, strNames, k=1):
+        '''
+        Method: Retrieve the k reference names closest to each name in strNames
+
+        Return:
+            matchdf: Pandas DataFrame
+            Long-form DataFrame with columns ['Structure', 'Rank', 'Suggestion', 'Score']
+        '''
+        rows = [{'Structure': strName, 'Rank': rank, 'Suggestion': suggestion, 'Score': score}
+                for strName in strNames
+                for rank, (suggestion, score) in enumerate(self.match(strName, k=k), start=1)]
+        matchdf = pd.DataFrame(rows, columns=['Structure', 'Rank', 'Suggestion', 'Score'])
+        return matchdf
+
+def _suggestStrNames(strlistA, strlistB, k=1):
     '''
     Function: Suggest changes in a list of structure names based on the names of the other list 
 
@@ -1098,19 +3543,19 @@ def _suggestStrNames(strlistA, strlistB):
     strlistB: List
         Structure name list taken as reference
 
+    k: Integer
+        Number of suggestions per structure. Default 1
+
     Return:
         suggestiondf: Pandas DataFrame
-        A pandas DataFrame which index is the names of the structures to be corrected and its column is the structure name suggested
-    '''
-    infstrdf = pd.DataFrame([{strB: ratcliff_obershelp(strA, strB) 
-                              for strB in strlistB} 
-                                for strA in strlistA], index=strlistA)
-    infstrdf['Suggestion'] = infstrdf.idxmax(axis=1)
-    suggestiondf = pd.DataFrame(infstrdf['Suggestion'])
-    suggestiondf.reset_index(names='Structure', inplace=True)
+        A pandas DataFrame with columns ['Structure', 'Suggestion', 'Score'] with the structures to be corrected
+        and the suggested structure names. With k > 1 there are k rows per structure, best first
+    '''
+    matchdf = StrNameMatcher(strlistB).matchAll(strlistA, k=k)
+    suggestiondf = matchdf[['Structure', 'Suggestion', 'Score']].reset_index(drop=True)
     return suggestiondf
 
-def suggestStrNames(clinprot, rsdicom):
+def suggestStrNames(clinprot, rsdicom, k=1):
     '''
     Function: Suggest changes in a list of structure names based on the names of the other list 
 
@@ -1121,29 +3566,281 @@ def suggestStrNames(clinprot, rsdicom):
     rsdicom: String
         File Path to the RT Dicom containing the reference structure set
 
+    k: Integer
+        Number of suggestions per structure. Default 1
+
     Return:
         suggestiondf: Pandas DataFrame
-        A pandas DataFrame which index is the names of the structures to be corrected and its column is the structure name suggested
+        A pandas DataFrame with columns ['Structure', 'Suggestion', 'Score']. See _suggestStrNames
     '''
 
     protstrnames = readClinProtStructureNames(clinprot)
     contstrnames = readContouringStructureNames(rsdicom)
-    invalidStrNames = checkStructureNameLength(contstrnames)
+    # Se informa de todos los nombres demasiado largos de ambas listas a la vez (ver StrNameRules)
+    invalidStrNames = checkStructureNameLength(contstrnames) + checkStructureNameLength(protstrnames)
     sep = ', '
     if invalidStrNames:
         raise NameError('''
         The following structures are more than 16 characters long
         which is not allowed for the clinical protocol definition.\n
-        ''' + sep.join(invalidStrNames))
-    invalidStrNames = checkStructureNameLength(protstrnames)
-    if invalidStrNames:
-        raise NameError('''
-        The following structures are more than 16 characters long
-        which is not allowed for the clinical protocol definition
-        ''' + sep.join(invalidStrNames))
-    suggestiondf = _suggestStrNames(protstrnames, contstrnames)
+        ''' + sep.join(dict.fromkeys(invalidStrNames)))
+    suggestiondf = _suggestStrNames(protstrnames, contstrnames, k=k)
     return suggestiondf
 
+@dataclasses.dataclass(slots=True, frozen=True)
+class StrNameRule:
+    '''
+    Class: StrNameRule
+        Declarative structure name rule, evaluated by StrNameRules
+
+    Arguments:
+    Rule: String
+        Rule name reported in the violations table
+    Kind: String
+        'length': names longer than Value characters
+        'pattern': names that do not fully match the regular expression Value
+        'forbidden': names where the regular expression Value is found
+        'duplicate': names that normalize (see normalizeStrName) to the same form as another name of the source
+        'dictionary': names that are not target names of the translation dictionary
+    Value: Integer or String
+        Maximum length or regular expression. Patterns should stay within the syntax shared by re and RE2
+        so that pandas can evaluate them with pyarrow
+    Severity: String
+        'error' or 'warning'
+    Message: String
+        Explanation reported in the violations table
+    '''
+    Rule: str
+    Kind: str
+    Value: object = None
+    Severity: str = 'error'
+    Message: str = ''
+
+# Sufijos de lateralidad distintos de los _L y _R de TG-263
+_LATERALITY_RX = (r'[\s_\-\.](?i:' + '|'.join(sorted(set(_LATERALITY_SUFFIXES) - {'l', 'r'}, key=len, reverse=True))
+                  + r')$|[\s\-\.][LlRr]$|_[lr]$')
+
+STRNAME_RULES = [
+    StrNameRule('MaxLength', 'length', 16, 'error', 'More than 16 characters, not allowed in ARIA clinical protocols'),
+    StrNameRule('Characters', 'pattern', r'[A-Za-z0-9_^~\-\.]+', 'warning',
+                'TG-263 names only use A-Z, a-z, 0-9 and _ ^ ~ - .'),
+    StrNameRule('Casing', 'pattern', r'[A-Z0-9].*', 'warning', 'TG-263 names start with a capital letter or a digit'),
+    StrNameRule('Laterality', 'forbidden', _LATERALITY_RX, 'warning', 'TG-263 laterality suffixes are _L and _R'),
+    StrNameRule('Duplicate', 'duplicate', None, 'error', 'Same normalized name as'),
+    StrNameRule('Dictionary', 'dictionary', None, 'warning', 'Not in the translation dictionary'),
+]
+
+# Nombres citados como máximo en el mensaje de un duplicado
+_DUPLICATE_NAMES_CITED = 5
+
+def readStructureNames(file):
+    '''
+    Function: Structure names of a RT structure set (.dcm), a clinical protocol or contouring template (.xml)
+        or a prescription export (.csv)
+
+    Arguments:
+    file: String
+        File path. For prescription exports, the target volumes and organs at risk of every prescription
+
+    Return:
+        strnames: list
+        The structure names, without repetitions in the case of prescription exports
+    '''
+    extension = os.path.splitext(str(file))[1].lower()
+    if extension == '.dcm':
+        return readContouringStructureNames(file)
+    if extension == '.xml':
+        # Las plantillas de contorneo tienen StructureTemplate como raíz
+        with open(file, 'rb') as f:
+            _, root = next(ET.iterparse(f, events=('start',)))
+        if root.tag == 'StructureTemplate':
+            return [structureElement.get('ID') for structureElement in
+                    parseProt(file).getroot().iterfind('Structures/Structure')]
+        return readClinProtStructureNames(file)
+    if extension == '.csv':
+        strnames = {}
+        for prescription in parse_prescription_ir(file):
+            strnames.update(dict.fromkeys(targetVolume.Volume for targetVolume in prescription.TargetVolumes))
+            strnames.update(dict.fromkeys(prescription.OrgansAtRisk))
+        return list(strnames)
+    raise ValueError(f'Tipo de fichero no reconocido: {file}')
+
+class StrNameRules:
+    '''
+    Class: StrNameRules
+        Structure name compliance checks. The rules are compiled once; every check evaluates each rule over all
+        the distinct names at once with pandas string methods, and returns every violation instead of stopping
+        at the first one.
+        The 'duplicate' and 'dictionary' rules need normalizeStrName and StrNameTranslator.translateName, which
+        are Python functions. Their results are cached by the instance, seeded with the dictionary names, so
+        each distinct name is evaluated in Python only the first time any check sees it
+
+    Arguments:
+    rules: list of StrNameRule
+        Rules to check. Default STRNAME_RULES
+    dictionary: String, DataFrame, dict or None
+        Translation dictionary for the 'dictionary' rules, see StrNameTranslator. Default DICTIONARY_FILE,
+        tools/Diccionario.csv of the repository
+    '''
+    def __init__(self, rules=None, dictionary=DICTIONARY_FILE):
+        self.rules = list(STRNAME_RULES if rules is None else rules)
+        for rule in self.rules:
+            if rule.Kind not in ('length', 'pattern', 'forbidden', 'duplicate', 'dictionary'):
+                raise ValueError(f'Tipo de regla desconocido: {rule.Kind}')
+            if rule.Kind in ('pattern', 'forbidden'):
+                # Un patrón incorrecto falla aquí y no en cada comprobación
+                re.compile(rule.Value)
+        self.translator = None
+        self.dictionaryNames = frozenset()
+        if dictionary is not None and any(rule.Kind == 'dictionary' for rule in self.rules):
+            self.translator = StrNameTranslator(dictionary)
+            self.dictionaryNames = self.translator.names
+        self._normalized = {New: normalizeStrName(New) for New in self.dictionaryNames}
+        self._translations = {}
+
+    def _lookup(self, cache, function, names):
+        '''
+        Method: Values of a function for the distinct names, through one of the caches of the instance.
+            Only the names not yet in the cache are evaluated
+        '''
+        values = names.map(cache).to_numpy(dtype=object)
+        missing = pd.isna(values)
+        if missing.any():
+            computed = [function(name) for name in names[missing]]
+            cache.update(zip(names[missing], computed))
+            values[missing] = computed
+        return values
+
+    def _duplicateMessages(self, rule, groups, codes, uniques):
+        '''
+        Method: Message of each name of the duplicate groups. The message cites the other distinct names of
+            the group, with their count when repeated, up to _DUPLICATE_NAMES_CITED names
+        '''
+        if not len(groups):
+            return np.zeros(0, dtype=object)
+        # Pares (grupo, nombre) distintos, ordenados por grupo y por orden de aparición del nombre
+        pairs, inverse, counts = np.unique(groups.astype(np.int64) * len(uniques) + codes,
+                                           return_inverse=True, return_counts=True)
+        pairGroups, pairCodes = np.divmod(pairs, len(uniques))
+        messages = np.empty(len(pairs), dtype=object)
+        bounds = np.flatnonzero(np.diff(pairGroups)) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(pairs)]):
+            entries = list(zip(pairCodes[start:stop].tolist(), counts[start:stop].tolist()))
+            for position, (code, count) in enumerate(entries):
+                # El propio nombre se cita solo si se repite, y por sus demás apariciones
+                others = len(entries) - (count == 1)
+                cited = [(otherCode, otherCount - (otherCode == code))
+                         for otherCode, otherCount in entries[:_DUPLICATE_NAMES_CITED + 1]
+                         if otherCode != code or otherCount > 1][:_DUPLICATE_NAMES_CITED]
+                text = ', '.join(uniques[otherCode] if otherCount == 1 else f'{uniques[otherCode]} (x{otherCount})'
+                                 for otherCode, otherCount in cited)
+                if others > len(cited):
+                    text += f' and {others - len(cited)} more'
+                messages[start + position] = f'{rule.Message} {text}'
+        return messages[inverse.ravel()]
+
+    def _violations(self, rule, names):
+        '''
+        Method: Boolean mask of the distinct names violating a rule, and the message of each violation
+        '''
+        if rule.Kind == 'length':
+            return (names.str.len() > rule.Value).to_numpy(dtype=bool), rule.Message
+        if rule.Kind == 'pattern':
+            return ~names.str.fullmatch(rule.Value).to_numpy(dtype=bool), rule.Message
+        if rule.Kind == 'forbidden':
+            return names.str.contains(rule.Value, regex=True).to_numpy(dtype=bool), rule.Message
+        if rule.Kind == 'dictionary':
+            mask = ~names.isin(self.dictionaryNames).to_numpy(dtype=bool)
+            if self.translator is None:
+                return np.zeros(len(names), dtype=bool), rule.Message
+            # Si el diccionario conoce el nombre, el mensaje incluye su traducción ('' si no la tiene)
+            translations = self._lookup(self._translations, lambda name: self.translator.translateName(name) or '',
+                                        names[mask])
+            messages = pd.Series(rule.Message, index=names.index, dtype=object)
+            messages[mask] = [f'{rule.Message}: translate to {New}' if New else rule.Message
+                              for New in translations]
+            return mask, messages.to_numpy()
+        raise ValueError(rule.Kind)
+
+    def check(self, names):
+        '''
+        Method: Check structure names against the rules
+
+        Arguments:
+        names: list of String, dict or DataFrame
+            Names of a single source, {source: names} or a DataFrame with columns 'Source' and 'Name',
+            e.g. the ROIs of every structure set of a StructureSetArchive (see StructureSetArchive.structureNames)
+
+        Returns:
+        violationsdf: Pandas DataFrame
+            One row per violation with columns ['Source', 'Name', 'Rule', 'Severity', 'Message'],
+            in the order of the names and of the rules
+        '''
+        if isinstance(names, pd.DataFrame):
+            namesdf = names[['Source', 'Name']].reset_index(drop=True)
+        elif isinstance(names, dict):
+            namesdf = pd.DataFrame([(source, name) for source, sourceNames in names.items() for name in sourceNames],
+                                   columns=['Source', 'Name'])
+        else:
+            namesdf = pd.DataFrame({'Source': '', 'Name': list(names)}, columns=['Source', 'Name'])
+        namesdf['Name'] = namesdf.Name.fillna('').astype(str)
+
+        # Cada regla se evalúa una sola vez por nombre distinto
+        codes, uniques = pd.factorize(namesdf.Name)
+        uniqueNames = pd.Series(uniques, dtype='str')
+        ruleRows, ruleMessages = [], []
+        for rule in self.rules:
+            if rule.Kind == 'duplicate':
+                normalized = self._lookup(self._normalized, normalizeStrName, uniqueNames)[codes]
+                groups = pd.DataFrame({'Source': namesdf.Source, 'Normalized': normalized}) \
+                    .groupby(['Source', 'Normalized'], sort=False).ngroup().to_numpy()
+                rows = np.flatnonzero(np.bincount(groups)[groups] > 1)
+                ruleRows.append(rows)
+                ruleMessages.append(self._duplicateMessages(rule, groups[rows], codes[rows], uniques))
+                continue
+            mask, messages = self._violations(rule, uniqueNames)
+            rows = np.flatnonzero(mask[codes])
+            ruleRows.append(rows)
+            ruleMessages.append(messages[codes[rows]] if isinstance(messages, np.ndarray)
+                                else np.full(len(rows), messages, dtype=object))
+
+        ruleIndices = np.repeat(np.arange(len(self.rules)), [len(rows) for rows in ruleRows])
+        rows = np.concatenate(ruleRows) if ruleRows else np.zeros(0, dtype=int)
+        order = np.lexsort((ruleIndices, rows))
+        rows, ruleIndices = rows[order], ruleIndices[order]
+        violationsdf = pd.DataFrame({
+            'Source': namesdf.Source.to_numpy()[rows],
+            'Name': namesdf.Name.to_numpy()[rows],
+            'Rule': np.array([rule.Rule for rule in self.rules], dtype=object)[ruleIndices],
+            'Severity': np.array([rule.Severity for rule in self.rules], dtype=object)[ruleIndices],
+            'Message': np.concatenate(ruleMessages)[order] if ruleRows else [],
+        }, columns=['Source', 'Name', 'Rule', 'Severity', 'Message'])
+        return violationsdf
+
+    def checkFiles(self, files):
+        '''
+        Method: Check the structure names of RT structure sets, clinical protocols and prescription exports
+
+        Arguments:
+        files: list of String
+            Files to check, see readStructureNames
+
+        Returns:
+        violationsdf: Pandas DataFrame
+            See check. Source is the file path. Files that cannot be read are reported with Rule 'Unreadable'
+        '''
+        names, unreadable = {}, []
+        for file in files:
+            try:
+                names[str(file)] = readStructureNames(file)
+            except Exception as e:
+                unreadable.append((str(file), '', 'Unreadable', 'error', f'{type(e).__name__}: {e}'))
+        violationsdf = self.check(names)
+        if unreadable:
+            violationsdf = pd.concat([violationsdf, pd.DataFrame(unreadable, columns=violationsdf.columns)],
+                                     ignore_index=True)
+        return violationsdf
+
 def _correctStrNames(filedata, strNameChanges):
     '''
     Function: Correct structure names in a prescrption file following a DataFrame of directions  
@@ -1159,8 +3856,7 @@ def _correctStrNames(filedata, strNameChanges):
         filedata: String
         The corrected text of the prescription csv file
     '''
-    for index, strName in strNameChanges.iterrows():
-        filedata = filedata.replace(strName.Old, strName.New)
+    filedata, _ = StrNameRenamer(strNameChanges).renameCSV(filedata)
     return filedata
 
 def correctStrNames(prescriptionFile, strNameChanges):
@@ -1183,3 +3879,546 @@ def correctStrNames(prescriptionFile, strNameChanges):
     # Write the corrected prescription file
     with open(prescriptionFile, 'w') as file:
       file.write(filedata)
+
+# Elementos y atributos que identifican estructuras en un protocolo clínico
+_STRUCTURE_NAME_ATTRIBUTES = [('.//Structures/Structure', ('ID', 'Name')),
+                              ('.//Phases/Phase/Prescription/Item', ('ID', 'Name')),
+                              ('.//Phases/Phase/Prescription/MeasureItem', ('ID', 'Name')),
+                              ('.//ObjectivesOneStructure', ('ID',))]
+_STRUCTURE_NAME_TEXTS = ['.//VolumeID', './/ReviewStructure/Item']
+
+def _renameProtocolStructures(root, rename):
+    '''
+    Function: Rename in place the structure names of a clinical protocol or contouring template.
+        Shared by StrNameRenamer and StrNameTranslator, so both rewrite the same elements: Structure ID and Name,
+        prescription Item and MeasureItem ID and Name, optimization objective structure ID, VolumeID
+        and review structure names
+
+    Arguments:
+    root: Element
+        Root element of the protocol
+    rename: Callable
+        New name of a structure name, None to keep it
+
+    Returns:
+    changes: list of dict
+        Change log with keys 'Element', 'Attribute', 'Old' and 'New'. Attribute is '' for element texts
+    '''
+    changes = []
+    for path, attributes in _STRUCTURE_NAME_ATTRIBUTES:
+        for element in root.iterfind(path):
+            for attribute in attributes:
+                Old = element.get(attribute)
+                New = rename(Old) if Old else None
+                if New is not None:
+                    element.set(attribute, New)
+                    changes.append({'Element': element.tag, 'Attribute': attribute, 'Old': Old, 'New': New})
+    for path in _STRUCTURE_NAME_TEXTS:
+        for element in root.iterfind(path):
+            Old = (element.text or '').strip()
+            New = rename(Old) if Old else None
+            if New is not None:
+                element.text = New
+                changes.append({'Element': element.tag, 'Attribute': '', 'Old': Old, 'New': New})
+    return changes
+
+class StrNameRenamer:
+    '''
+    Class: StrNameRenamer
+        Single pass, field-aware structure renamer for prescription csv files and clinical protocol xml files.
+        In prescriptions all the old names are compiled into one alternation regex, longest first; in clinical
+        protocols the structure name elements and attributes are renamed on the parsed document. Only structure
+        name positions are rewritten, so a name that is a prefix of another one (PTV vs PTV gg) is never corrupted
+
+    Arguments:
+    strNameChanges: DataFrame or dict
+        Pandas dataframe with the Old and New names of each structure or a dict {Old: New}
+    '''
+    def __init__(self, strNameChanges):
+        if isinstance(strNameChanges, pd.DataFrame):
+            strNameChanges = dict(zip(strNameChanges.Old, strNameChanges.New))
+        self.mapping = {Old: New for Old, New in strNameChanges.items()
+                        if isinstance(Old, str) and isinstance(New, str) and Old and Old != New}
+        alternation = '|'.join(re.escape(Old) for Old in sorted(self.mapping, key=len, reverse=True)) or '(?!)'
+        # Posiciones de nombres de estructura en la prescripción exportada de ARIA
+        self._csvRx = re.compile(r'(?P<pre>Volume / Structure :|Volume |Organ :|% of )(?P<name>' + alternation + r')'
+                                 r'(?=  \d| Min Dose| Mean| at )')
+
+    def renameCSV(self, filedata):
+        '''
+        Method: Rename the structures in the text of a prescription csv file
+
+        Return:
+            filedata, count: String, Integer
+            The corrected text and the number of replacements
+        '''
+        filedata, count = self._csvRx.subn(lambda match: match.group('pre') + self.mapping[match.group('name')], filedata)
+        return filedata, count
+
+    def renameXML(self, filedata):
+        '''
+        Method: Rename the structures in the text of a clinical protocol xml file.
+            The structure names are rewritten by _renameProtocolStructures, as StrNameTranslator does.
+            A renamed document is serialized as writeProt would write it; a document without renames is returned as is
+
+        Return:
+            filedata, count: String, Integer
+            The corrected text and the number of replacements
+        '''
+        cpet = ET.ElementTree(ET.fromstring(filedata.lstrip('\ufeff')))
+        changes = _renameProtocolStructures(cpet.getroot(), self.mapping.get)
+        if changes:
+            filedata = serializeProt(cpet).decode('utf-8')
+        return filedata, len(changes)
+
+    def renameFile(self, fileIn, fileOut=None):
+        '''
+        Method: Rename the structures of a prescription (.csv) or clinical protocol (.xml) file
+
+        Arguments:
+        fileIn: String
+            Path to the file to be corrected
+        fileOut: String
+            Path to the corrected file. Defaults to fileIn, which is overwritten
+
+        Return:
+            count: Integer
+            Number of replacements
+        '''
+        with open(fileIn, 'r', encoding='utf-8', newline='') as file:
+            filedata = file.read()
+        if fileIn.lower().endswith('.xml'):
+            filedata, count = self.renameXML(filedata)
+        else:
+            filedata, count = self.renameCSV(filedata)
+        with open(fileOut or fileIn, 'w', encoding='utf-8', newline='') as file:
+            file.write(filedata)
+        return count
+
+    def renameDirectory(self, directory, outdir=None, patterns=('*.csv', '*.xml')):
+        '''
+        Method: Rename the structures of every prescription and clinical protocol file in a directory
+
+        Arguments:
+        directory: String
+            Directory with the files to be corrected
+        outdir: String
+            Directory where the corrected files are written. Defaults to directory, overwriting the files
+        patterns: Tuple
+            Glob patterns of the files to be corrected
+
+        Return:
+            renamedf: Pandas DataFrame
+            DataFrame with columns ['File', 'Replacements']
+        '''
+        if outdir is not None:
+            os.makedirs(outdir, exist_ok=True)
+        rows = []
+        for pattern in patterns:
+            for fileIn in sorted(glob.glob(os.path.join(directory, pattern))):
+                fileOut = os.path.join(outdir, os.path.basename(fileIn)) if outdir is not None else None
+                rows.append({'File': fileIn, 'Replacements': self.renameFile(fileIn, fileOut)})
+        renamedf = pd.DataFrame(rows, columns=['File', 'Replacements'])
+        return renamedf
+
+def _dictionaryKey(strName):
+    '''
+    Function: Normalized key of a structure name in a translation dictionary: NFC unicode form,
+        collapsed whitespace and case folding
+    '''
+    return ' '.join(unicodedata.normalize('NFC', strName).split()).casefold()
+
+def _translateProtocolFile(fileIn, translator, outdir):
+    '''
+    Function: Translate a clinical protocol file. Worker of StrNameTranslator.translateDirectory
+
+    Returns:
+    summary, changes: dict, list of dict
+        Per-file summary and change log
+    '''
+    start = time.perf_counter()
+    fileOut = os.path.join(outdir, os.path.basename(fileIn))
+    summary = {'File': fileIn, 'Output': fileOut, 'Changes': 0, 'Error': '', 'Seconds': 0.}
+    changes = []
+    try:
+        changes = translator.translateFile(fileIn, fileOut)
+        summary['Changes'] = len(changes)
+    except Exception as e:
+        summary['Output'] = ''
+        summary['Error'] = f'{type(e).__name__}: {e}'
+    summary['Seconds'] = time.perf_counter() - start
+    return summary, [{'File': fileIn, **change} for change in changes]
+
+class StrNameTranslator:
+    '''
+    Class: StrNameTranslator
+        Dictionary driven translation of the structure names of clinical protocols, e.g. to TG-263 names.
+        The dictionary is loaded once; names are looked up ignoring case, repeated whitespace and unicode form.
+        The structure names are rewritten on the parsed element tree by _renameProtocolStructures,
+        the same routine StrNameRenamer uses
+
+    Arguments:
+    dictionary: String, DataFrame or dict
+        Translation dictionary csv file, DataFrame or dict {Old: New}.
+        Default DICTIONARY_FILE, tools/Diccionario.csv of the repository
+    source, target: String
+        Columns of the dictionary with the old and the new names. Default 'est' and 'strt'
+
+    Attributes:
+    mapping: dict
+        Translation of each dictionary key (see _dictionaryKey). Repeated entries with the same translation count once
+    ambiguous: dict
+        Keys with several translations, e.g. a paired organ without laterality. They are not translated
+    names: frozenset
+        Every new name of the dictionary, also the ones without old name
+    '''
+    def __init__(self, dictionary=DICTIONARY_FILE, source='est', target='strt'):
+        if isinstance(dictionary, (str, os.PathLike)):
+            dictionary = pd.read_csv(dictionary, dtype=str)
+        pairs = list(zip(dictionary[source], dictionary[target])) if isinstance(dictionary, pd.DataFrame) \
+            else list(dictionary.items())
+        self.names = frozenset(New.strip() for _, New in pairs if isinstance(New, str) and New.strip())
+        targets = {}
+        for Old, New in pairs:
+            if isinstance(Old, str) and isinstance(New, str) and Old.strip() and New.strip():
+                News = targets.setdefault(_dictionaryKey(Old), [])
+                if New.strip() not in News:
+                    News.append(New.strip())
+        # Un nombre con varias traducciones (p.ej. un órgano par sin lateralidad) no se traduce
+        self.mapping = {key: News[0] for key, News in targets.items() if len(News) == 1}
+        self.ambiguous = {key: News for key, News in targets.items() if len(News) > 1}
+
+    def translateName(self, strName):
+        '''
+        Method: Translated structure name, None if the name is not in the dictionary or is already translated
+        '''
+        if not strName:
+            return None
+        New = self.mapping.get(_dictionaryKey(strName))
+        return New if New is not None and New != strName else None
+
+    def translate(self, cpet):
+        '''
+        Method: Translate in place the structure names of a clinical protocol
+
+        Arguments:
+        cpet: Element Tree or ClinicalProtocol
+            Clinical protocol to translate. A ClinicalProtocol is reindexed afterwards
+
+        Returns:
+        changes: list of dict
+            Change log with keys 'Element', 'Attribute', 'Old' and 'New'. Attribute is '' for element texts
+        '''
+        changes = _renameProtocolStructures(cpet.getroot(), self.translateName)
+        if isinstance(cpet, ClinicalProtocol):
+            cpet.reindex()
+        return changes
+
+    def translateFile(self, fileIn, fileOut=None):
+        '''
+        Method: Translate a clinical protocol xml file
+
+        Arguments:
+        fileIn: String
+            Clinical protocol to translate
+        fileOut: String
+            Translated clinical protocol. Defaults to fileIn, which is overwritten
+
+        Returns:
+        changes: list of dict
+            Change log. See translate
+        '''
+        cpet = parseProt(fileIn)
+        changes = self.translate(cpet)
+        writeProt(cpet, fileOut or fileIn)
+        return changes
+
+    def translateDirectory(self, directory, outdir, pattern='*.xml', max_workers=None):
+        '''
+        Method: Translate every clinical protocol of a directory. The files are distributed across a process pool
+
+        Arguments:
+        directory: String or list of String
+            Directory with the clinical protocols, or list of clinical protocol files
+        outdir: String
+            Directory where the translated protocols are written with the same file names. Created if needed
+        pattern: String
+            Glob pattern of the protocol files inside directory. Default '*.xml'
+        max_workers: Integer
+            Number of worker processes. None uses the number of processors, 1 translates serially in this process
+
+        Returns:
+        summarydf: Pandas DataFrame
+            One row per file with columns ['File', 'Output', 'Changes', 'Error', 'Seconds']
+        changelogdf: Pandas DataFrame
+            One row per change with columns ['File', 'Element', 'Attribute', 'Old', 'New']
+        '''
+        if isinstance(directory, (str, os.PathLike)):
+            protocolFiles = sorted(glob.glob(os.path.join(directory, pattern)))
+        else:
+            protocolFiles = list(directory)
+        os.makedirs(outdir, exist_ok=True)
+        worker = functools.partial(_translateProtocolFile, translator=self, outdir=os.path.abspath(outdir))
+        if max_workers == 1 or len(protocolFiles) <= 1:
+            results = [worker(protocolFile) for protocolFile in protocolFiles]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(worker, protocolFiles))
+
+        summarydf = pd.DataFrame([summary for summary, _ in results],
+                                 columns=['File', 'Output', 'Changes', 'Error', 'Seconds'])
+        changelogdf = pd.DataFrame([change for _, changes in results for change in changes],
+                                   columns=['File', 'Element', 'Attribute', 'Old', 'New'])
+        return summarydf, changelogdf
+
+_ARCHIVE_SCHEMA = """
+PRAGMA foreign_keys = ON;
+CREATE TABLE IF NOT EXISTS Files (
+    Path TEXT PRIMARY KEY, MTimeNs INTEGER, Size INTEGER, Digest TEXT, Error TEXT);
+CREATE TABLE IF NOT EXISTS StructureSets (
+    Digest TEXT PRIMARY KEY, SOPInstanceUID TEXT, StructureSetLabel TEXT, StructureSetDate TEXT);
+CREATE TABLE IF NOT EXISTS ROIs (
+    Digest TEXT REFERENCES StructureSets ON DELETE CASCADE, ROINumber INTEGER, ROIName TEXT,
+    RTROIInterpretedType TEXT);
+CREATE INDEX IF NOT EXISTS FilesByDigest ON Files (Digest);
+CREATE INDEX IF NOT EXISTS StructureSetsByUID ON StructureSets (SOPInstanceUID);
+CREATE INDEX IF NOT EXISTS ROIsByDigest ON ROIs (Digest);
+"""
+
+_ARCHIVE_TAGS = ['Modality', 'SOPInstanceUID', 'StructureSetLabel', 'StructureSetDate'] + _RS_HEADER_TAGS
+
+def _scanStructureSetFile(path):
+    '''
+    Function: Digest and header of a RT structure set file. Worker of StructureSetArchive.scan
+
+    Returns:
+    result: dict
+        Keys 'Path', 'MTimeNs', 'Size', 'Digest', 'Error' and, for readable structure sets,
+        'SOPInstanceUID', 'StructureSetLabel', 'StructureSetDate' and 'ROIs' [(ROINumber, ROIName, RTROIInterpretedType)]
+    '''
+    stat = os.stat(path)
+    result = {'Path': path, 'MTimeNs': stat.st_mtime_ns, 'Size': stat.st_size, 'Digest': None, 'Error': None}
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(digest_size=16)
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+            result['Digest'] = digest.hexdigest()
+        dcmds = _readStructureSetHeader(path, tags=_ARCHIVE_TAGS)
+        if dcmds.get('Modality') != 'RTSTRUCT':
+            raise ValueError(f"Modality {dcmds.get('Modality')}: no es un RT Structure Set")
+        observationTypes = {int(observation.ReferencedROINumber): observation.get('RTROIInterpretedType', '')
+                            for observation in dcmds.get('RTROIObservationsSequence', [])}
+        result.update({
+            'SOPInstanceUID': str(dcmds.get('SOPInstanceUID', '')),
+            'StructureSetLabel': str(dcmds.get('StructureSetLabel', '')),
+            'StructureSetDate': str(dcmds.get('StructureSetDate', '')),
+            'ROIs': [(int(structure.ROINumber), str(structure.ROIName),
+                      observationTypes.get(int(structure.ROINumber), ''))
+                     for structure in dcmds.get('StructureSetROISequence', [])],
+        })
+    except Exception as e:
+        result['Error'] = f'{type(e).__name__}: {e}'
+    return result
+
+class StructureSetArchive:
+    '''
+    Class: StructureSetArchive
+        Nomenclature statistics of an archive of RT structure set files. scan() reads only the DICOM headers
+        (the contour data is skipped), spread across a process or thread pool, and stores the ROI names in an
+        SQLite cache keyed by the content digest of each file. Later scans only read the files that are new or
+        whose modification time or size changed. Structure sets stored more than once are counted once
+        (by SOPInstanceUID). ROI names are normalized (see normalizeStrName) and matched with a translation
+        dictionary (see StrNameTranslator)
+
+    Arguments:
+    database: String
+        SQLite database file holding the cache. Default ':memory:', a cache that lives only in this process
+    archive: String or list of String
+        Directories of the archive. Default DICOM_DIR, DICOM of the repository
+    pattern: String
+        Glob pattern of the structure set files inside the archive directories. Default '**/RS*.dcm'
+    dictionary: String, DataFrame, dict or None
+        Translation dictionary, see StrNameTranslator. Default DICTIONARY_FILE, tools/Diccionario.csv of the
+        repository. None disables matching
+    '''
+    def __init__(self, database=':memory:', archive=DICOM_DIR, pattern='**/RS*.dcm',
+                 dictionary=DICTIONARY_FILE):
+        self.archive = [archive] if isinstance(archive, (str, os.PathLike)) else list(archive)
+        self.pattern = pattern
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript(_ARCHIVE_SCHEMA)
+        self.translator = StrNameTranslator(dictionary) if dictionary is not None else None
+        self._dictionaryNames = {}
+        if self.translator is not None:
+            # Nombres ya traducidos y nombres del diccionario, por su forma normalizada
+            for New in sorted(self.translator.names):
+                self._dictionaryNames.setdefault(normalizeStrName(New), New)
+            for key, New in self.translator.mapping.items():
+                self._dictionaryNames.setdefault(normalizeStrName(key), New)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Method: Close the database connection
+        '''
+        self.connection.close()
+
+    def files(self):
+        '''
+        Method: Absolute paths of the structure set files currently in the archive directories
+        '''
+        return sorted({os.path.abspath(path) for directory in self.archive
+                       for path in glob.glob(os.path.join(directory, self.pattern), recursive=True)})
+
+    def scan(self, max_workers=None, executor='process'):
+        '''
+        Method: Bring the cache up to date with the archive directories
+
+        Arguments:
+        max_workers: Integer
+            Number of workers. None uses the executor default, 1 reads serially in this process
+        executor: String ('process' [Default], 'thread')
+            Pool type. Header parsing is CPU bound; threads suit archives on slow network shares
+
+        Returns:
+        counts: dict
+            Number of files 'read', 'unchanged', 'removed' and 'errors' (files that are not readable
+            RT structure sets; they are not read again until they change)
+        '''
+        counts = {'read': 0, 'unchanged': 0, 'removed': 0, 'errors': 0}
+        known = {path: (mtime, size) for path, mtime, size in
+                 self.connection.execute('SELECT Path, MTimeNs, Size FROM Files')}
+        files = self.files()
+        pending = []
+        for path in files:
+            stat = os.stat(path)
+            if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                counts['unchanged'] += 1
+            else:
+                pending.append(path)
+
+        if max_workers == 1 or len(pending) <= 1:
+            results = map(_scanStructureSetFile, pending)
+            pool = None
+        else:
+            Executor = (concurrent.futures.ThreadPoolExecutor if executor == 'thread'
+                        else concurrent.futures.ProcessPoolExecutor)
+            pool = Executor(max_workers=max_workers)
+            results = pool.map(_scanStructureSetFile, pending, chunksize=16 if executor != 'thread' else 1)
+        try:
+            with self.connection:
+                for result in results:
+                    self._insert(result)
+                    counts['errors' if result['Error'] else 'read'] += 1
+                for path in set(known) - set(files):
+                    self.connection.execute('DELETE FROM Files WHERE Path = ?', (path,))
+                    counts['removed'] += 1
+                # Estructuras sin ningún fichero que las contenga
+                self.connection.execute('DELETE FROM StructureSets WHERE Digest NOT IN '
+                                        '(SELECT Digest FROM Files WHERE Digest IS NOT NULL)')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return counts
+
+    def _insert(self, result):
+        '''
+        Method: Store the result of _scanStructureSetFile
+        '''
+        self.connection.execute('INSERT OR REPLACE INTO Files VALUES (?, ?, ?, ?, ?)',
+                                (result['Path'], result['MTimeNs'], result['Size'], result['Digest'],
+                                 result['Error']))
+        if result['Error'] is not None:
+            return
+        # Contenido ya conocido (copia de otro fichero): no hace falta volver a insertarlo
+        if self.connection.execute('SELECT 1 FROM StructureSets WHERE Digest = ?', (result['Digest'],)).fetchone():
+            return
+        self.connection.execute('INSERT INTO StructureSets VALUES (?, ?, ?, ?)',
+                                (result['Digest'], result['SOPInstanceUID'], result['StructureSetLabel'],
+                                 result['StructureSetDate']))
+        self.connection.executemany('INSERT INTO ROIs VALUES (?, ?, ?, ?)',
+                                    [(result['Digest'], *roi) for roi in result['ROIs']])
+
+    def query(self, sql, params=()):
+        '''
+        Method: Run an SQL query on the cache tables (Files, StructureSets, ROIs)
+
+        Returns:
+        A Pandas DataFrame with the query result
+        '''
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def dictionaryName(self, strName):
+        '''
+        Method: Name of the translation dictionary matching a ROI name: its translation, the name itself if it
+            already is a dictionary name, or a match of its normalized form. None if there is no match
+        '''
+        if self.translator is None:
+            return None
+        New = self.translator.mapping.get(_dictionaryKey(strName))
+        if New is None:
+            New = self._dictionaryNames.get(normalizeStrName(strName))
+        return New
+
+    def names(self):
+        '''
+        Method: ROI names of the archive
+
+        Returns:
+        namesdf: Pandas DataFrame
+            One row per distinct ROI name with columns ['ROIName', 'NormalizedName', 'Dictionary', 'Count'].
+            Count is the number of distinct structure sets (SOPInstanceUID) with the name
+        '''
+        namesdf = self.query('SELECT r.ROIName, COUNT(DISTINCT s.SOPInstanceUID) AS Count '
+                             'FROM ROIs r JOIN StructureSets s USING (Digest) GROUP BY r.ROIName')
+        namesdf.insert(1, 'NormalizedName', namesdf.ROIName.map(normalizeStrName))
+        namesdf.insert(2, 'Dictionary', namesdf.ROIName.map(self.dictionaryName))
+        namesdf = namesdf.sort_values(['Count', 'ROIName'], ascending=[False, True], ignore_index=True)
+        return namesdf
+
+    def structureNames(self):
+        '''
+        Method: ROI names of every structure set of the archive, the input of StrNameRules.check
+
+        Returns:
+        namesdf: Pandas DataFrame
+            Columns ['Source', 'Name']: SOPInstanceUID and ROIName, in ROI number order
+        '''
+        return self.query('SELECT s.SOPInstanceUID AS Source, r.ROIName AS Name '
+                          'FROM ROIs r JOIN StructureSets s USING (Digest) ORDER BY s.SOPInstanceUID, r.ROINumber')
+
+    def frequencies(self, by='ROIName'):
+        '''
+        Method: Frequency table of the ROI names
+
+        Arguments:
+        by: String ('ROIName' [Default], 'NormalizedName', 'Dictionary')
+            Group the names as written, by normalized form or by matching dictionary name
+
+        Returns:
+        frequenciesdf: Pandas DataFrame
+            Columns [by, 'Count', 'Share', 'Variants', 'Names']: the number and fraction of distinct structure sets
+            with any name of the group, the number of distinct names and the names, most frequent first.
+            Names without dictionary match are grouped under Dictionary None
+        '''
+        pairsdf = self.query('SELECT DISTINCT s.SOPInstanceUID, r.ROIName '
+                             'FROM ROIs r JOIN StructureSets s USING (Digest)')
+        structureSets = pairsdf.SOPInstanceUID.nunique()
+        namesdf = self.names().set_index('ROIName')
+        pairsdf[by] = pairsdf.ROIName.map(namesdf[by]) if by != 'ROIName' else pairsdf.ROIName
+        grouped = pairsdf.groupby(by, dropna=False)
+        frequenciesdf = pd.DataFrame({
+            'Count': grouped.SOPInstanceUID.nunique(),
+            'Variants': grouped.ROIName.nunique(),
+            'Names': grouped.ROIName.agg(lambda names: namesdf.Count[names.unique()]
+                                         .sort_values(ascending=False).index.tolist()),
+        }).reset_index()
+        frequenciesdf.insert(2, 'Share', frequenciesdf.Count / structureSets if structureSets else 0.)
+        frequenciesdf = frequenciesdf.sort_values(['Count', by], ascending=[False, True], ignore_index=True)
+        return frequenciesdf
@@ -2,26 +2,82 @@ import streamlit as st
 import pandas as pd
 import sys
 import os
-from io import StringIO
+import time
+from io import StringIO, BytesIO
 import traceback
-import difflib
 
+# Inicio de la ejecución del script para medir la latencia de cada rerun
+t_inicio = time.perf_counter()
 
 # Añade el directorio src al path para importar aclinprot como acp
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../aclinprot')))
 import aclinprot as acp
 
+# --- Recursos compartidos y cálculos cacheados ---
+@st.cache_resource(show_spinner=False)
+def cargar_plantillas():
+    # Una vez por proceso del servidor: la plantilla se analiza una vez y cada conversión recibe un clon
+    plantillas = acp.TemplateRegistry()
+    plantillas.get('BareBone.xml')
+    return plantillas
+
+@st.cache_resource(show_spinner=False)
+def cargar_traductor():
+    # Diccionario de nombres de estructuras (tools/Diccionario.csv), None si no está disponible
+    try:
+        return acp.StrNameTranslator()
+    except FileNotFoundError:
+        return None
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def emparejador_contorneo(cont_names):
+    # El índice de n-gramas de cada RT Structure Set se construye una sola vez
+    return acp.StrNameMatcher(list(cont_names))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def parsear_prescripcion(contenido):
+    # Clave: contenido del CSV subido. Streamlit devuelve copias, el caché no se corrompe
+    return acp.parse_prescription(BytesIO(contenido))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def leer_estructuras_contorneo(contenido):
+    return acp.readContouringStructureNames(BytesIO(contenido))
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def sugerir_nombres(pres_names, cont_names):
+    # Mismo motor de emparejamiento que acp.suggestStrNames
+    matcher = emparejador_contorneo(cont_names)
+    traductor = cargar_traductor()
+    suggestions = {}
+    for pres_name in pres_names:
+        # La traducción del diccionario, si está en el contorneo, antes que el nombre más parecido
+        traduccion = traductor.translateName(pres_name) if traductor is not None else None
+        if traduccion in cont_names:
+            suggestions[pres_name] = traduccion
+            continue
+        match = matcher.match(pres_name, k=1)
+        suggestions[pres_name] = match[0][0] if match else cont_names[0]
+    return suggestions
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def verificar_dosimpars(oars):
+    # oars: tupla de (Organ, tupla de DosimPars), hashable a diferencia de las listas de oardf
+    oardf = pd.DataFrame([{'Organ': organ, 'DosimPars': list(dosimpars)} for organ, dosimpars in oars],
+                         columns=['Organ', 'DosimPars'])
+    return acp.checkDosimPars(oardf)
+
+def clave_oardf(oardf):
+    if 'DosimPars' not in oardf:
+        return ()
+    return tuple((organ, tuple(dosimpars) if isinstance(dosimpars, list) else ())
+                 for organ, dosimpars in zip(oardf['Organ'], oardf['DosimPars']))
+
 # Función para mostrar el resultado del protocolo clínico y permitir su descarga
-def mostrar_resultado_y_descarga(prot_out, ruta_protocolo):
+def mostrar_resultado_y_descarga(prot_out, xml_content):
     try:
-        st.success(f"Protocolo clínico generado en {prot_out}")
-
-        # Ruta completa al archivo generado
-        xml_path = os.path.join(ruta_protocolo, prot_out)
-        # Lee el archivo XML como texto
-        with open(xml_path, "r", encoding="utf-8") as f:
-            xml_content = f.read()
-        # Botón de descarga
+        st.success(f"Protocolo clínico generado: {prot_out}")
+
+        # Botón de descarga con el XML generado en memoria, sin pasar por disco
         st.download_button(
             label="Descargar protocolo clínico XML",
             data=xml_content,
@@ -75,7 +131,7 @@ with tab1:
     # Mostrar DataFrames directamente al subir archivo
     if uploaded_file is not None:
         try:
-            pvdfs, ccdfs, oardfs = acp.parse_prescription(uploaded_file)
+            pvdfs, ccdfs, oardfs = parsear_prescripcion(uploaded_file.getvalue())
             num_prescripciones = len(pvdfs)
 
             if num_prescripciones > 1:
@@ -106,26 +162,25 @@ with tab1:
 
         # Generar protocolo clínico y permitir descarga
         if st.button("Generar protocolo clínico", key="gen_prot_tab1"):
-            ruta_protocolo = os.path.abspath(os.getcwd())
-            os.makedirs(ruta_protocolo, exist_ok=True)
-
             # Usa los dataframes corregidos si existen en session_state
             pvdf_to_use = st.session_state.get('pvdf', pvdf)
             ccdf_to_use = st.session_state.get('ccdf', ccdf)
             oardf_to_use = st.session_state.get('oardf', oardf)
 
             try:
-                acp.convertPrescriptionIntoClinicalProtocol(
+                xml_content = acp.convertPrescriptionIntoClinicalProtocol(
                     prescription_or_pvdf=pvdf_to_use,
                     ccdf=ccdf_to_use,
                     oardf=oardf_to_use,
                     ProtocolID=protocolo_id,
                     TreatmentSite=treatment_site,
                     PlanID=plan_id,
-                    ProtOut=prot_out,
+                    ProtOut=None,
                     PrescriptionIndex=prescripcion_idx,
+                    ProtTemplate=cargar_plantillas().get('BareBone.xml'),
+                    Return='bytes',
                 )
-                mostrar_resultado_y_descarga(prot_out, ruta_protocolo)
+                mostrar_resultado_y_descarga(prot_out, xml_content)
             except Exception as e:
                 st.error(f"Error generando el protocolo clínico: {e}")
                 st.code(traceback.format_exc(), language="python")
@@ -140,7 +195,7 @@ with tab2:
     st.header("Corrección de estructuras")
     dicom_file = st.file_uploader("Sube el archivo DICOM RT Structure Set", type=["dcm"], key="dicom_uploader")
     if dicom_file is not None:
-        cont_names = acp.readContouringStructureNames(dicom_file)
+        cont_names = leer_estructuras_contorneo(dicom_file.getvalue())
         contStrdf = pd.DataFrame(cont_names, columns=['Contouring'])
         st.write("Estructuras en el RT Structure Set:")
         st.dataframe(contStrdf)
@@ -152,10 +207,7 @@ with tab2:
         st.dataframe(pd.DataFrame(pres_names, columns=['Prescripción']))
 
         # Sugerencia automática
-        suggestions = {}
-        for pres_name in pres_names:
-            match = difflib.get_close_matches(pres_name, cont_names, n=1)
-            suggestions[pres_name] = match[0] if match else cont_names[0]
+        suggestions = sugerir_nombres(tuple(pres_names), tuple(cont_names))
 
         # Selección manual
         mapping = {}
@@ -194,26 +246,25 @@ with tab2:
 
         # Generar protocolo clínico y permitir descarga
         if st.button("Generar protocolo clínico", key="gen_prot_tab2"):
-            ruta_protocolo = os.path.abspath(os.getcwd())
-            os.makedirs(ruta_protocolo, exist_ok=True)
-
             # Usa los dataframes corregidos si existen en session_state
             pvdf_to_use = st.session_state.get('pvdf', pvdf)
             ccdf_to_use = st.session_state.get('ccdf', ccdf)
             oardf_to_use = st.session_state.get('oardf', oardf)
 
             try:
-                acp.convertPrescriptionIntoClinicalProtocol(
+                xml_content = acp.convertPrescriptionIntoClinicalProtocol(
                     prescription_or_pvdf=pvdf_to_use,
                     ccdf=ccdf_to_use,
                     oardf=oardf_to_use,
                     ProtocolID=protocolo_id,
                     TreatmentSite=treatment_site,
                     PlanID=plan_id,
-                    ProtOut=prot_out,
+                    ProtOut=None,
                     PrescriptionIndex=prescripcion_idx,
+                    ProtTemplate=cargar_plantillas().get('BareBone.xml'),
+                    Return='bytes',
                 )
-                mostrar_resultado_y_descarga(prot_out, ruta_protocolo)
+                mostrar_resultado_y_descarga(prot_out, xml_content)
             except Exception as e:
                 st.error(f"Error generando el protocolo clínico: {e}")
                 st.code(traceback.format_exc(), language="python")
@@ -226,7 +277,7 @@ with tab3:
     # Usa el oardf corregido si existe
     oardf_to_check = st.session_state.get('oardf', oardf if 'oardf' in locals() else None)
     if oardf_to_check is not None:
-        df_check = acp.checkDosimPars(oardf_to_check)
+        df_check = verificar_dosimpars(clave_oardf(oardf_to_check))
         st.write("Resultado de la verificación de DosimPars:")
         st.dataframe(df_check, use_container_width=True)
 
@@ -280,26 +331,25 @@ with tab3:
 
     # Generar protocolo clínico y permitir descarga
     if st.button("Generar protocolo clínico", key="gen_prot_tab3"):
-        ruta_protocolo = os.path.abspath(os.getcwd())
-        os.makedirs(ruta_protocolo, exist_ok=True)
-
         # Usa los dataframes corregidos si existen en session_state
         pvdf_to_use = st.session_state.get('pvdf', pvdf)
         ccdf_to_use = st.session_state.get('ccdf', ccdf)
         oardf_to_use = st.session_state.get('oardf', oardf)
 
         try:
-            acp.convertPrescriptionIntoClinicalProtocol(
+            xml_content = acp.convertPrescriptionIntoClinicalProtocol(
                 prescription_or_pvdf=pvdf_to_use,
                 ccdf=ccdf_to_use,
                 oardf=oardf_to_use,
                 ProtocolID=protocolo_id,
                 TreatmentSite=treatment_site,
                 PlanID=plan_id,
-                ProtOut=prot_out,
+                ProtOut=None,
                 PrescriptionIndex=prescripcion_idx,
+                ProtTemplate=cargar_plantillas().get('BareBone.xml'),
+                Return='bytes',
             )
-            mostrar_resultado_y_descarga(prot_out, ruta_protocolo)
+            mostrar_resultado_y_descarga(prot_out, xml_content)
         except Exception as e:
             st.error(f"Error generando el protocolo clínico: {e}")
             st.code(traceback.format_exc(), language="python")
@@ -313,4 +363,7 @@ hide_streamlit_style = """
     header {visibility: hidden;}
     </style>
     """
-st.markdown(hide_streamlit_style, unsafe_allow_html=True)
\ No newline at end of file
+st.markdown(hide_streamlit_style, unsafe_allow_html=True)
+
+# Latencia de esta ejecución del script
+st.sidebar.caption(f"Tiempo de ejecución: {(time.perf_counter() - t_inicio) * 1000:.0f} ms")
@@ -0,0 +1,126 @@
+import copy
+import importlib.util
+import timeit
+import pytest
+import xml.etree.ElementTree as ET
+import aclinprot as acp
+
+SBRTTorax_test = '../protocolos/clinicos/SBRTTórax1fx.xml'
+BareBone_test = '../src/aclinprot/BareBone.xml'
+
+def test_ClinicalProtocol_lookups(clinprot=SBRTTorax_test):
+    cpet = acp.parseProt(clinprot)
+    cp = acp.ClinicalProtocol(clinprot)
+    for ID in acp.readClinProtStructureNames(clinprot):
+        assert cp.structureElement(ID).get('ID') == acp.structureElementByID(cpet, ID).get('ID')
+        assert len(cp.prescriptionItems(ID)) == len(acp.prescriptionItemsByID(cpet, ID))
+        assert len(cp.measureItems(ID)) == len(acp.measureItemsByID(cpet, ID))
+
+def test_ClinicalProtocol_amend(clinprot=SBRTTorax_test, template=BareBone_test):
+    IDs = acp.readClinProtStructureNames(clinprot)
+    amended = acp.parseProt(template)
+    model = acp.parseProt(clinprot)
+    indexedAmended = acp.ClinicalProtocol(template)
+    indexedModel = acp.ClinicalProtocol(clinprot)
+    for ID in IDs:
+        acp.amendClinicalProtocol(amended, model, ID)
+        acp.amendClinicalProtocol(indexedAmended, indexedModel, ID)
+    assert ET.tostring(amended.getroot()) == ET.tostring(indexedAmended.getroot())
+
+def test_ClinicalProtocol_removeStructure(clinprot=SBRTTorax_test):
+    cp = acp.ClinicalProtocol(clinprot)
+    ID = next(ID for ID in cp.structureIDs if cp.measureItems(ID))
+    cp.removeStructure(ID)
+    assert ID not in cp
+    assert acp.measureItemsByID(cp.cpet, ID) == []
+    assert acp.ClinicalProtocol(cp.cpet).structureIDs == cp.structureIDs
+
+def test_TemplateRegistry(tmp_path, template=BareBone_test):
+    registry = acp.TemplateRegistry(directory=tmp_path)
+    with open(template, 'rb') as f:
+        content = f.read()
+    (tmp_path / 'Base.xml').write_bytes(content)
+    registry.register('Prostata', 'Base.xml', sites=['Prostate'])
+    cpet = registry.get(site='prostate')
+    acp.modPreview(cpet, ID='Modified')
+    assert registry.get('Prostata').find('Preview').get('ID') != 'Modified'
+    assert registry.info()['misses'] == 1
+    (tmp_path / 'Base.xml').write_bytes(content.replace(b'Version="1.12"', b'Version="1.13"'))
+    assert registry.get('Base.xml').getroot().get('Version') == '1.13'
+    assert registry.info()['misses'] == 2
+
+def test_diffProt(clinprot='../protocolos/clinicos/Próstata 20Fx.xml', modified='../protocolos/clinicos/Próstata 20Fx mod.xml'):
+    cpet = acp.parseProt(clinprot)
+    assert acp.diffProt(clinprot, modified).Change.value_counts().to_dict() == {'removed': 5, 'changed': 2}
+    # Re-indenting and touching LastModified does not change the protocol
+    ET.indent(cpet, space='    ')
+    cpet.find('Preview').set('LastModified', ' enero 01 2026 00:00:00:000')
+    assert acp.diffProt(clinprot, cpet).empty
+    item = cpet.find('Phases/Phase/Prescription/Item')
+    item.find('Dose').text = '2'
+    diffdf = acp.diffProt(clinprot, cpet)
+    assert diffdf[['Kind', 'ID', 'Change']].values.tolist() == [['Item', item.get('ID'), 'changed']]
+    assert diffdf.Details[0] == 'Dose: 1 -> 2'
+
+def test_diffProtLibrary(clinprot='../protocolos/clinicos/Próstata 20Fx.xml', library='../protocolos/clinicos'):
+    librarydf = acp.diffProtLibrary(clinprot, library)
+    assert librarydf.Protocol[0].endswith('Próstata 20Fx.xml') and librarydf.Identical[0]
+    assert not librarydf.Identical[1:].any()
+
+def test_ProtocolCatalog(tmp_path, clinprot='../protocolos/clinicos/Próstata 20Fx.xml'):
+    with open(clinprot, 'rb') as f:
+        content = f.read()
+    (tmp_path / 'A.xml').write_bytes(content)
+    (tmp_path / 'B.xml').write_bytes(content)
+    with acp.ProtocolCatalog(library=[tmp_path]) as catalog:
+        assert catalog.refresh() == {'added': 2, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        assert len(catalog.protocolsConstraining('RECTO')) == 2
+        assert catalog.protocolsWithMeasure('V%', 'Recto').Measure.str.startswith('V').all()
+        measuredf = catalog.query('SELECT Type, Measure FROM MeasureItems WHERE StructureID = ?', ('PTV 60',))
+        assert set(measuredf.Measure[measuredf.Type == 2]) == {'V95%', 'V107%'}
+        (tmp_path / 'A.xml').write_bytes(content.replace(b'ID="Recto"', b'ID="Rectum"'))
+        (tmp_path / 'B.xml').unlink()
+        assert catalog.refresh() == {'added': 0, 'updated': 1, 'unchanged': 0, 'removed': 1}
+        assert catalog.protocolsConstraining('Recto').empty
+        assert catalog.query('SELECT COUNT(*) AS n FROM Items WHERE StructureID = ?', ('Rectum',)).n[0] > 0
+        assert catalog.refresh()['unchanged'] == 1
+
+def test_ContouringTemplate(tmp_path, conttemplate='../protocolos/contorneo/OARs Torax SBRT Task G.xml',
+                            template=BareBone_test):
+    ct = acp.parseContouringTemplate(conttemplate)
+    assert ct is acp.parseContouringTemplate(conttemplate)
+    assert 'Heart' in ct and 'heart' in ct and 'Corazón' not in ct
+    cpet = acp.parseProt(template)
+    structureElement = acp.addStructure(cpet, 'Heart', contouringTemplate=ct)
+    assert structureElement.find('ColorAndStyle').text == 'Purple'
+    assert structureElement.find('Identification/StructureCode').get('Code') == '7088'
+    assert ct.reconcile(cpet) == []
+    acp.addStructure(cpet, 'Esophagus')
+    changes = ct.reconcile(cpet)
+    assert {change['ID'] for change in changes} == {'Esophagus'}
+    acp.writeProt(cpet, tmp_path / 'Heart.xml')
+    changelogdf = ct.reconcileLibrary([str(tmp_path / 'Heart.xml')])
+    assert changelogdf.empty
+
+def test_TemplateRegistry_cheapClone(template=SBRTTorax_test):
+    # Sin unir text y tail del árbol guardado, cada deepcopy copia los fragmentos del parser sin unir
+    registry = acp.TemplateRegistry(directory='.')
+    registry.get(template)
+    parsed = acp.parseProt(template).getroot()
+    cloneTime = min(timeit.repeat(lambda: registry.get(template), number=20, repeat=5))
+    deepcopyTime = min(timeit.repeat(lambda: copy.deepcopy(parsed), number=20, repeat=5))
+    assert cloneTime < deepcopyTime / 2
+    assert ET.tostring(registry.get(template).getroot()) == ET.tostring(parsed)
+
+@pytest.mark.parametrize('backend', ['etree', pytest.param('lxml', marks=pytest.mark.skipif(
+    importlib.util.find_spec('lxml') is None, reason='lxml is not installed'))])
+def test_xmlBackend(tmp_path, backend, clinprot=SBRTTorax_test):
+    cpet = acp.parseProt(clinprot, backend=backend)
+    assert acp.readClinProtStructureNames(clinprot, backend=backend) == acp.readClinProtStructureNames(clinprot, backend='etree')
+    summary = acp.summarizeProt(clinprot, backend=backend)
+    assert summary['ID'] == 'SBRTTórax1fx' and 'Corazón' in summary['Structures']
+    assert summary['Items'] == len(cpet.find('Phases').find('Phase').find('Prescription').findall('Item'))
+    assert [e.get('ID') for e in acp.xmlBackend(backend).xpath(cpet.getroot(), ".//Structure[@ID='Corazón']")] == ['Corazón']
+    assert acp.ClinicalProtocol(cpet).structureElement('Corazón').get('ID') == 'Corazón'
+    acp.writeProt(cpet, tmp_path / 'out.xml')
+    assert acp.readClinProtStructureNames(tmp_path / 'out.xml', backend='etree') == summary['Structures']
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+import aclinprot as acp
+
+RS_test = '../DICOM/RS.1.2.246.352.205.4955711944111358107.16273022557623532164.dcm'
+
+def test_readContouringStructureNames_headerOnly(rsdicom=RS_test):
+    assert acp.readContouringStructureNames(rsdicom) == acp.readContouringStructureNames(rsdicom, headerOnly=False)
+
+def test_readContouringStructures(rsdicom=RS_test):
+    strdf = acp.readContouringStructures(rsdicom)
+    assert len(strdf) == 21
+    assert strdf.set_index('ROIName').loc['PTV mama izqda', 'RTROIInterpretedType'] == 'PTV'
+
+def test_normalizeStrName():
+    assert acp.normalizeStrName('Pulmón Izqdo') == acp.normalizeStrName('pulmon_I') == acp.normalizeStrName('Pulmon_L')
+    assert acp.normalizeStrName('Cabeza femoral D') == 'cabeza femoral r'
+
+def test_StrNameMatcher(rsdicom=RS_test):
+    matcher = acp.StrNameMatcher(acp.readContouringStructureNames(rsdicom))
+    assert matcher.match('Pulmon_I')[0][0] == 'Pulmón izqdo'
+    assert [name for name, _ in matcher.match('Corazon', k=3)][0] == 'Corazón'
+    assert len(matcher.matchAll(['Esofago', 'Medula'], k=2)) == 4
+
+def test_StructureSetArchive(tmp_path, rsdicom=RS_test):
+    (tmp_path / 'copy').mkdir()
+    for name in ['RS.a.dcm', 'copy/RS.b.dcm']:
+        (tmp_path / name).write_bytes(open(rsdicom, 'rb').read())
+    (tmp_path / 'RS.bad.dcm').write_bytes(b'not dicom')
+    with acp.StructureSetArchive(archive=tmp_path, dictionary={'Corazón': 'Heart'}) as archive:
+        assert archive.scan(max_workers=2, executor='thread') == {'read': 2, 'unchanged': 0, 'removed': 0, 'errors': 1}
+        assert archive.scan()['unchanged'] == 3
+        namesdf = archive.names().set_index('ROIName')
+        assert len(namesdf) == 21 and namesdf.Count.eq(1).all()
+        assert namesdf.loc['Corazón', 'Dictionary'] == 'Heart'
+        frequenciesdf = archive.frequencies('Dictionary').set_index('Dictionary')
+        assert frequenciesdf.loc['Heart', 'Names'] == ['Corazón'] and frequenciesdf.Variants.sum() == 21
+        (tmp_path / 'RS.a.dcm').unlink()
+        assert archive.scan()['removed'] == 1 and len(archive.names()) == 21
+
+def _squareRS(path):
+    # Cuadrado de 20 mm con un agujero de 10 mm en sentido contrario en 5 planos separados 2 mm: 3 cc
+    import pydicom as dcm
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+    square = [0, 0, 20, 0, 20, 20, 0, 20]
+    hole = [5, 5, 5, 15, 15, 15, 15, 5]
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.481.3'
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+    ds.StructureSetROISequence = [Dataset(), Dataset()]
+    ds.ROIContourSequence = [Dataset()]
+    for number, (roi, name) in enumerate(zip(ds.StructureSetROISequence, ['Ring', 'Empty']), 1):
+        roi.ROINumber, roi.ROIName = number, name
+    ds.ROIContourSequence[0].ReferencedROINumber = 1
+    ds.ROIContourSequence[0].ContourSequence = []
+    for z in range(0, 10, 2):
+        for xy in [square, hole]:
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(xy) // 2
+            contour.ContourData = [value for x, y in zip(xy[::2], xy[1::2]) for value in (x, y, z)]
+            ds.ROIContourSequence[0].ContourSequence.append(contour)
+    dcm.dcmwrite(path, ds, enforce_file_format=True)
+    return path
+
+def test_readStructureVolumes(tmp_path):
+    rsdicom = _squareRS(tmp_path / 'RS.square.dcm')
+    strvoldf = acp.readStructureVolumes(rsdicom).set_index('ROIName')
+    assert strvoldf.loc['Ring', 'Volume'] == pytest.approx(3.0)
+    assert strvoldf.loc['Ring', ['CentroidX', 'CentroidY', 'CentroidZ']].tolist() == pytest.approx([10, 10, 4])
+    assert strvoldf.loc['Ring', ['MinX', 'MaxX', 'MinZ', 'MaxZ', 'Slices', 'Contours']].tolist() == [0, 20, 0, 8, 5, 10]
+    assert strvoldf.loc['Empty', 'Contours'] == 0 and np.isnan(strvoldf.loc['Empty', 'Volume'])
+    assert acp.readStructureVolume(rsdicom, 'Ring', SliceThickness=3) == pytest.approx(4.5)
+
+def test_dosimParVolumes(rsdicom=RS_test):
+    strvoldf = acp.readStructureVolumes(rsdicom, ROINames=['Corazón'])
+    oardf = pd.DataFrame({'Organ': ['Corazon', 'Recto'], 'DosimPars': [['V25$10%', 'V30$20cc'], ['V50$35%']]})
+    dosimvoldf = acp.dosimParVolumes(oardf, strvoldf)
+    assert dosimvoldf.ROIName.iloc[:2].tolist() == ['Corazón', 'Corazón'] and pd.isna(dosimvoldf.ROIName.iloc[2])
+    volume = strvoldf.Volume.iloc[0]
+    assert dosimvoldf.VolumeCC.iloc[0] == pytest.approx(volume / 10)
+    assert dosimvoldf.VolumePercentage.iloc[1] == pytest.approx(20 / volume * 100)
+    assert np.isnan(dosimvoldf.VolumeCC.iloc[2])
@@ -0,0 +1,75 @@
+import io
+import os
+import time
+import xml.etree.ElementTree as ET
+import aclinprot as acp
+
+prescription_dir = '../prescripciones'
+Prostata_test = '../prescripciones/Prostata.csv'
+
+def test_convertPrescriptionIntoClinicalProtocol_ProtOutDir(tmp_path, prescription_test=Prostata_test):
+    acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                ProtOut='Prostata.xml', ProtOutDir=tmp_path)
+    assert os.path.exists(tmp_path / 'Prostata.xml')
+
+def test_convertPrescriptionIntoClinicalProtocol_defaultDir(tmp_path, monkeypatch, prescription_test=Prostata_test):
+    # La carpeta por defecto no depende del directorio de trabajo
+    prescription_test = os.path.abspath(prescription_test)
+    monkeypatch.setattr(acp, 'CLINICAL_PROTOCOLS_DIR', str(tmp_path))
+    monkeypatch.chdir(tmp_path.parent)
+    acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID', ProtOut='Prostata.xml')
+    assert os.path.exists(tmp_path / 'Prostata.xml')
+
+def test_convertPrescriptionFiles(tmp_path, prescriptions=prescription_dir):
+    summarydf = acp.convertPrescriptionFiles(prescriptions, tmp_path, max_workers=2)
+    assert len(summarydf) == len([f for f in os.listdir(prescriptions) if f.endswith('.csv')])
+    assert summarydf.Failed.sum() == 0
+    assert all(os.path.exists(output) for outputs in summarydf.Outputs for output in outputs)
+
+def test_convertPrescriptionIntoClinicalProtocol_bytes(tmp_path, prescription_test=Prostata_test):
+    protbytes = acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                            ProtOut=None, ProtOutDir=tmp_path, Return='bytes')
+    assert protbytes.startswith(b'<?xml')
+    assert os.listdir(tmp_path) == []
+    cpet = acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                       ProtOut=None, Return='tree')
+    assert acp.serializeProt(cpet).startswith(b'<?xml')
+    assert acp.ClinicalProtocol(cpet).structureIDs == acp.ClinicalProtocol(acp.parseProt(io.BytesIO(protbytes))).structureIDs
+
+def test_convertPrescriptionIntoClinicalProtocol_Timings(tmp_path, prescription_test=Prostata_test):
+    timings = acp.ConversionTimings()
+    stages = []
+    cpet = acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                       ProtOut=None, Return='tree', Timings=timings,
+                                                       Hook=lambda stage, seconds, calls: stages.append(stage),
+                                                       Profile=str(tmp_path / 'convert.prof'))
+    assert os.path.exists(tmp_path / 'convert.prof')
+    assert stages == list(timings.stages) and 'writeProt' not in stages and timings.runs == 1
+    reportdf = timings.report().set_index('Stage')
+    assert reportdf.loc['addStructure', 'Calls'] == len(cpet.findall('StructureTemplate/Structures/Structure'))
+    batchTimings = acp.ConversionTimings()
+    acp.convertPrescriptionFiles([prescription_test], tmp_path, Timings=batchTimings)
+    assert batchTimings.runs == 1 and batchTimings.stages['writeProt'][0] == 1
+
+def test_convertPrescriptionIntoClinicalProtocol_slowHook(prescription_test=Prostata_test):
+    timings = acp.ConversionTimings()
+    acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                ProtOut=None, Return='tree', Timings=timings,
+                                                Hook=lambda stage, seconds, calls: time.sleep(0.05))
+    # El tiempo del hook no se carga a la etapa siguiente
+    assert max(seconds for _, seconds in timings.stages.values()) < 0.05
+
+def test_convertPrescriptionIntoClinicalProtocol_skipped(caplog, prescription_test=Prostata_test):
+    prescription = acp.parse_prescription_ir(prescription_test, 0)
+    prescription.OARConstraints.append(acp.OARConstraint('Recto', None, float('nan'), DosimPar='V53$<0.05cc'))
+    acp.convertPrescriptionIntoClinicalProtocol(prescription, 'Prostata', 'Prostate', 'PlanID', ProtOut=None)
+    assert 'Recto: V53$<0.05cc' in caplog.text
+
+def test_convertPrescriptionIntoClinicalProtocol_Prescription(prescription_test=Prostata_test):
+    prescription = acp.parse_prescription_ir(prescription_test, 0)
+    fromIR = acp.convertPrescriptionIntoClinicalProtocol(prescription, 'Prostata', 'Prostate', 'PlanID',
+                                                         ProtOut=None, Return='tree')
+    fromFile = acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                           ProtOut=None, Return='tree')
+    prescriptionPath = 'Phases/Phase/Prescription'
+    assert ET.tostring(fromIR.find(prescriptionPath)) == ET.tostring(fromFile.find(prescriptionPath))
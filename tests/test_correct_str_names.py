@@ -0,0 +1,69 @@
+import pandas as pd
+import aclinprot as acp
+
+Prostata_test = '../prescripciones/Prostata.csv'
+SBRTTorax_test = '../protocolos/clinicos/SBRTTórax1fx.xml'
+
+def test_correctStrNames_prefix(prescription_test=Prostata_test):
+    strNameChanges = pd.DataFrame([{'Old': 'PTV', 'New': 'PTV_X'}, {'Old': 'PTV gg', 'New': 'PTV_GG'}])
+    with open(prescription_test) as f:
+        filedata = acp._correctStrNames(f.read(), strNameChanges)
+    assert 'PTV_GG' in filedata and 'PTV_X' not in filedata and 'PTV gg' not in filedata
+
+def test_StrNameRenamer_renameXML(clinprot=SBRTTorax_test):
+    with open(clinprot, encoding='utf-8') as f:
+        filedata, count = acp.StrNameRenamer({'Corazón': 'Heart'}).renameXML(f.read())
+    assert count == 4
+    assert 'Corazón' not in filedata
+
+def test_StrNameRenamer_renameDirectory(tmp_path, prescription_test=Prostata_test):
+    renamedf = acp.StrNameRenamer({'Recto': 'Rectum'}).renameDirectory('../prescripciones', outdir=tmp_path)
+    assert renamedf.set_index('File').loc[prescription_test, 'Replacements'] == 1
+    assert 'Rectum' in acp.parse_prescription(str(tmp_path / 'Prostata.csv'))[2][0].Organ.tolist()
+
+def test_StrNameTranslator_translateDirectory(tmp_path):
+    translator = acp.StrNameTranslator({'Corazón': 'Heart', 'Médula': 'SpinalCord'})
+    summarydf, changelogdf = translator.translateDirectory(['../protocolos/clinicos/SBRTTórax1fx.xml'], tmp_path)
+    assert summarydf.Error.eq('').all() and summarydf.Changes.sum() == len(changelogdf)
+    assert set(changelogdf.New) <= {'Heart', 'SpinalCord'}
+    cpet = acp.parseProt(str(tmp_path / 'SBRTTórax1fx.xml'))
+    structureIDs = [s.get('ID') for s in cpet.getroot().iterfind('.//Structures/Structure')]
+    assert 'Heart' in structureIDs and 'Corazón' not in structureIDs
+
+def test_StrNameRules_check():
+    rules = acp.StrNameRules(dictionary={'Pulmón Izqdo': 'Lung_L'})
+    violationsdf = rules.check({'RS': ['Lung_L', 'Pulmón Izqdo', 'pulmon_i', 'PTV_Very_Long_Name_1']})
+    assert list(violationsdf.columns) == ['Source', 'Name', 'Rule', 'Severity', 'Message']
+    rulesByName = violationsdf.groupby('Name').Rule.agg(set)
+    assert 'Lung_L' not in rulesByName
+    assert rulesByName['Pulmón Izqdo'] == {'Characters', 'Laterality', 'Duplicate', 'Dictionary'}
+    assert rulesByName['pulmon_i'] >= {'Casing', 'Laterality', 'Duplicate'}
+    assert 'MaxLength' in rulesByName['PTV_Very_Long_Name_1']
+    assert 'translate to Lung_L' in violationsdf.query("Rule == 'Dictionary'").Message.iloc[0]
+
+def test_StrNameRules_duplicates():
+    rules = acp.StrNameRules(dictionary=None)
+    violationsdf = rules.check(['BODY'] * 8000 + ['Body', 'body', 'Bódy', 'bodY', 'BoDy', 'B.ody'])
+    messages = violationsdf.query("Rule == 'Duplicate'").Message
+    assert len(messages) == 8005 and messages.iloc[0] == 'Same normalized name as BODY (x7999), Body, body, Bódy, bodY and 1 more'
+    assert messages.iloc[-1] == 'Same normalized name as BODY (x8000), Body, body, Bódy, bodY'
+
+def test_StrNameRules_checkFiles(prescription_test=Prostata_test, clinprot=SBRTTorax_test):
+    violationsdf = acp.StrNameRules().checkFiles([prescription_test, clinprot])
+    assert set(violationsdf.Source) <= {prescription_test, clinprot}
+    assert 'Unreadable' not in set(violationsdf.Rule)
+
+def test_StrNameTranslator_dictionary():
+    translator = acp.StrNameTranslator()
+    assert len(translator.mapping) == 83 and set(translator.ambiguous) == {'plexo braquial', 'hipocampo'}
+    assert translator.translateName('PULMÓN  izqdo') == 'Lung_L' and translator.translateName('Plexo Braquial') is None
+    assert {'Lung_L', 'BrachialPlex_L', 'Pituitary'} <= translator.names
+
+def test_StrNameRenamer_StrNameTranslator_agree(clinprot='../protocolos/clinicos/Próstata 20Fx.xml'):
+    mapping = {'Recto': 'Rectum', 'Vejiga': 'Bladder', 'Cabeza femoral D': 'Femur_Head_R'}
+    with open(clinprot, encoding='utf-8') as f:
+        filedata, count = acp.StrNameRenamer(mapping).renameXML(f.read())
+    cpet = acp.parseProt(clinprot)
+    changes = acp.StrNameTranslator(mapping).translate(cpet)
+    assert count == len(changes) and {change['Element'] for change in changes} >= {'ObjectivesOneStructure', 'Item'}
+    assert filedata.encode('utf-8') == acp.serializeProt(cpet)
@@ -1,3 +1,5 @@
+import importlib.util
+import pandas as pd
 import aclinprot as acp
 
 Vxx_test = 'data/Vxx.csv'
@@ -81,3 +83,94 @@ def test_parseDosimPar_19(strDosimPar='V35Gy$67%'):
     assert actual['Vxx%'] == {'VolumeRelative': 67.0, 'DoseGy': 35.0}
     
 
+
+# Vectorized parsing of a whole DosimPar column
+def test_parseDosimPars_1(strDosimPars=['V 36$42 %', 'V60$3 cc', 'D950 cc$7.2 Gy', 'D40%$7.3Gy', 'Dmax']):
+    actual = acp.parseDosimPars(strDosimPars)
+    assert list(actual['Kind'].astype(object).fillna('')) == ['Vxx%', 'VxxGy', 'Dxxcc_Gy', 'Dxx%_Gy', '']
+    assert list(actual['Recognized']) == [True, True, True, True, False]
+    assert actual.loc[2, ['Dose', 'Volume']].tolist() == [7.2, 950.0]
+
+def test_parseDosimPars_2(strDosimPar='V3000cGy$50%'):
+    actual = acp.parseDosimPars([strDosimPar]).iloc[0]
+    assert (actual['Kind'], actual['Dose'], actual['DoseUnits'], actual['Volume'], actual['VolumeUnits']) == ('Vxx%', 30.0, 'Gy', 50.0, '%')
+
+def test_parseDosimPars_3(strDosimPars=['D2cc$70 Gy (max)', 'V20$30% x', 'V20$30%', 'D150cc$76.2%', 'D55.3%$51.86%',
+                                       'V2780cGy$11.46 %']):
+    actual = acp.parseDosimPars(pd.Series(strDosimPars * 3))
+    assert list(actual['Recognized'][:6]) == [bool(acp.parseDosimPar(p)) for p in strDosimPars]
+    assert list(actual['Kind'].astype(object).fillna('')[:6]) == ['Dxxcc_Gy', '', 'Vxx%', 'Dxxcc_Gy', 'Dxx%_Gy', 'Vxx%']
+    assert actual.loc[5, ['Dose', 'Volume']].tolist() == [27.8, 11.46]
+    assert actual.iloc[6:12].reset_index(drop=True).equals(actual.iloc[:6])
+
+def test_checkDosimPars_unrecognized():
+    oardf = pd.DataFrame({'Organ': ['Recto'], 'DosimPars': [['V50$50%', '', float('nan'), 'V53$<0.05cc']]})
+    assert acp.checkDosimPars(oardf).Recognized.tolist() == [True, False, False, False]
+
+# Content-hash cache of parse_prescription
+def test_parse_prescription_cached(prescription_test='../prescripciones/Prostata.csv'):
+    cache = acp.PrescriptionCache(maxsize=2)
+    pvdfs, ccds, oardfs = acp.parse_prescription_cached(prescription_test, cache=cache)
+    oardfs[0].at[0, 'DosimPars'].append('V1$1%')
+    with open(prescription_test, 'rb') as f:
+        _, _, cachedoardfs = acp.parse_prescription_cached(f.read(), cache=cache)
+    assert 'V1$1%' not in cachedoardfs[0].at[0, 'DosimPars']
+    assert cache.info()['hits'] == 1 and cache.info()['entries'] == 1
+
+# Synthetic ARIA exports
+def test_generatePrescriptionExport(tmp_path, nPrescriptions=3, nPTVs=2, nOARs=30, nDosimPars=4):
+    export = tmp_path / 'Sintetica.csv'
+    acp.generatePrescriptionExport(export, nPrescriptions, nPTVs, nOARs, nDosimPars, seed=7)
+    pvdfs, ccds, oardfs = acp.parse_prescription(export)
+    assert len(pvdfs) == nPrescriptions
+    assert all(len(pvdf) == nPTVs and len(ccdf) == nPTVs for pvdf, ccdf in zip(pvdfs, ccds))
+    assert all(len(oardf) == nOARs for oardf in oardfs)
+    assert all(acp.checkDosimPars(oardf)['Recognized'].all() for oardf in oardfs)
+    again = tmp_path / 'Sintetica2.csv'
+    acp.generatePrescriptionExport(again, nPrescriptions, nPTVs, nOARs, nDosimPars, seed=7)
+    assert export.read_bytes() == again.read_bytes()
+
+# Columnar long-form parser
+def test_parse_prescription_tables(tmp_path, prescription_test='../prescripciones/Prostata.csv'):
+    export = tmp_path / 'Sintetica.csv'
+    acp.generatePrescriptionExport(export, nPrescriptions=4, nOARs=6, nDosimPars=3, seed=3)
+    for prescription in [prescription_test, export]:
+        pvdfs, ccds, oardfs = acp.parse_prescription(prescription)
+        pvtable, cctable, oartable = acp.parse_prescription_tables(prescription)
+        for index, (pvdf, ccdf, oardf) in enumerate(zip(pvdfs, ccds, oardfs)):
+            pv = pvtable[pvtable.PrescriptionIndex == index]
+            assert list(pv.Volume) == list(pvdf.Volume)
+            assert list(pv.Dose) == list(pvdf.Dose.astype(float))
+            cc = cctable[cctable.PrescriptionIndex == index]
+            assert [[cc.AtLeast[i], cc.AtLeastPercentage[i], cc.AtLeastDose[i]] for i in cc.index] == \
+                [[float(x) for x in atLeast] for atLeast in ccdf.AtLeast]
+            oar = oartable[oartable.PrescriptionIndex == index]
+            assert [list(dosimPars.dropna()) for _, dosimPars in oar.groupby('OARIndex').DosimPar] == \
+                list(oardf.DosimPars)
+
+# Streaming parser
+def test_iter_prescriptions(tmp_path):
+    export = tmp_path / 'Sintetica.csv'
+    acp.generatePrescriptionExport(export, nPrescriptions=5, nOARs=3, nDosimPars=2, seed=5)
+    pvdfs, ccds, oardfs = acp.parse_prescription(export)
+    engines = [None, 'pyarrow'] if importlib.util.find_spec('pyarrow') else [None]
+    for engine in engines:
+        prescriptions = list(acp.iter_prescriptions(export, chunksize=2, engine=engine))
+        assert len(prescriptions) == len(pvdfs)
+        for (pvdf, ccdf, oardf), expected in zip(prescriptions, zip(pvdfs, ccds, oardfs)):
+            assert pvdf.equals(expected[0]) and ccdf.equals(expected[1]) and oardf.equals(expected[2])
+
+def test_parse_prescription_ir(prescription_test='../prescripciones/Prostata.csv'):
+    prescription = acp.parse_prescription_ir(prescription_test, 0)
+    pvdfs, ccdfs, oardfs = acp.parse_prescription(prescription_test)
+    fromDataFrames = acp.prescriptionFromDataFrames(pvdfs[0], ccdfs[0], oardfs[0])
+    for actual, expected in zip(prescription.dataframes(), fromDataFrames.dataframes()):
+        pd.testing.assert_frame_equal(actual, expected)
+    assert prescription.TreatmentDose == acp.getTreatmentDosePrescription(pvdfs[0])
+    assert prescription.FractionCount == int(float(pvdfs[0].Dose[0]) / float(pvdfs[0].FxDose[0]))
+    assert prescription.OrgansAtRisk == oardfs[0].Organ.tolist()
+    dosimpardf = acp.oarDosimPars(oardfs[0])
+    oardf = prescription.dataframes()[2]
+    oardf = oardf[oardf.DosimPar != '']
+    assert oardf.Kind.fillna('').tolist() == dosimpardf.Kind.astype(object).fillna('').tolist()
+    assert not hasattr(prescription, '__dict__')
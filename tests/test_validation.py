@@ -0,0 +1,17 @@
+import aclinprot as acp
+
+Prostata_test = '../prescripciones/Prostata.csv'
+
+def test_ValidationReport_counts(prescription_test=Prostata_test):
+    counts = acp.ValidationReport(prescription_test).counts.loc[0]
+    assert counts.PrescriptionName == 'Lecho PT hipofx + GG'
+    assert (counts.CoverageConstraints, counts.OARConstraints) == (4, 16)
+    assert (counts.PlanObjetives, counts.ConstraintsToQualityIndexes, counts.QualityIndexes) == (20, 15, 19)
+
+def test_ValidationReport_compare(tmp_path, prescription_test=Prostata_test):
+    acp.convertPrescriptionIntoClinicalProtocol(prescription_test, 'Prostata', 'Prostate', 'PlanID',
+                                                ProtOut='Prostata.xml', ProtOutDir=tmp_path)
+    clinicalProtocol = str(tmp_path / 'Prostata.xml')
+    comparisondf = acp.ValidationReport(prescription_test).compare(clinicalProtocol)
+    assert comparisondf.loc[0, 'Items'] == acp.clinicalProtocolPrescriptionItemCounting(clinicalProtocol)
+    assert comparisondf.loc[0, 'MeasureItems'] == acp.clinicalProtocolPrescriptionQualityIndexCounting(clinicalProtocol)